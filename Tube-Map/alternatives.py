@@ -0,0 +1,194 @@
+#alternative routes: the K shortest routes between two stations, by Yen's algorithm over the (station, line) states
+#of a CompiledGraph. routes never visit a station twice and never change line at the origin (starting on the other
+#line is free, so that would just be the same route with a pointless transfer)
+#every spur search in Yen's algorithm is a search to the same destination on the same graph with some states and edges
+#taken away, so one reverse shortest path tree to the destination is worked out per query and reused by all of them:
+#its distances are an exact A* heuristic (taking edges away only makes distances longer), and when the tree's own
+#path from the spur state avoids everything that's been taken away, that path is the spur path and no search is needed
+from array import array
+from heapq import heappush, heappop
+from setup import *
+from routes import route_legs
+
+def reverse_tree(compiled, end_id):
+    #dijkstra backwards from every state of end_id: returns (distance to end_id, next state towards it) per state
+    INF = float('inf')
+    reverse_offsets, reverse_sources, reverse_weights = compiled._reverse_edges()
+    n_states = len(compiled.state_station)
+    distances = [INF] * n_states
+    successors = array('i', [-1]) * n_states
+    queue = []
+    for state in compiled.station_states[end_id]:
+        distances[state] = 0
+        heappush(queue, (0, state))
+    while queue:
+        current_distance, state = heappop(queue)
+        if current_distance != distances[state]:
+            continue
+        for k in range(reverse_offsets[state], reverse_offsets[state + 1]):
+            distance = current_distance + reverse_weights[k]
+            source = reverse_sources[k]
+            if distance < distances[source]:
+                distances[source] = distance
+                successors[source] = state
+                heappush(queue, (distance, source))
+    return distances, successors
+
+class _Query:
+    #one k shortest routes query: the graph, the reverse tree and the spur searches
+    def __init__(self, compiled, start_id, end_id, reuse_tree=True):
+        self.compiled = compiled
+        self.start_id = start_id
+        self.end_id = end_id
+        if reuse_tree:
+            self.to_end, self.successors = reverse_tree(compiled, end_id)
+        else:
+            #every spur search is a plain dijkstra (for benchmarking against)
+            n_states = len(compiled.state_station)
+            self.to_end, self.successors = [0] * n_states, array('i', [-1]) * n_states
+        self.spur_searches = 0
+        self.tree_shortcuts = 0
+        self.settled = 0
+
+    def allowed(self, state, target, blocked_stations, blocked_targets):
+        compiled = self.compiled
+        if compiled.state_station[target] in blocked_stations or compiled.state_station[target] == self.start_id:
+            return False
+        if blocked_targets and target in blocked_targets:
+            return False
+        #no changing lines at the origin
+        return compiled.state_station[state] != self.start_id or compiled.state_line[state] == compiled.state_line[target]
+
+    def tree_path(self, state, blocked_stations, blocked_targets):
+        #the reverse tree's path from state to the end, if none of it is blocked
+        path = [state]
+        seen = set(blocked_stations)
+        while self.compiled.state_station[state] != self.end_id:
+            target = self.successors[state]
+            if target == -1 or not self.allowed(state, target, seen, blocked_targets if len(path) == 1 else None):
+                return None
+            seen.add(self.compiled.state_station[target])
+            path.append(target)
+            state = target
+        return path
+
+    def search(self, sources, blocked_stations, blocked_targets):
+        #A* from sources (state indices, all at distance 0) to any end state, guided by the reverse tree
+        #blocked_targets only apply to edges out of the sources (those are the edges Yen's algorithm removes)
+        #returns a path of state indices or None
+        INF = float('inf')
+        compiled = self.compiled
+        offsets, targets, weights = compiled.state_offsets, compiled.state_targets, compiled.state_weights
+        state_station = compiled.state_station
+        to_end = self.to_end
+        self.spur_searches += 1
+        if len(sources) == 1:
+            path = self.tree_path(sources[0], blocked_stations, blocked_targets)
+            if path is not None:
+                self.tree_shortcuts += 1
+                return path
+        distances = {}
+        predecessors = {}
+        queue = []
+        for state in sources:
+            if to_end[state] < INF:
+                distances[state] = 0
+                predecessors[state] = -1
+                heappush(queue, (to_end[state], 0, state))
+        source_set = set(sources)
+        while queue:
+            _, current_distance, state = heappop(queue)
+            if current_distance != distances[state]:
+                continue
+            self.settled += 1
+            if state_station[state] == self.end_id:
+                path = []
+                while state != -1:
+                    path.append(state)
+                    state = predecessors[state]
+                return path[::-1]
+            for k in range(offsets[state], offsets[state + 1]):
+                target = targets[k]
+                if to_end[target] == INF or not self.allowed(state, target, blocked_stations, blocked_targets if state in source_set else None):
+                    continue
+                distance = current_distance + weights[k]
+                if distance < distances.get(target, INF):
+                    distances[target] = distance
+                    predecessors[target] = state
+                    heappush(queue, (distance + to_end[target], distance, target))
+        return None
+
+    def cost(self, path):
+        #weights added up from the start, like every other search does
+        total = 0
+        for state, target in zip(path, path[1:]):
+            total += self.compiled._edge_weight(state, target)
+        return total
+
+def k_shortest_routes(compiled, start_id, end_id, k=3, max_candidates=None, stats=None, reuse_tree=True):
+    #up to k distinct routes from start_id to end_id, shortest first, as [(path, total), ...] where path is
+    #[(station, line), ...] like get_shortest_route. routes count as distinct if they ride different legs
+    #(so starting on a line you never ride doesn't make a new route). max_candidates bounds how many paths
+    #Yen's algorithm looks at, by default 10 * k. reuse_tree=False searches every spur from scratch
+    if not compiled.has_station(start_id) or not compiled.has_station(end_id) or k <= 0:
+        return []
+    if start_id == end_id:
+        return [compiled.shortest_route(start_id, end_id)]
+    if max_candidates is None:
+        max_candidates = 10 * k
+    query = _Query(compiled, start_id, end_id, reuse_tree)
+    station_of = compiled.state_station
+    start_states = compiled.station_states[start_id]
+
+    first = query.search(start_states, set(), None)
+    accepted = []          #every path Yen's algorithm has settled on, as tuples of states
+    candidates = []        #heap of (total, path)
+    seen_paths = set()
+    routes = []
+    seen_legs = set()
+    if first is not None:
+        heappush(candidates, (query.cost(first), tuple(first)))
+        seen_paths.add(tuple(first))
+    while candidates and len(routes) < k and len(accepted) < max_candidates:
+        total, path = heappop(candidates)
+        accepted.append(path)
+        route = [compiled.state_to_tuple(state) for state in path]
+        legs = tuple((line, tuple(stations)) for line, stations in route_legs(route))
+        if legs not in seen_legs:
+            seen_legs.add(legs)
+            routes.append((route, total))
+        if len(routes) >= k:
+            break
+
+        #spur from the origin itself (any start state not yet used as the first state of an accepted path)
+        #and from every state along the new path
+        for i in range(-1, len(path) - 1):
+            root = path[:i + 1]
+            blocked_stations = set(station_of[state] for state in root)
+            if i == -1:
+                used = set(p[0] for p in accepted)
+                sources = [state for state in start_states if state not in used]
+                if not sources:
+                    continue
+                spur = query.search(sources, blocked_stations, None)
+            else:
+                blocked_targets = set(p[i + 1] for p in accepted if len(p) > i + 1 and p[:i + 1] == root)
+                spur = query.search([path[i]], blocked_stations, blocked_targets)
+                if spur is not None:
+                    spur = spur[1:]
+            if spur is None:
+                continue
+            candidate = tuple(root) + tuple(spur)
+            if candidate in seen_paths:
+                continue
+            if len(set(station_of[state] for state in candidate)) != len(candidate):
+                continue    #visits a station twice (possible with zero weight edges), not a real alternative
+            seen_paths.add(candidate)
+            heappush(candidates, (query.cost(candidate), candidate))
+
+    if stats is not None:
+        stats['paths'] = len(accepted)
+        stats['spur_searches'] = query.spur_searches
+        stats['tree_shortcuts'] = query.tree_shortcuts
+        stats['settled'] = query.settled
+    return routes
@@ -1,40 +1,759 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from flask import Flask, render_template, request, redirect, url_for, flash
-import folium
+import hmac
+import os
+import threading
+import time
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, g
 
 # Import your existing backend functions and data structures
-from routes import get_shortest_route, journey_summary
-from visualisation import create_route_map
-from setup import graph, vertex_data, line_colours, vertex_ID
-from model import time_DC, model_transfer_time
+from routes import journey_summary, options_summary, route_legs, route_to_dict, stations_within
+from visualisation import create_route_map, create_isochrone_map, NetworkLayers
+from setup import graph, vertex_data, line_colours
+import model
+from model import model_transfer_time, model_fingerprint, get_parameters
+from journey_table import load_or_build_journey_table
+from route_cache import RouteCache
+from compiled_graph import CompiledGraph
+from compute_pool import ComputePool, PoolSaturated
+from station_index import StationIndex
+from alternatives import k_shortest_routes
+from pareto import pareto_routes
+from disruptions import Disruptions, DisruptionsFile, affected_routes, weight_changes, file_stamp
+import instrumentation
+from instrumentation import stage
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # needed for flashing messages
 
-# Prepare a sorted list of all station names from your vertex_data for the datalist
-station_names = sorted([vertex_data[vid][0] for vid in vertex_data])
+ROUTE_MODES = ('time', 'distance', 'stops', 'transfers')
+MAX_BATCH_PAIRS = 100000
+MAX_ISOCHRONE_MINUTES = 600
+MAX_SUGGESTIONS = 50
+MAX_ALTERNATIVES = 10
+MAP_ALTERNATIVES = 2  # extra routes drawn (dashed, in their own layers) under the route on the map page
+
+# Stations, line segments and lines closed at the moment (see update_disruptions). Every worker process has its own
+# copy, kept in step with the others through DISRUPTIONS_FILE (see sync_disruptions)
+disruptions = Disruptions()
+disruptions_lock = threading.RLock()
+shared_disruptions = DisruptionsFile(os.environ.get("DISRUPTIONS_FILE") or os.path.join(app.root_path, "disruptions.json"))
+
+def model_time_function(parameters=None):
+    """
+    Edge times for the current parameters (or the given ones) from the vectorised model, in one batched pass rather
+    than per-edge time_DC calls. It needs numpy, so it's imported here: serving routes from a saved journey table
+    never loads it.
+    """
+    from vectorised_model import make_time_function
+    return make_time_function(graph, parameters or get_parameters())
+
+def build_compiled_graph(mode, parameters=None):
+    """
+    A CompiledGraph for the given mode and model parameters (the current ones by default), with the closures applied.
+    """
+    compiled = CompiledGraph.build(
+        graph, mode,
+        time_function=model_time_function(parameters),
+        transfer_time=model_transfer_time
+    )
+    disruptions.apply(compiled)
+    return compiled
+
+def build_journey_table(parameters=None):
+    """
+    Precompute every journey once, so each request is a table lookup instead of a fresh Dijkstra.
+    The table on disk is for the open network, so any closures are then applied to it.
+    parameters builds it for other model parameters than the current ones, without touching them (see reload_parameters).
+    """
+    table = load_or_build_journey_table(
+        graph, model_fingerprint(parameters),
+        time_function_factory=lambda: model_time_function(parameters),
+        transfer_time=model_transfer_time
+    )
+    if disruptions:
+        compiled = get_compiled_graph('time') if parameters is None else build_compiled_graph('time', parameters)
+        table.update(compiled, weight_changes(compiled))
+    return table
+
+journey_table = build_journey_table()
+
+# The whole network (every line and station) is drawn once and shipped as static GeoJSON,
+# so each response only has to render the route overlay
+network_layers = NetworkLayers(graph, vertex_data, line_colours)
+base_layer_files = network_layers.write_geojson(os.path.join(app.root_path, 'static'), url_path='static')
+
+# Finished route results for the most popular origin/destination pairs
+route_cache = RouteCache(maxsize=512)
+model.on_parameters_changed(route_cache.clear)
+
+def reload_parameters():
+    """
+    Reload the fitted model parameters from disk, rebuild the journey table and drop every cached route.
+    Returns False (and changes nothing) if the saved parameters are missing or stale.
+    The new table is built before anything is swapped, so requests keep using the old table and parameters until
+    then. The table goes in first and the parameters (which bump parameters_version and clear the caches) straight
+    after, so a route from the old table can only ever be cached under the old version.
+    disruptions_lock is held throughout, so closures can't change between building the table and swapping it in.
+    """
+    global journey_table
+    parameters = model.read_parameters()
+    if parameters is None:
+        return False
+    with disruptions_lock:
+        table = build_journey_table(parameters)
+        journey_table = table
+        model.set_parameters(parameters)
+    return True
+
+# Array-backed graphs for the modes the journey table doesn't cover, built on first use
+compiled_graphs = {}
+model.on_parameters_changed(compiled_graphs.clear)
+
+def get_compiled_graph(mode):
+    """
+    Return the CompiledGraph with edge weights baked in for the given mode.
+    """
+    if mode not in compiled_graphs:
+        compiled_graphs[mode] = build_compiled_graph(mode)
+    return compiled_graphs[mode]
+
+# Time dependent routing for a given departure time, with line frequencies by time of day (line_frequencies.json)
+timetable_routers = {}
+model.on_parameters_changed(timetable_routers.clear)
+
+def get_timetable_router():
+    """
+    Return the TimetableRouter for the current model parameters, built on first use (timetable.py and numpy are
+    only imported then).
+    """
+    if 'time' not in timetable_routers:
+        from timetable import TimetableRouter
+        router = TimetableRouter(graph, model_time_function())
+        router.apply_disruptions(disruptions)
+        timetable_routers['time'] = router
+    return timetable_routers['time']
+
+def warm_up():
+    """
+    Build everything that is otherwise built on first use (the compiled graph for every mode and the timetable router)
+    and import folium, which visualisation.py otherwise imports on the first map.
+    Called in the gunicorn master before forking (see gunicorn.conf.py), so all the workers share one copy.
+    """
+    import folium
+    for mode in ROUTE_MODES:
+        get_compiled_graph(mode)  # the time one is for alternative and pareto routes, single routes come from the journey table
+    get_timetable_router()
+
+def update_disruptions(change):
+    """
+    Change the closures (change is called with the Disruptions) and bring everything built from the graph up to date
+    without rebuilding it: the compiled graphs and the timetable router are patched, the journey table repairs just
+    the parts of its trees that changed, and only the cached routes the change could affect are dropped.
+    Searches don't take disruptions_lock, so nothing they can see is patched in place: each compiled graph and the
+    router are patched as copies and swapped in with one assignment, like the journey table swaps whole rows.
+    Returns a summary of what was done.
+    """
+    with disruptions_lock:
+        started = time.perf_counter()
+        get_compiled_graph('time')  # the journey table is repaired from it, so it has to see the change
+        closed_before = set(disruptions.stations)
+        change(disruptions)
+        endpoints = closed_before ^ disruptions.stations  # stations where journeys can now start and end, or no longer can
+        edges_changed = 0
+        affected = {}
+        table_changes = {}
+        for mode, compiled in list(compiled_graphs.items()):
+            compiled = compiled.copy()
+            changes = disruptions.apply(compiled)
+            compiled_graphs[mode] = compiled
+            edges_changed += len(changes)
+            if mode == 'time':
+                table_changes = journey_table.update(compiled, changes)
+            elif changes:
+                affected[mode] = affected_routes(compiled, changes)
+        if timetable_routers:
+            timetable_routers['time'] = timetable_routers['time'].with_disruptions(disruptions)
+
+        def stale(key, value):
+            start_id, end_id, mode, _ = key
+            if start_id in endpoints or end_id in endpoints:
+                return True
+            if mode == 'time':
+                return end_id in table_changes.get(start_id, ())
+            return mode in affected and affected[mode](start_id, end_id, value[0], value[1])
+        dropped = route_cache.discard(stale)
+        return {
+            "edges_changed": edges_changed,
+            "routes_changed": sum(len(destinations) for destinations in table_changes.values()),
+            "cached_routes_dropped": dropped,
+            "milliseconds": (time.perf_counter() - started) * 1000,
+        }
+
+def sync_disruptions():
+    """
+    Bring this process's closures up to date with the ones saved in the shared file, if another worker changed them.
+    Called before every request (and once at import), it costs one stat when nothing changed.
+    """
+    if not shared_disruptions.changed():
+        return
+    with disruptions_lock:
+        stored = shared_disruptions.poll()
+        if stored is not None and stored[0] != shared_disruptions.version:
+            version, closures = stored
+            update_disruptions(lambda current: current.replace(closures))
+            shared_disruptions.version = version
+
+def change_disruptions(change):
+    """
+    update_disruptions for a change made through the API: it's made on top of the latest saved closures, under the
+    shared file's lock, and saved there for the other workers to pick up.
+    """
+    with shared_disruptions.locked(), disruptions_lock:
+        sync_disruptions()
+        summary = update_disruptions(change)
+        shared_disruptions.save(disruptions)
+    return summary
+
+sync_disruptions()  # closures saved before this process started
+
+@app.before_request
+def apply_shared_disruptions():
+    sync_disruptions()
+
+# `python fit_model.py` rewrites the parameters file; every worker notices on its next request and reloads it
+parameters_lock = threading.Lock()
+parameters_stamp = file_stamp(model.PARAMETERS_FILE)
+
+@app.before_request
+def apply_new_parameters():
+    """
+    Reload the model parameters if the file has changed since they were loaded (one stat per request).
+    Only one thread reloads; the others carry on with the old parameters until it's done.
+    """
+    global parameters_stamp
+    if file_stamp(model.PARAMETERS_FILE) == parameters_stamp or not parameters_lock.acquire(blocking=False):
+        return
+    try:
+        stamp = file_stamp(model.PARAMETERS_FILE)
+        if stamp != parameters_stamp:
+            parameters_stamp = stamp
+            reload_parameters()
+    finally:
+        parameters_lock.release()
+
+def closed_station(start_id, end_id):
+    """
+    The first of the two stations that is closed (no journeys start or end there), or None.
+    """
+    return next((station for station in (start_id, end_id) if disruptions.is_closed(station)), None)
+
+def find_route(start_id, end_id, mode='time'):
+    """
+    Return (route_path, route_distance) without going through the route cache.
+    """
+    if closed_station(start_id, end_id) is not None:
+        return None, float('inf')
+    if mode == 'time':
+        return journey_table.get_route(start_id, end_id)
+    stats = {} if instrumentation.ENABLED else None
+    result = get_compiled_graph(mode).shortest_route(start_id, end_id, stats=stats)
+    instrumentation.record_search(mode, stats)
+    return result
+
+def get_route_result(start_id, end_id, mode='time'):
+    """
+    Return (route_path, route_distance, journey) for a pair of station ids, from the route cache if possible.
+    """
+    key = (start_id, end_id, mode, model.parameters_version)
+    result = route_cache.get(key)
+    if result is None:
+        route_path, route_distance = find_route(start_id, end_id, mode)
+        result = (route_path, route_distance, journey_summary(route_path))
+        route_cache.put(key, result)
+    return result
+
+def get_alternatives(start_id, end_id, k, mode='time'):
+    """
+    Up to k distinct routes between two stations, shortest first, as [(route_path, route_distance), ...].
+    """
+    if closed_station(start_id, end_id) is not None:
+        return []
+    return k_shortest_routes(get_compiled_graph(mode), start_id, end_id, k)
+
+def get_route_options(start_id, end_id, max_transfers=None):
+    """
+    The (time, transfers) trade-off between two stations from one search: [(route_path, seconds, transfers), ...],
+    fastest first, each one with fewer transfers than the one before.
+    """
+    if closed_station(start_id, end_id) is not None:
+        return []
+    return pareto_routes(get_compiled_graph('time'), start_id, end_id, max_transfers)
+
+# Route + map renders run here rather than in the request thread: identical requests in flight share one render,
+# and a burst beyond MAX_PENDING_RENDERS is turned away with a 503 instead of queueing without limit.
+# The pool starts its threads on first use, so it's safe to create before gunicorn forks the workers
+MAX_PENDING_RENDERS = 16
+render_pool = ComputePool(max_workers=4, max_pending=MAX_PENDING_RENDERS)
+
+def render_route(start_id, end_id):
+    """
+    Find the route and a couple of alternatives and draw them over the static base map.
+    Returns (route_path, route_distance, journey, fewer_transfers, map_html), where fewer_transfers summarises the
+    slower options with fewer transfers and map_html is None if there is no route.
+    """
+    with stage('route'):
+        route_path, route_distance, journey = get_route_result(start_id, end_id)
+    if not route_path:
+        return route_path, route_distance, journey, [], None
+    with stage('transfer options'):
+        fewer_transfers = options_summary(get_route_options(start_id, end_id)[1:])
+    # the shortest route may tie with the main one, so ask for one more and drop whichever rides the same legs
+    with stage('alternatives'):
+        legs = route_legs(route_path)
+        alternatives = [(path, total) for path, total in get_alternatives(start_id, end_id, MAP_ALTERNATIVES + 1)
+                        if route_legs(path) != legs][:MAP_ALTERNATIVES]
+    with stage('map build'):
+        m = create_route_map(
+            graph,
+            vertex_data,
+            line_colours,
+            route_path,
+            route_distance,
+            center_coords=(51.5074, -0.1278),
+            network=network_layers,
+            base_layer_files=base_layer_files,
+            alternatives=alternatives
+        )
+    with stage('map html'):
+        map_html = m._repr_html_()
+    return route_path, route_distance, journey, fewer_transfers, map_html
+
+def render_isochrone(start_id, minutes):
+    """
+    The isochrone map page for one station as HTML.
+    """
+    m = create_isochrone_map(
+        graph,
+        vertex_data,
+        line_colours,
+        start_id,
+        get_travel_times(start_id),
+        minutes,
+        network=network_layers,
+        base_layer_files=base_layer_files
+    )
+    return m.get_root().render()
+
+def run_render(key, function, *args):
+    """
+    Run a render on the render pool, or right here if this request is being profiled (a profiler only sees its own thread).
+    """
+    if g.get("profiler") is not None:
+        return function(*args)
+    return render_pool.run(key, function, *args)
+
+# Normalised, prefix and trigram indexes over the station names, for lookups and typeahead
+station_index = StationIndex(vertex_data)
 
 def lookup_station_id(name):
     """
-    Given a station name (case-insensitive match), return the corresponding station id.
-    Uses the vertex_ID dictionary, if available, or searches vertex_data.
+    Given a station name as typed by a person, return the corresponding station id (or None).
+    Case, punctuation, apostrophes and '&' vs 'and' don't matter, and small typos are forgiven if only one station is close.
+    """
+    return station_index.lookup(name)
+
+def suggestion_text(name):
     """
-    # First try the vertex_ID mapping if your key exactly matches
-    if name in vertex_ID:
-        return vertex_ID[name]
-    # Otherwise try a case-insensitive search in vertex_data
-    for vid, (sname, _, _) in vertex_data.items():
-        if sname.lower() == name.lower():
-            return vid
+    "Did you mean ...?" for a name that didn't resolve, or "" if nothing is close.
+    """
+    suggestions = [vertex_data[station][0] for station in station_index.suggest(name, 3)]
+    if not suggestions:
+        return ""
+    if len(suggestions) > 1:
+        return f" Did you mean {', '.join(suggestions[:-1])} or {suggestions[-1]}?"
+    return f" Did you mean {suggestions[0]}?"
+
+def get_travel_times(start_id, mode='time'):
+    """
+    Return {station id: total} from one station to every reachable station, from a single search.
+    Closed stations are left out.
+    """
+    if disruptions.is_closed(start_id):
+        return {}
+    if mode == 'time':
+        travel_times = journey_table.travel_times(start_id)
+    else:
+        INF = float('inf')
+        travel_times = {station: total for station, total in enumerate(get_compiled_graph(mode).travel_times(start_id)) if total < INF}
+    return {station: total for station, total in travel_times.items() if not disruptions.is_closed(station)}
+
+def resolve_station(value):
+    """
+    Accept either a station id (an int, or a string of digits) or a station name, and return the station id.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value if value in vertex_data else None
+    if isinstance(value, str):
+        value = value.strip()
+        if value.isdigit():
+            return resolve_station(int(value))
+        return lookup_station_id(value)
     return None
 
+def json_seconds(seconds):
+    """
+    JSON has no infinity, unreachable journeys are reported as null.
+    """
+    return None if seconds == float('inf') else seconds
+
+def total_key(mode):
+    """
+    Only the time mode minimises seconds, the others report their own weight (stops, transfers, ...).
+    """
+    return "total_seconds" if mode == 'time' else "total_weight"
+
+def api_error(message, status=400):
+    return jsonify({"error": message}), status
+
+def closed_error(start_id, end_id):
+    """
+    A 404 naming the closed station if either one is closed, otherwise None.
+    """
+    station = closed_station(start_id, end_id)
+    return None if station is None else api_error(f"{vertex_data[station][0]} is closed.", 404)
+
+@app.route("/api/route", methods=["GET", "POST"])
+def api_route():
+    """
+    Route between two stations as JSON, without building a map.
+    Takes start, end (names or ids) and optionally mode, from the query string, a form or a JSON body.
+    With depart=HH:MM (time mode only) the route is the earliest arrival leaving then, with waits that depend on
+    how often the lines run at that time of day, and the result also has departure and arrival times.
+    """
+    params = request.get_json(silent=True) or request.values
+    if not isinstance(params, dict):
+        return api_error('Expected a JSON object like {"start": ..., "end": ...}.')
+    mode = params.get("mode", "time")
+    if mode not in ROUTE_MODES:
+        return api_error(f"Unknown mode {mode!r}, expected one of {', '.join(ROUTE_MODES)}")
+    start_id = resolve_station(params.get("start"))
+    end_id = resolve_station(params.get("end"))
+    if start_id is None or end_id is None:
+        return api_error("One or both stations were not found.", 404)
+    if closed_station(start_id, end_id) is not None:
+        return closed_error(start_id, end_id)
+
+    depart = params.get("depart")
+    if depart is not None:
+        if mode != 'time':
+            return api_error("depart only works with mode=time.")
+        from timetable import parse_clock, format_clock
+        try:
+            departure = parse_clock(str(depart))
+        except ValueError as e:
+            return api_error(str(e))
+        route_path, arrival = get_timetable_router().earliest_arrival(start_id, end_id, departure)
+        if not route_path:
+            return api_error("No route could be found between the selected stations.", 404)
+        result = route_to_dict(route_path, arrival - departure)
+        result.update({"mode": mode, "departure": format_clock(departure), "arrival": format_clock(arrival)})
+        return jsonify(result)
+
+    route_path, route_distance, _ = get_route_result(start_id, end_id, mode)
+    if not route_path:
+        return api_error("No route could be found between the selected stations.", 404)
+    result = route_to_dict(route_path, json_seconds(route_distance), total_key(mode))
+    result["mode"] = mode
+    return jsonify(result)
+
+@app.route("/api/alternatives")
+def api_alternatives():
+    """
+    Up to k distinct routes between two stations, shortest first, e.g. /api/alternatives?start=Morden&end=Paddington&k=3
+    Each route has the same fields as /api/route. Routes never visit a station twice.
+    """
+    mode = request.args.get("mode", "time")
+    if mode not in ROUTE_MODES:
+        return api_error(f"Unknown mode {mode!r}, expected one of {', '.join(ROUTE_MODES)}")
+    start_id = resolve_station(request.args.get("start"))
+    end_id = resolve_station(request.args.get("end"))
+    if start_id is None or end_id is None:
+        return api_error("One or both stations were not found.", 404)
+    try:
+        k = int(request.args.get("k", 3))
+    except ValueError:
+        return api_error("k must be an integer.")
+    if not 1 <= k <= MAX_ALTERNATIVES:
+        return api_error(f"k must be between 1 and {MAX_ALTERNATIVES}.")
+    if closed_station(start_id, end_id) is not None:
+        return closed_error(start_id, end_id)
+
+    routes = get_alternatives(start_id, end_id, k, mode)
+    if not routes or not routes[0][0]:
+        return api_error("No route could be found between the selected stations.", 404)
+    return jsonify({
+        "mode": mode,
+        "routes": [route_to_dict(route_path, json_seconds(route_distance), total_key(mode)) for route_path, route_distance in routes],
+    })
+
+@app.route("/api/pareto")
+def api_pareto():
+    """
+    Every route that is either faster or has fewer transfers than all the others, e.g. /api/pareto?start=Morden&end=Paddington
+    Routes come fastest first, in the same form as /api/route. max_transfers leaves out options with more transfers.
+    """
+    start_id = resolve_station(request.args.get("start"))
+    end_id = resolve_station(request.args.get("end"))
+    if start_id is None or end_id is None:
+        return api_error("One or both stations were not found.", 404)
+    max_transfers = request.args.get("max_transfers")
+    if max_transfers is not None:
+        try:
+            max_transfers = int(max_transfers)
+        except ValueError:
+            return api_error("max_transfers must be an integer.")
+        if max_transfers < 0:
+            return api_error("max_transfers can't be negative.")
+    if closed_station(start_id, end_id) is not None:
+        return closed_error(start_id, end_id)
+
+    options = get_route_options(start_id, end_id, max_transfers)
+    if not options:
+        return api_error("No route could be found between the selected stations.", 404)
+    return jsonify({
+        "routes": [route_to_dict(route_path, seconds) for route_path, seconds, _ in options],
+        "summaries": options_summary(options),
+    })
+
+@app.route("/api/stations")
+def api_stations():
+    """
+    Typeahead suggestions, e.g. /api/stations?q=kings&limit=10: names starting with q first, then the closest by spelling.
+    """
+    query = request.args.get("q", "")
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        return api_error("limit must be an integer.")
+    if not 1 <= limit <= MAX_SUGGESTIONS:
+        return api_error(f"limit must be between 1 and {MAX_SUGGESTIONS}.")
+    return jsonify({
+        "query": query,
+        "stations": [{"id": station, "name": vertex_data[station][0]} for station in station_index.suggest(query, limit)],
+    })
+
+@app.route("/api/routes/batch", methods=["POST"])
+def api_routes_batch():
+    """
+    Answer many origin/destination pairs in one request.
+    Expects a JSON body {"pairs": [[start, end], ...], "mode": "time", "detail": false}; stations are names or ids.
+    Pairs are grouped by origin so each origin needs at most one search. Results come back in the same order;
+    with detail the full route (path, legs, ...) is included, otherwise just the total and number of transfers.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("pairs"), list):
+        return api_error('Expected a JSON body like {"pairs": [[start, end], ...]}.')
+    pairs = body["pairs"]
+    if len(pairs) > MAX_BATCH_PAIRS:
+        return api_error(f"At most {MAX_BATCH_PAIRS} pairs per request.", 413)
+    mode = body.get("mode", "time")
+    if mode not in ROUTE_MODES:
+        return api_error(f"Unknown mode {mode!r}, expected one of {', '.join(ROUTE_MODES)}")
+    detail = bool(body.get("detail", False))
+
+    resolved = []
+    for pair in pairs:
+        if isinstance(pair, (list, tuple)) and len(pair) == 2:
+            resolved.append((resolve_station(pair[0]), resolve_station(pair[1])))
+        else:
+            resolved.append((None, None))
+    valid_pairs = [pair for pair in resolved if None not in pair]
+    if mode == 'time':
+        # the journey table already holds one search per origin, so these are lookups
+        answers = [journey_table.get_route(start_id, end_id) for start_id, end_id in valid_pairs]
+    else:
+        answers = get_compiled_graph(mode).batch_routes(valid_pairs)
+
+    results = []
+    answer_iter = iter(answers)
+    for start_id, end_id in resolved:
+        if start_id is None or end_id is None:
+            results.append({"error": "Station not found."})
+            continue
+        route_path, route_distance = next(answer_iter)
+        if closed_station(start_id, end_id) is not None:
+            results.append({"start": start_id, "end": end_id, "error": "Station closed."})
+        elif not route_path:
+            results.append({"start": start_id, "end": end_id, "error": "No route found."})
+        elif detail:
+            results.append(route_to_dict(route_path, json_seconds(route_distance), total_key(mode)))
+        else:
+            results.append({
+                "start": start_id,
+                "end": end_id,
+                total_key(mode): json_seconds(route_distance),
+                "transfers": max(0, len(route_legs(route_path)) - 1),
+            })
+    return jsonify({"mode": mode, "results": results})
+
+line_names = set(line for station in graph for _, line, _ in graph[station])
+
+def parse_closures(closures):
+    """
+    Check the closures in a disruptions request, {"stations": [...], "segments": [[a, b] or [a, b, line], ...],
+    "lines": [...]} with stations as names or ids. Returns (stations, segments, lines), raises ValueError if any
+    of it doesn't exist.
+    """
+    if not isinstance(closures, dict):
+        raise ValueError('Expected {"stations": [...], "segments": [...], "lines": [...]}.')
+    stations = []
+    for value in closures.get("stations", []):
+        station = resolve_station(value)
+        if station is None:
+            raise ValueError(f"Station {value!r} was not found.")
+        stations.append(station)
+    segments = []
+    for segment in closures.get("segments", []):
+        if not isinstance(segment, (list, tuple)) or len(segment) not in (2, 3):
+            raise ValueError(f"Segment {segment!r} should be [from, to] or [from, to, line].")
+        a, b = resolve_station(segment[0]), resolve_station(segment[1])
+        line = segment[2] if len(segment) == 3 else None
+        if a is None or b is None or not any(dest == b and line in (None, edge_line) for dest, edge_line, _ in graph.get(a, [])):
+            raise ValueError(f"Segment {segment!r} is not between two adjacent stations" + (f" on the {line} line." if line else "."))
+        segments.append((a, b, line))
+    lines = []
+    for line in closures.get("lines", []):
+        if line not in line_names:
+            raise ValueError(f"Unknown line {line!r}.")
+        lines.append(line)
+    return stations, segments, lines
+
+def disruptions_allowed():
+    """
+    Changing closures needs the DISRUPTIONS_TOKEN from the environment in an X-Disruptions-Token header,
+    and is turned off when it isn't set.
+    """
+    token = os.environ.get("DISRUPTIONS_TOKEN")
+    return bool(token) and hmac.compare_digest(request.headers.get("X-Disruptions-Token", ""), token)
+
+@app.route("/api/disruptions", methods=["GET", "POST", "DELETE"])
+def api_disruptions():
+    """
+    GET lists the closed stations, segments and lines. POST changes them with a body like
+    {"close": {"stations": ["Bank"], "segments": [["Oval", "Stockwell", "Northern"]], "lines": ["Waterloo & City"]},
+     "reopen": {...}}, and DELETE reopens everything. Routes change straight away, without rebuilding anything.
+    Closed stations can't be started or ended at or changed at, but trains still run through them.
+    """
+    if request.method != "GET":
+        if not disruptions_allowed():
+            return api_error("Changing disruptions needs a valid X-Disruptions-Token.", 403)
+        if request.method == "DELETE":
+            summary = change_disruptions(Disruptions.clear)
+        else:
+            body = request.get_json(silent=True)
+            if not isinstance(body, dict):
+                return api_error('Expected a JSON body like {"close": {...}, "reopen": {...}}.')
+            try:
+                close = parse_closures(body.get("close", {}))
+                reopen = parse_closures(body.get("reopen", {}))
+            except ValueError as e:
+                return api_error(str(e))
+
+            def change(closures):
+                stations, segments, lines = reopen
+                for station in stations:
+                    closures.reopen_station(station)
+                for segment in segments:
+                    closures.reopen_segment(*segment)
+                for line in lines:
+                    closures.reopen_line(line)
+                stations, segments, lines = close
+                for station in stations:
+                    closures.close_station(station)
+                for segment in segments:
+                    closures.close_segment(*segment)
+                for line in lines:
+                    closures.close_line(line)
+            summary = change_disruptions(change)
+        result = disruptions.to_dict()
+        result["update"] = summary
+        return jsonify(result)
+    return jsonify(disruptions.to_dict())
+
+def parse_isochrone_request():
+    """
+    Shared argument handling for the isochrone endpoints: returns (start_id, minutes, error response or None).
+    """
+    start_id = resolve_station(request.args.get("start"))
+    if start_id is None:
+        return None, None, api_error("Station not found.", 404)
+    try:
+        minutes = float(request.args.get("minutes", 30))
+    except ValueError:
+        return None, None, api_error("minutes must be a number.")
+    if not 0 <= minutes <= MAX_ISOCHRONE_MINUTES:
+        return None, None, api_error(f"minutes must be between 0 and {MAX_ISOCHRONE_MINUTES}.")
+    return start_id, minutes, None
+
+@app.route("/api/travel_times")
+def api_travel_times():
+    """
+    Modelled total from one station to every station, e.g. /api/travel_times?start=Bank&mode=time
+    """
+    mode = request.args.get("mode", "time")
+    if mode not in ROUTE_MODES:
+        return api_error(f"Unknown mode {mode!r}, expected one of {', '.join(ROUTE_MODES)}")
+    start_id = resolve_station(request.args.get("start"))
+    if start_id is None:
+        return api_error("Station not found.", 404)
+    travel_times = get_travel_times(start_id, mode)
+    return jsonify({
+        "start": {"id": start_id, "name": vertex_data[start_id][0]},
+        "mode": mode,
+        "stations": [{"id": station, "name": vertex_data[station][0], total_key(mode): total}
+                     for station, total in sorted(travel_times.items(), key=lambda item: item[1])],
+    })
+
+@app.route("/api/isochrone")
+def api_isochrone():
+    """
+    Every station reachable within N minutes, e.g. /api/isochrone?start=Bank&minutes=20
+    """
+    start_id, minutes, error = parse_isochrone_request()
+    if error:
+        return error
+    reachable = stations_within(get_travel_times(start_id), minutes * 60)
+    return jsonify({
+        "start": {"id": start_id, "name": vertex_data[start_id][0]},
+        "minutes": minutes,
+        "stations": [{"id": station, "name": vertex_data[station][0], "total_seconds": seconds}
+                     for station, seconds in sorted(reachable.items(), key=lambda item: item[1])],
+    })
+
+@app.route("/isochrone")
+def isochrone_map():
+    """
+    The same isochrone drawn on a map, coloured by journey time.
+    """
+    start_id, minutes, error = parse_isochrone_request()
+    if error:
+        return error
+    try:
+        return run_render(("isochrone_map", start_id, minutes, model.parameters_version), render_isochrone, start_id, minutes)
+    except PoolSaturated:
+        response, status = api_error("The server is busy right now, please try again in a moment.", 503)
+        return response, status, {"Retry-After": "1"}
+
 @app.route("/", methods=["GET", "POST"])
 def index():
     map_html = None
     journey = ""
     total_time = ""
+    fewer_transfers = []
     selected_start = ""
     selected_end = ""
 
@@ -43,26 +762,39 @@ def index():
         selected_end = request.form.get("end_station", "").strip()
 
         # look up the station id's
-        start_id = lookup_station_id(selected_start)
-        end_id = lookup_station_id(selected_end)
+        with stage('station lookup'):
+            start_id = lookup_station_id(selected_start)
+            end_id = lookup_station_id(selected_end)
 
-        if not start_id or not end_id:
-            flash("One or both station names were not found. Please check your spelling.")
+        if start_id is None or end_id is None:
+            missing = [name for name, station in ((selected_start, start_id), (selected_end, end_id)) if station is None]
+            flash("One or both station names were not found. Please check your spelling."
+                  + "".join(suggestion_text(name) for name in missing))
+            return redirect(url_for("index"))
+        if closed_station(start_id, end_id) is not None:
+            flash(f"{vertex_data[closed_station(start_id, end_id)][0]} is closed at the moment.")
             return redirect(url_for("index"))
 
-        # Get the shortest route - here we assume get_shortest_route returns (route_path, total_weight)
-        route_path, route_distance = get_shortest_route(
-            graph, start_id, end_id,
-            time_function=time_DC,
-            transfer_time=model_transfer_time
-        )
+        # Look up the shortest route and its summary (e.g. a brief text description), and draw it, on the render pool
+        try:
+            with stage('render'):  # the stages of render_route, plus any wait for the pool
+                route_path, route_distance, journey, fewer_transfers, map_html = run_render(
+                    ("route_map", start_id, end_id, model.parameters_version), render_route, start_id, end_id
+                )
+        except PoolSaturated:
+            flash("The server is busy right now, please try again in a moment.")
+            return render_template("index.html",
+                                   map_html=None,
+                                   journey="",
+                                   total_time="",
+                                   fewer_transfers=[],
+                                   selected_start=selected_start,
+                                   selected_end=selected_end), 503, {"Retry-After": "1"}
 
         if not route_path:
             flash("No route could be found between the selected stations.")
             return redirect(url_for("index"))
 
-        # Get a route summary (e.g. a brief text description)
-        journey = journey_summary(route_path)
         total_time_seconds = int(route_distance)
 
         hours = total_time_seconds // 3600
@@ -80,25 +812,70 @@ def index():
         total_time = ', '.join(time_parts)
         print(total_time)  # Output: '1 hour, 1 minute, 7 seconds'
 
-        # Create the Folium map.
-        # You can set a center coordinate (e.g. central London) or compute a bounding box.
-        m = create_route_map(
-            graph,
-            vertex_data,
-            line_colours,
-            route_path,
-            route_distance,
-            center_coords=(51.5074, -0.1278)
-        )
-        map_html = m._repr_html_()
+    with stage('template'):
+        return render_template("index.html",
+                               map_html=map_html,
+                               journey=journey,
+                               total_time=total_time,
+                               fewer_transfers=fewer_transfers,
+                               selected_start=selected_start,
+                               selected_end=selected_end)
+
+# Instrumentation (see instrumentation.py) is off unless TUBE_METRICS=1, and then these hooks aren't even registered
+if instrumentation.ENABLED:
+    instrumentation.metrics.add_collector(instrumentation.cache_info_collector({
+        'get_top_speed': model.get_top_speed,
+        'get_adjacent_time': model.get_adjacent_time,
+        'calculate_route_time': model.calculate_route_time,
+    }))
+    instrumentation.metrics.add_collector(instrumentation.stats_collector(
+        'tube_route_cache', route_cache.stats, ('hits', 'misses', 'evictions', 'expirations'), 'Route cache'))
+    instrumentation.metrics.add_collector(instrumentation.stats_collector(
+        'tube_render_pool', render_pool.stats, ('submitted', 'coalesced', 'rejected', 'completed'), 'Render pool'))
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_time(response):
+        if "request_start" in g:
+            instrumentation.metrics.observe("tube_request_seconds", time.perf_counter() - g.request_start,
+                                            "Time to answer a request", endpoint=request.endpoint or "", method=request.method,
+                                            status=str(response.status_code))
+        return response
+
+@app.route("/metrics")
+def metrics():
+    """
+    Everything instrumentation.py records, in the Prometheus text format. 404 unless TUBE_METRICS=1.
+    """
+    if not instrumentation.ENABLED:
+        return api_error("Metrics are off, set TUBE_METRICS=1 to turn them on.", 404)
+    return instrumentation.metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def profiling_allowed():
+    """
+    Profiling a request needs the TUBE_PROFILE_TOKEN from the environment as its X-Profile header,
+    and is turned off when it isn't set.
+    """
+    token = os.environ.get("TUBE_PROFILE_TOKEN")
+    return bool(token) and hmac.compare_digest(request.headers.get("X-Profile", ""), token)
+
+# With TUBE_PROFILE_DIR set, a request with the profiling token in an X-Profile header is run under cProfile and the
+# dump's file name (in that folder) comes back in an X-Profile-File header
+if instrumentation.PROFILE_DIR:
+    @app.before_request
+    def start_profile():
+        if "X-Profile" in request.headers and profiling_allowed():
+            g.profiler = instrumentation.start_profile()
 
-    return render_template("index.html",
-                           station_names=station_names,
-                           map_html=map_html,
-                           journey=journey,
-                           total_time=total_time,
-                           selected_start=selected_start,
-                           selected_end=selected_end)
+    @app.after_request
+    def finish_profile(response):
+        if g.get("profiler") is not None:
+            file_path = instrumentation.finish_profile(g.pop("profiler"), request.endpoint or "request")
+            response.headers["X-Profile-File"] = os.path.basename(file_path)
+        return response
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,779 @@
+#benchmarks for the routing backend, run from this folder:
+#   python benchmarks.py                 (runs everything)
+#   python benchmarks.py journey_table   (runs just the named benchmarks)
+#   python benchmarks.py stages --json run.json --baseline baseline.json
+#every row printed is also recorded, --json saves them and --baseline compares the p50s against an earlier run.
+#exits with status 1 if any cross-check failed (a row with a nonzero CHECKS count), if any row got slower than
+#--tolerance times its baseline or if no row is in both runs
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+DEFAULT_TOLERANCE = 1.5     #a row regresses when its p50 is this many times the baseline's...
+MIN_REGRESSION_US = 50      #...and at least this much slower, so timer noise on very quick rows doesn't count
+
+results = {}                #{benchmark: {row: summary}} of everything print_summary printed in this run
+CHECKS = ('mismatches', 'impossible', 'dominated', 'beaten', 'not_shortest')   #summary counts that have to be 0
+current_benchmark = None
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def latency_summary(samples):
+    #samples are in seconds, the summary is in microseconds
+    return {
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p99_us': percentile(samples, 99) * 1e6,
+        'mean_us': sum(samples) / len(samples) * 1e6,
+    }
+
+def time_calls(function, arguments):
+    samples = []
+    results = []
+    for args in arguments:
+        start = time.perf_counter()
+        results.append(function(*args))
+        samples.append(time.perf_counter() - start)
+    return samples, results
+
+def sample_od_pairs(graph, n_pairs, seed=0):
+    rng = random.Random(seed)
+    stations = sorted(graph)
+    return [(rng.choice(stations), rng.choice(stations)) for _ in range(n_pairs)]
+
+def print_summary(name, summary):
+    results.setdefault(current_benchmark, {})[name] = summary
+    print(f"{name:<28}" + "  ".join(f"{k}={v:10.1f}" for k, v in summary.items()))
+
+def run_metadata():
+    #what the numbers were measured on, saved alongside them
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def find_regressions(baseline, current, tolerance=DEFAULT_TOLERANCE):
+    #[(benchmark, row, baseline p50, current p50), ...] for the rows in both runs whose p50 got slower than
+    #tolerance times the baseline's (and by more than MIN_REGRESSION_US)
+    regressions = []
+    for benchmark, rows in current.items():
+        for row, summary in rows.items():
+            before = baseline.get(benchmark, {}).get(row, {}).get('p50_us')
+            after = summary.get('p50_us')
+            if before is not None and after is not None and after > before * tolerance and after - before > MIN_REGRESSION_US:
+                regressions.append((benchmark, row, before, after))
+    return regressions
+
+def failed_checks(current):
+    #[(benchmark, row, check, count), ...] for the CHECKS counts in the run that aren't 0
+    return [(benchmark, row, check, summary[check]) for benchmark, rows in current.items() for row, summary in rows.items()
+            for check in CHECKS if summary.get(check)]
+
+def compare_rows(baseline, current):
+    #which rows the two runs have p50s for, as lists of (benchmark, row): (in both, only in the baseline, only in
+    #the current run). benchmarks in the baseline that weren't run this time don't count as missing
+    def timed_rows(run, benchmarks):
+        return {(benchmark, row) for benchmark in benchmarks for row, summary in run.get(benchmark, {}).items() if summary.get('p50_us') is not None}
+    before, after = timed_rows(baseline, current), timed_rows(current, current)
+    return sorted(before & after), sorted(before - after), sorted(after - before)
+
+def bench_journey_table(n_pairs=2000):
+    #on the fly dijkstra vs the precomputed all-pairs table
+    from setup import graph
+    from routes import get_shortest_route
+    from model import time_DC, model_transfer_time, model_fingerprint
+    from journey_table import JourneyTable
+
+    od_pairs = sample_od_pairs(graph, n_pairs)
+    start = time.perf_counter()
+    table = JourneyTable.build(graph, time_function=time_DC, transfer_time=model_transfer_time, fingerprint=model_fingerprint())
+    build_time = time.perf_counter() - start
+
+    dijkstra_samples, dijkstra_results = time_calls(
+        lambda s, e: get_shortest_route(graph, s, e, time_function=time_DC, transfer_time=model_transfer_time), od_pairs)
+    table_samples, table_results = time_calls(table.get_route, od_pairs)
+    mismatches = sum(1 for a, b in zip(dijkstra_results, table_results) if a != b)
+
+    print(f"journey table built in {build_time:.2f}s, {n_pairs} queries")
+    print_summary('dijkstra', latency_summary(dijkstra_samples))
+    summary = latency_summary(table_samples)
+    summary['mismatches'] = mismatches
+    print_summary('journey table', summary)
+
+def bench_compiled_graph(n_pairs=2000):
+    #dict/tuple dijkstra with model callbacks vs the array-backed graph with baked weights
+    from setup import graph
+    from routes import get_shortest_route
+    from model import time_DC, model_transfer_time
+    from compiled_graph import CompiledGraph
+
+    od_pairs = sample_od_pairs(graph, n_pairs)
+    start = time.perf_counter()
+    compiled = CompiledGraph.build(graph, time_function=time_DC, transfer_time=model_transfer_time)
+    build_time = time.perf_counter() - start
+
+    dijkstra_samples, dijkstra_results = time_calls(
+        lambda s, e: get_shortest_route(graph, s, e, time_function=time_DC, transfer_time=model_transfer_time), od_pairs)
+    compiled_samples, compiled_results = time_calls(compiled.shortest_route, od_pairs)
+    mismatches = sum(1 for a, b in zip(dijkstra_results, compiled_results) if a != b)
+
+    print(f"compiled graph built in {build_time * 1000:.1f}ms ({len(compiled.state_station)} states, {len(compiled.state_targets)} edges), {n_pairs} queries")
+    print_summary('dijkstra', latency_summary(dijkstra_samples))
+    summary = latency_summary(compiled_samples)
+    summary['mismatches'] = mismatches
+    print_summary('compiled dijkstra', summary)
+
+def bench_vectorised_model(n_candidates=1000):
+    #per edge time_DC calls (cold caches) vs one batched numpy pass, and a batch of parameter sets for fitting
+    import numpy as np
+    from setup import graph
+    import model
+    from vectorised_model import EdgeArrays, get_edge_times
+
+    edges = [(s, d, line) for s in graph for d, line, _ in graph[s]]
+    model.set_parameters(model.get_parameters())    #clears the model caches
+    start = time.perf_counter()
+    scalar_times = np.array([model.time_DC(s, d, line) for s, d, line in edges])
+    scalar_time = time.perf_counter() - start
+
+    parameters = model.get_parameters()
+    start = time.perf_counter()
+    edge_arrays = EdgeArrays(graph)
+    setup_time = time.perf_counter() - start
+    start = time.perf_counter()
+    vector_times = get_edge_times(edge_arrays, parameters)
+    vector_time = time.perf_counter() - start
+
+    batch = {
+        'relative_speeds': np.tile(edge_arrays.line_table(parameters['relative_speeds']), (n_candidates, 1)),
+        'distance_base_coefficient': np.full(n_candidates, parameters['distance_base_coefficient']),
+        'distance_relevance_coefficient': np.full(n_candidates, parameters['distance_relevance_coefficient']),
+    }
+    start = time.perf_counter()
+    get_edge_times(edge_arrays, batch)
+    batch_time = time.perf_counter() - start
+
+    print(f"{len(edges)} edges, max difference from time_DC {np.abs(scalar_times - vector_times).max():.2e}s")
+    print(f"scalar time_DC           {scalar_time * 1000:8.2f}ms")
+    print(f"vectorised (arrays)      {setup_time * 1000:8.2f}ms once")
+    print(f"vectorised (kernel)      {vector_time * 1000:8.2f}ms")
+    print(f"vectorised x{n_candidates} params {batch_time * 1000:8.2f}ms")
+
+def bench_fitting():
+    #the original ternary search vs the batched engine, sequential (same search space) and joint
+    #final errors are all from model.get_loss so they're directly comparable
+    import model
+    from fitting import FittingProblem
+
+    saved = model.get_parameters()
+    rows = []
+    start = time.perf_counter()
+    model.fine_tune()
+    rows.append(('ternary (fine_tune)', time.perf_counter() - start, model.get_loss()))
+
+    for name, joint in (('batched sequential', False), ('batched joint', True)):
+        start = time.perf_counter()
+        problem = FittingProblem(model.graph, model.formatted_data)
+        model.set_parameters(problem.fit(model.INITIAL_PARAMETERS, joint=joint))
+        rows.append((name, time.perf_counter() - start, model.get_loss()))
+    model.set_parameters(saved)
+
+    for name, seconds, loss in rows:
+        print(f"{name:<28}{seconds:8.2f}s   squared error {loss:12.1f}")
+
+def bench_map_render(n_routes=20):
+    #full folium map per request vs static base layers + route overlay, both serialised like app.index does
+    import tempfile
+    import warnings
+    from setup import graph, vertex_data, line_colours
+    from model import model_transfer_time
+    from compiled_graph import CompiledGraph
+    from visualisation import create_route_map, NetworkLayers
+
+    warnings.filterwarnings('ignore', module='folium')
+    compiled = CompiledGraph.build(graph, transfer_time=model_transfer_time)
+    routes = [compiled.shortest_route(s, e) for s, e in sample_od_pairs(graph, n_routes)]
+    network = NetworkLayers(graph, vertex_data, line_colours)
+    with tempfile.TemporaryDirectory() as directory:
+        base_layer_files = network.write_geojson(directory)
+        for name, kwargs in (('full map', {}), ('route overlay', {'network': network, 'base_layer_files': base_layer_files})):
+            sizes = []
+            render = lambda path, distance: sizes.append(len(create_route_map(graph, vertex_data, line_colours, path, distance, **kwargs)._repr_html_()))
+            samples, _ = time_calls(render, routes)
+            summary = latency_summary(samples)
+            summary['kib'] = sum(sizes) / len(sizes) / 1024
+            print_summary(name, summary)
+
+def peak_allocations(function, arguments, before_each=None):
+    #peak traced allocation of each call, tracing is only on while the call runs
+    peaks = []
+    for args in arguments:
+        if before_each is not None:
+            before_each()
+        tracemalloc.start()
+        function(*args)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return peaks
+
+def bench_extended_graph(n_pairs=300):
+    #get_shortest_route rebuilding the extended graph every query (as it used to) vs reusing the cached one
+    from setup import graph
+    from routes import get_shortest_route, clear_extended_graph_cache
+    from model import time_DC, model_transfer_time
+
+    od_pairs = sample_od_pairs(graph, n_pairs)
+    query = lambda s, e: get_shortest_route(graph, s, e, time_function=time_DC, transfer_time=model_transfer_time)
+    query(*od_pairs[0])    #warm the model caches so both runs see the same time_DC cost
+    rebuild = lambda s, e: (clear_extended_graph_cache(), query(s, e))
+    for name, function, before_each in (('rebuilt per query', rebuild, clear_extended_graph_cache), ('cached', query, None)):
+        samples, _ = time_calls(function, od_pairs)
+        peaks = peak_allocations(query, od_pairs, before_each)
+        summary = latency_summary(samples)
+        summary['peak_kib'] = percentile(peaks, 50) / 1024
+        print_summary(name, summary)
+
+def bench_search_algorithms(n_pairs=None):
+    #dijkstra vs A* vs bidirectional on the compiled graph, over every OD pair by default
+    from setup import graph
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph, SEARCH_ALGORITHMS
+
+    compiled = CompiledGraph.build(graph, time_function=make_time_function(graph, get_parameters()), transfer_time=model_transfer_time)
+    od_pairs = [(s, e) for s in sorted(graph) for e in sorted(graph)] if n_pairs is None else sample_od_pairs(graph, n_pairs)
+    compiled.prepare()    #one-off preprocessing, not part of the query
+    baseline = None
+    for algorithm in SEARCH_ALGORITHMS:
+        settled = []
+        def query(s, e):
+            stats = {}
+            result = compiled.shortest_route(s, e, algorithm, stats)
+            settled.append(stats['settled'])
+            return result
+        samples, results = time_calls(query, od_pairs)
+        if baseline is None:
+            baseline = results
+        summary = latency_summary(samples)
+        summary['settled'] = sum(settled) / len(settled)
+        summary['mismatches'] = sum(1 for a, b in zip(baseline, results) if a != b)
+        print_summary(algorithm, summary)
+
+def count_beaten_transfer_routes(graph, compiled, time_function, od_pairs):
+    #transfers mode has to give the quickest of the routes with the fewest transfers, so the stops and time mode
+    #routes for the same pair can't need fewer transfers, or as many and be quicker. counts the pairs where one does,
+    #with every route timed on the same time CompiledGraph
+    from model import model_transfer_time
+    from routes import route_legs
+    from compiled_graph import CompiledGraph
+
+    by_time = CompiledGraph.build(graph, time_function=time_function, transfer_time=model_transfer_time)
+    by_stops = CompiledGraph.build(graph, 'stops', time_function=time_function, transfer_time=model_transfer_time)
+    def time_and_transfers(path):
+        #the search can start on any line at the start station, so a change there is free
+        while len(path) > 1 and path[1][0] == path[0][0]:
+            path = path[1:]
+        states = [by_time.state_index[state] for state in path]
+        return sum(by_time._edge_weight(a, b) for a, b in zip(states, states[1:])), max(0, len(route_legs(path)) - 1)
+    beaten = 0
+    for s, e in od_pairs:
+        time, transfers = time_and_transfers(compiled.shortest_route(s, e, 'lexicographic')[0])
+        for other in (by_time, by_stops):
+            other_time, other_transfers = time_and_transfers(other.shortest_route(s, e)[0])
+            if other_transfers < transfers or (other_transfers == transfers and other_time < time - 1e-6):
+                beaten += 1
+                break
+    return beaten
+
+def bench_mode_searches(n_pairs=2000):
+    #the searches for the stops and transfers modes (BFS, 0-1 BFS and the fewest transfers then quickest search that
+    #transfers mode uses) vs dijkstra on the same states, on the dict graph (routes.py) and the compiled one, and
+    #the fewest transfers then quickest search vs dijkstra on a combined weight where any transfer costs more than
+    #any journey's time
+    from setup import graph
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from routes import get_extended_graph, make_weight_function, run_dijkstra, run_bfs, run_zero_one_bfs, run_lexicographic, run_fewest_transfers, SEARCH_WEIGHT_MODES
+    from compiled_graph import CompiledGraph
+
+    time_function = make_time_function(graph, get_parameters())
+    extended_graph = get_extended_graph(graph, model_transfer_time)
+    od_pairs = sample_od_pairs(graph, n_pairs)
+
+    def run(search, get_weight, total=lambda distance: distance):
+        pops = []
+        def query(s, e):
+            stats = {}
+            end_state, distances, _ = search(graph, extended_graph, s, get_weight, e, stats)
+            pops.append(stats['pops'])
+            return total(distances[end_state])
+        samples, results = time_calls(query, od_pairs)
+        summary = latency_summary(samples)
+        summary['pops'] = sum(pops) / len(pops)
+        return summary, results
+
+    for mode, searches, algorithms in (('stops', (run_bfs,), ('dijkstra', 'bfs')),
+                                       ('transfers', (run_zero_one_bfs, run_fewest_transfers), ('dijkstra', 'bfs', 'lexicographic'))):
+        get_weight = make_weight_function(mode, time_function)
+        baseline, expected = run(run_dijkstra, get_weight)
+        print_summary(f'{mode} dijkstra', baseline)
+        for search in searches:
+            summary, results = run(search, get_weight if search is run_zero_one_bfs else make_weight_function(SEARCH_WEIGHT_MODES.get(mode, mode), time_function))
+            summary['mismatches'] = sum(1 for a, b in zip(expected, results) if a != b)
+            print_summary(f"{mode} {'levels' if search is run_fewest_transfers else search.__name__}", summary)
+        compiled = CompiledGraph.build(graph, mode, time_function=time_function, transfer_time=model_transfer_time)
+        for algorithm in algorithms:
+            samples, results = time_calls(lambda s, e: compiled.shortest_route(s, e, algorithm)[1], od_pairs)
+            summary = latency_summary(samples)
+            summary['mismatches'] = sum(1 for a, b in zip(expected, results) if a != b)
+            if algorithm == 'lexicographic':
+                summary['beaten'] = count_beaten_transfer_routes(graph, compiled, time_function, od_pairs)
+            print_summary(f"{mode} compiled {'levels' if algorithm == 'lexicographic' else algorithm}", summary)
+
+    get_time = make_weight_function('time', time_function)
+    transfer_weight = 1e7
+    combined = lambda station, line, next_station, next_line, weight, transfer_cost: \
+        get_time(station, line, next_station, next_line, weight, transfer_cost) + (transfer_weight if next_line != line else 0)
+    baseline, expected = run(run_dijkstra, combined)
+    print_summary('lexicographic dijkstra', baseline)
+    summary, results = run(run_lexicographic, get_time, lambda distance: distance[0] * transfer_weight + distance[1])
+    summary['mismatches'] = sum(1 for a, b in zip(expected, results) if abs(a - b) > 1e-3)
+    print_summary('lexicographic levels', summary)
+
+def bench_contraction(n_pairs=None):
+    #hub label queries (from the contraction hierarchy) vs full dijkstra on the compiled graph, over every OD pair by default
+    from setup import graph
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph
+    from contraction import HubLabels
+
+    compiled = CompiledGraph.build(graph, time_function=make_time_function(graph, get_parameters()), transfer_time=model_transfer_time)
+    start = time.perf_counter()
+    labels = HubLabels.build(compiled)
+    print(f'build: {time.perf_counter() - start:.2f}s, {len(labels.middles)} shortcuts, {labels.label_size():.1f} hubs per label')
+    od_pairs = [(s, e) for s in sorted(graph) for e in sorted(graph)] if n_pairs is None else sample_od_pairs(graph, n_pairs)
+    baseline = None
+    for name, search, counter in (('dijkstra', compiled.shortest_route, 'settled'), ('hub_labels', labels.shortest_route, 'hubs')):
+        counts = []
+        def query(s, e):
+            stats = {}
+            result = search(s, e, stats=stats)
+            counts.append(stats[counter])
+            return result
+        samples, results = time_calls(query, od_pairs)
+        if baseline is None:
+            baseline = results
+        summary = latency_summary(samples)
+        summary[counter] = sum(counts) / len(counts)
+        summary['mismatches'] = sum(1 for a, b in zip(baseline, results) if a != b)
+        print_summary(name, summary)
+
+def bench_alternatives(n_pairs=1000, k=3):
+    #k shortest routes by yen's algorithm, with the reverse shortest path tree shared by every spur search vs without it
+    from setup import graph
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph
+    from alternatives import k_shortest_routes
+
+    compiled = CompiledGraph.build(graph, time_function=make_time_function(graph, get_parameters()), transfer_time=model_transfer_time)
+    od_pairs = sample_od_pairs(graph, n_pairs)
+    shortest = [compiled.shortest_route(s, e)[1] for s, e in od_pairs]
+    baseline = None
+    for name, reuse_tree in (('from_scratch', False), ('shared_tree', True)):
+        counts = []
+        def query(s, e):
+            stats = {}
+            result = k_shortest_routes(compiled, s, e, k, stats=stats, reuse_tree=reuse_tree)
+            counts.append(stats)
+            return [total for _, total in result]
+        samples, results = time_calls(query, od_pairs)
+        if baseline is None:
+            baseline = results
+        summary = latency_summary(samples)
+        for counter in ('spur_searches', 'tree_shortcuts', 'settled'):
+            summary[counter] = sum(stats.get(counter, 0) for stats in counts) / len(counts)
+        summary['mismatches'] = sum(1 for a, b in zip(baseline, results) if a != b)
+        summary['not_shortest'] = sum(1 for totals, best in zip(results, shortest) if totals and totals[0] != best)
+        print_summary(name, summary)
+
+def bench_pareto(n_pairs=2000):
+    #the whole (time, transfers) pareto set from one label setting search vs the two single objective dijkstras
+    #(time mode, transfers mode) that only give its two ends
+    from setup import graph
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph
+    from pareto import pareto_routes
+
+    time_function = make_time_function(graph, get_parameters())
+    by_time = CompiledGraph.build(graph, time_function=time_function, transfer_time=model_transfer_time)
+    by_transfers = CompiledGraph.build(graph, 'transfers', time_function=time_function, transfer_time=model_transfer_time)
+    od_pairs = sample_od_pairs(graph, n_pairs)
+    samples, ends = time_calls(lambda s, e: (by_time.shortest_route(s, e)[1], by_transfers.shortest_route(s, e)[1]), od_pairs)
+    print_summary('time_and_transfers_dijkstra', latency_summary(samples))
+    counts = []
+    def query(s, e):
+        stats = {}
+        result = pareto_routes(by_time, s, e, stats=stats)
+        counts.append(stats)
+        return result
+    samples, results = time_calls(query, od_pairs)
+    summary = latency_summary(samples)
+    summary['labels'] = sum(stats['labels'] for stats in counts) / len(counts)
+    summary['options'] = sum(len(options) for options in results) / len(results)
+    summary['mismatches'] = sum(1 for (fastest, fewest), options in zip(ends, results) if (options[0][1], options[-1][2]) != (fastest, fewest))
+    #the front itself: no option beaten or equalled on both time and transfers by another, and capping the transfers
+    #gives exactly the options of the uncapped front that are within the cap
+    summary['dominated'] = sum(1 for options in results if any(a is not b and a[1] <= b[1] and a[2] <= b[2] for a in options for b in options))
+    for max_transfers in (0, 1, 2):
+        capped = [pareto_routes(by_time, s, e, max_transfers=max_transfers) for s, e in od_pairs]
+        summary['mismatches'] += sum(1 for options, within in zip(results, capped) if [(total, transfers) for path, total, transfers in within] != [(total, transfers) for path, total, transfers in options if transfers <= max_transfers])
+    print_summary('pareto', summary)
+    print(f'pairs with a trade-off: {sum(1 for options in results if len(options) > 1)}, with options in between: {sum(1 for options in results if len(options) > 2)}')
+
+def bench_timetable(n_pairs=1000, departures=('06:55', '08:30', '23:50', '00:29', '02:00', '04:59')):
+    #earliest arrival at a departure time: RAPTOR vs a time dependent dijkstra on the same waits, point to point and
+    #one to all, with the static dijkstra (all day frequencies, no departure time) for scale. the departures include
+    #the night (no trains in line_frequencies.json) and either side of its band boundaries, and 'impossible' counts
+    #journeys that arrive before the first train they could have caught from the start
+    from setup import graph
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph
+    from timetable import TimetableRouter, parse_clock
+
+    time_function = make_time_function(graph, get_parameters())
+    static = CompiledGraph.build(graph, time_function=time_function, transfer_time=model_transfer_time)
+    router = TimetableRouter(graph, time_function)
+    od_pairs = sample_od_pairs(graph, n_pairs)
+    samples, _ = time_calls(static.shortest_route, od_pairs)
+    print_summary('static_dijkstra', latency_summary(samples))
+    samples, _ = time_calls(static.travel_times, [(s,) for s, _ in od_pairs])
+    print_summary('static_dijkstra_one_to_all', latency_summary(samples))
+    for clock in departures:
+        departure = parse_clock(clock)
+        samples, expected = time_calls(lambda s, e: router.earliest_arrival_dijkstra(s, e, departure), od_pairs)
+        print_summary(f'td_dijkstra {clock}', latency_summary(samples))
+        counts = []
+        def query(s, e):
+            stats = {}
+            result = router.earliest_arrival(s, e, departure, stats=stats)
+            counts.append(stats.get('rounds', 0))
+            return result
+        samples, results = time_calls(query, od_pairs)
+        summary = latency_summary(samples)
+        summary['rounds'] = sum(counts) / len(counts)
+        summary['mismatches'] = sum(1 for (_, a), (_, b) in zip(expected, results) if abs(a - b) > 1e-6)
+        summary['impossible'] = sum(1 for (s, e), (route, arrival) in zip(od_pairs, results) if route and s != e and
+                                    arrival < departure + min(router.wait(router.compiled.state_line[state], departure) for state in router.compiled.station_states[s]))
+        print_summary(f'raptor {clock}', summary)
+        samples, _ = time_calls(lambda s: router.arrival_times(s, departure), [(s,) for s, _ in od_pairs])
+        print_summary(f'raptor_one_to_all {clock}', latency_summary(samples))
+
+def bench_disruptions(n_closures=30):
+    #closing a random segment, station or line and reopening it: repairing the journey table incrementally vs
+    #searching every row again, checked against the full search
+    import random
+    from setup import graph
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph
+    from journey_table import JourneyTable
+    from disruptions import Disruptions
+
+    time_function = make_time_function(graph, get_parameters())
+    compiled = CompiledGraph.build(graph, time_function=time_function, transfer_time=model_transfer_time)
+    table = JourneyTable.build(graph, time_function=time_function, transfer_time=model_transfer_time)
+    rng = random.Random(0)
+    segments = sorted(set((min(a, b), max(a, b), line) for a in graph for b, line, _ in graph[a]))
+    lines = sorted(set(line for _, _, line in segments))
+    closures = {
+        'segment': lambda closures: closures.close_segment(*rng.choice(segments)),
+        'station': lambda closures: closures.close_station(rng.choice(sorted(graph))),
+        'line': lambda closures: closures.close_line(rng.choice(lines)),
+    }
+    disruptions = Disruptions()
+    for kind, close in closures.items():
+        incremental, full, mismatches, changed = [], [], 0, 0
+        for _ in range(n_closures if kind != 'line' else len(lines)):
+            for change in (close, Disruptions.clear):
+                change(disruptions)
+                changes = disruptions.apply(compiled)
+                start = time.perf_counter()
+                changed += sum(len(destinations) for destinations in table.update(compiled, changes).values())
+                incremental.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                trees = {source: compiled.shortest_tree(source)[0] for source in graph}
+                full.append(time.perf_counter() - start)
+                mismatches += sum(1 for source in graph if list(table.distances[source]) != trees[source])
+        print_summary(f'{kind} full_rebuild', latency_summary(full))
+        summary = latency_summary(incremental)
+        summary['routes_changed'] = changed / len(incremental)
+        summary['mismatches'] = mismatches
+        print_summary(f'{kind} incremental', summary)
+
+def time_subprocess(code, repeats):
+    #wall clock of a fresh interpreter running code, i.e. what a gunicorn worker pays on boot
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def time_import(module, repeats, before=''):
+    #just the import statement in a fresh interpreter, without the interpreter's own startup
+    samples = []
+    for _ in range(repeats):
+        code = f"{before}\nimport time\nstart = time.perf_counter()\nimport {module}\nprint(time.perf_counter() - start)"
+        samples.append(float(subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout))
+    return samples
+
+def bench_startup(repeats=5):
+    #importing model with the saved parameters vs refitting on import like it used to
+    loaded = time_subprocess("import model; assert model.parameters_source == 'file'", repeats)
+    refitted = time_subprocess("import model; model.fine_tune()", max(1, repeats // 5))
+    print_summary('import model (saved)', latency_summary(loaded))
+    print_summary('import model + refit', latency_summary(refitted))
+    #setup from network.bin vs parsing the text files
+    text_only = "import network_data\nnetwork_data.load_network = lambda *args: None\nnetwork_data.write_network = lambda *args: None"
+    print_summary('import setup (network.bin)', latency_summary(time_import('setup', repeats * 4)))
+    print_summary('import setup (text files)', latency_summary(time_import('setup', repeats * 4, text_only)))
+
+def import_times(module):
+    #cumulative import time in microseconds of every module imported by `import module` in a fresh interpreter,
+    #from python -X importtime (which writes "import time: self | cumulative | name" to stderr)
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], check=True, capture_output=True, text=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        parts = line.split('|')
+        if line.startswith('import time:') and parts[1].strip().isdigit():
+            times[parts[2].strip()] = int(parts[1])
+    return times
+
+#the entry points a script would use, from just routing up to the whole app
+IMPORT_ENTRY_POINTS = ('routes', 'model', 'journey_table', 'compiled_graph', 'visualisation', 'app')
+HEAVY_MODULES = ('numpy', 'folium', 'flask')
+
+def bench_imports(repeats=5):
+    #what each entry point costs to import and which of the heavy dependencies it pulls in (numpy and folium are
+    #only meant to load on the first map or timetable query, or when fitting), *_us columns are 0 when not imported
+    for module in IMPORT_ENTRY_POINTS:
+        runs = [import_times(module) for _ in range(repeats)]
+        summary = {'p50_us': percentile([run[module] for run in runs], 50)}
+        for heavy in HEAVY_MODULES:
+            summary[f'{heavy}_us'] = percentile([run.get(heavy, 0) for run in runs], 50)
+        print_summary(f'import {module}', summary)
+
+#a few requests per worker across every mode, so the lazily built structures and caches get touched,
+#then a full collection like a long running worker would eventually do (it's what un-shares pages without gc.freeze)
+WORKER_REQUESTS = """
+import gc
+client = app.app.test_client()
+for mode in ('time', 'distance', 'stops', 'transfers'):
+    for start, end in (('Morden', 'Paddington'), ('Brixton', 'Wembley Park'), (134, 152)):
+        client.get(f'/api/route?start={start}&end={end}&mode={mode}')
+client.get('/api/isochrone?start=Bank&minutes=20')
+gc.collect()
+"""
+
+#each worker imports the app itself, like gunicorn without preload_app
+INDEPENDENT_WORKER = """
+import sys
+import app
+""" + WORKER_REQUESTS + """
+print('ready', flush=True)
+sys.stdin.read()
+"""
+
+#the app is imported and warmed up once, then the workers are forked, like gunicorn.conf.py
+PREFORK_MASTER = """
+import gc, os, sys
+import app
+app.warm_up()
+gc.freeze()
+workers = int(sys.argv[1])
+for _ in range(workers):
+    if os.fork() == 0:
+""" + "".join("        " + line + "\n" for line in WORKER_REQUESTS.strip().splitlines()) + """
+        sys.stdout.write(f'{os.getpid()}\\n')    #one write, so the workers' lines can't interleave
+        sys.stdout.flush()
+        sys.stdin.read()
+        os._exit(0)
+for _ in range(workers):
+    os.wait()
+"""
+
+def memory_usage(pid):
+    #rss, pss and uss (private pages) of a process in KiB, from /proc/<pid>/smaps_rollup
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return {'rss_kib': fields['Rss'], 'pss_kib': fields['Pss'], 'uss_kib': fields['Private_Clean'] + fields['Private_Dirty']}
+
+def measure_workers(processes, workers_per_process):
+    #waits for every worker to report in, then samples their memory while they're all alive
+    #with more than one worker per process, the process is a master that forked them and reports their pids
+    pids = []
+    for process in processes:
+        for _ in range(workers_per_process):
+            line = process.stdout.readline()
+            pids.append(int(line) if workers_per_process > 1 else process.pid)
+    masters = [process.pid for process in processes] if workers_per_process > 1 else []
+    return [memory_usage(pid) for pid in pids], [memory_usage(pid) for pid in masters]
+
+def bench_prefork(workers=4):
+    #memory per worker and time until every worker is ready: each worker importing the app vs forking a warmed up master
+    def run(name, launch):
+        start = time.perf_counter()
+        processes, per_process = launch()
+        usage, masters = measure_workers(processes, per_process)
+        ready = time.perf_counter() - start
+        for process in processes:
+            process.stdin.close()
+            process.wait()
+        summary = {key: sum(u[key] for u in usage) / len(usage) for key in usage[0]}
+        summary['total_pss_mib'] = sum(u['pss_kib'] for u in usage + masters) / 1024    #what the box actually pays
+        summary['ready_ms'] = ready * 1000
+        print_summary(name, summary)
+
+    def independent():
+        launch = lambda: subprocess.Popen([sys.executable, '-c', INDEPENDENT_WORKER], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        return [launch() for _ in range(workers)], 1
+    def prefork():
+        return [subprocess.Popen([sys.executable, '-c', PREFORK_MASTER, str(workers)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)], workers
+    run(f'independent x{workers}', independent)
+    run(f'prefork x{workers}', prefork)
+
+def bench_stages(n_pairs=200, n_requests=20, repeats=3):
+    #the app's costs stage by stage, on fixed inputs so runs can be compared with --json and --baseline: loading the
+    #data, fitting the model, single route queries, all pairs sweeps, map renders and whole page requests
+    import contextlib
+    import io
+    import tempfile
+    import warnings
+    print_summary('load setup', latency_summary(time_import('setup', repeats * 4)))
+    print_summary('load model', latency_summary(time_import('model', repeats * 4)))
+    print_summary('load app', latency_summary(time_import('app', repeats)))
+
+    from setup import graph, vertex_data, line_colours
+    import model
+    from routes import get_shortest_route
+    from vectorised_model import make_time_function
+    from journey_table import JourneyTable
+    from visualisation import create_route_map, NetworkLayers
+
+    saved = model.get_parameters()
+    with contextlib.redirect_stdout(io.StringIO()):    #fine_tune prints every line it fits
+        samples, _ = time_calls(model.fine_tune, [()])
+    model.set_parameters(saved)
+    print_summary('fine_tune', latency_summary(samples))
+
+    od_pairs = sample_od_pairs(graph, n_pairs)
+    samples, _ = time_calls(lambda s, e: get_shortest_route(graph, s, e, time_function=model.time_DC, transfer_time=model.model_transfer_time), od_pairs)
+    print_summary('route get_shortest_route', latency_summary(samples))
+    build = lambda: JourneyTable.build(graph, time_function=make_time_function(graph, model.get_parameters()), transfer_time=model.model_transfer_time)
+    samples, tables = time_calls(build, [()] * repeats)
+    print_summary('all pairs journey table', latency_summary(samples))
+    samples, _ = time_calls(tables[0].get_route, od_pairs)
+    print_summary('route journey table', latency_summary(samples))
+
+    warnings.filterwarnings('ignore', module='folium')
+    routes = [tables[0].get_route(s, e) for s, e in od_pairs[:n_requests]]
+    network = NetworkLayers(graph, vertex_data, line_colours)
+    with tempfile.TemporaryDirectory() as directory:
+        base_layer_files = network.write_geojson(directory)
+        render = lambda path, total: create_route_map(graph, vertex_data, line_colours, path, total, network=network, base_layer_files=base_layer_files)._repr_html_()
+        samples, _ = time_calls(render, [route for route in routes if route[0]])
+    print_summary('map render', latency_summary(samples))
+
+    #whole requests to the route page, every pair a different one so none of them come from the route cache
+    import app
+    client = app.app.test_client()
+    form = lambda s, e: {'start_station': vertex_data[s][0], 'end_station': vertex_data[e][0]}
+    pairs = list(dict.fromkeys((s, e) for s, e in sample_od_pairs(graph, n_pairs, seed=1) if s != e))[:n_requests]
+    with contextlib.redirect_stdout(io.StringIO()):    #the page prints the journey time
+        samples, responses = time_calls(lambda s, e: client.post('/', data=form(s, e)), pairs)
+    if any(response.status_code != 200 for response in responses):
+        raise RuntimeError('a request to the route page failed')
+    print_summary('app index', latency_summary(samples))
+
+BENCHMARKS = {
+    'journey_table': bench_journey_table,
+    'compiled_graph': bench_compiled_graph,
+    'extended_graph': bench_extended_graph,
+    'vectorised_model': bench_vectorised_model,
+    'fitting': bench_fitting,
+    'map_render': bench_map_render,
+    'search_algorithms': bench_search_algorithms,
+    'mode_searches': bench_mode_searches,
+    'contraction': bench_contraction,
+    'alternatives': bench_alternatives,
+    'pareto': bench_pareto,
+    'timetable': bench_timetable,
+    'disruptions': bench_disruptions,
+    'startup': bench_startup,
+    'imports': bench_imports,
+    'prefork': bench_prefork,
+    'stages': bench_stages,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tube routing backend")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default: all of " + ", ".join(BENCHMARKS) + ")")
+    parser.add_argument('--json', help="save every row to this file, to compare later runs against")
+    parser.add_argument('--baseline', help="a file saved with --json: fail if any row's p50 regressed against it")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help=f"how many times slower counts as a regression (default {DEFAULT_TOLERANCE})")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+    for name in args.names or BENCHMARKS:
+        print(f"== {name} ==")
+        current_benchmark = name
+        BENCHMARKS[name]()
+    failures = failed_checks(results)
+    for benchmark, row, check, count in failures:
+        print(f"FAILED {benchmark} / {row}: {check}={count:g}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'meta': run_metadata(), 'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        compared, only_baseline, only_current = compare_rows(baseline['results'], results)
+        for benchmark, row in only_baseline:
+            print(f"MISSING {benchmark} / {row}: in the baseline but not in this run")
+        for benchmark, row in only_current:
+            print(f"NEW {benchmark} / {row}: not in the baseline")
+        if not compared:
+            print(f"no rows in common with {args.baseline}, nothing was compared")
+            sys.exit(1)
+        regressions = find_regressions(baseline['results'], results, args.tolerance)
+        for benchmark, row, before, after in regressions:
+            print(f"REGRESSION {benchmark} / {row}: p50 {before:.1f}us -> {after:.1f}us ({after / before:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions in {len(compared)} rows against {args.baseline} (commit {baseline['meta'].get('commit')}, tolerance {args.tolerance}x)")
+    if failures:
+        sys.exit(1)
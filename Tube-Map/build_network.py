@@ -0,0 +1,18 @@
+#offline build of network.bin, run from this folder after changing the station, edge or dwell time files:
+#   python build_network.py
+#setup rewrites it on import when it's stale, but building it at deploy time means no worker ever parses the text
+import argparse
+from network_data import NETWORK_FILE, NetworkData, source_checksum, write_network
+from setup import read_network_text, line_speeds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the network text files into one binary file")
+    parser.add_argument('--output', default=NETWORK_FILE, help="where to write the compiled network")
+    args = parser.parse_args()
+
+    graph, vertex_data, average_dwell_times = read_network_text()
+    write_network(args.output, graph, vertex_data, average_dwell_times, source_checksum(line_speeds))
+    network = NetworkData(args.output)
+    if (network.graph(), network.vertex_data(), network.average_dwell_times()) != (graph, vertex_data, average_dwell_times):
+        raise SystemExit(f'{args.output} does not read back the same network')
+    print(f'Wrote {args.output}: {network.n_stations} stations, {network.n_edges} edges, {network.n_dwell} dwell times')
@@ -0,0 +1,570 @@
+#compact array-backed version of the graph for the routing core
+#the dict graph is {station: [(dest, line_name, distance), ...]} and dijkstra keys everything by (station, line) tuples,
+#here lines get integer IDs, every (station, line) state gets a dense index and the edges live in flat CSR buffers
+#with the modelled weights baked in, so the search loop only ever touches ints and floats
+from array import array
+from collections import deque
+from heapq import heappush, heappop
+from setup import *
+from routes import make_weight_function, get_extended_graph
+
+SEARCH_ALGORITHMS = ('dijkstra', 'astar', 'bidirectional')
+#what shortest_route and shortest_tree use for a graph built with each mode, when no algorithm is asked for
+MODE_ALGORITHMS = {'stops': 'bfs', 'transfers': 'lexicographic'}
+
+class CompiledGraph:
+    def __init__(self, line_names, station_offsets, station_targets, station_lines, station_distances,
+                 state_station, state_line, state_offsets, state_targets, state_weights, mode=None, state_tie_weights=None):
+        self.mode = mode
+        self.line_names = line_names
+        self.line_ids = {name: i for i, name in enumerate(line_names)}
+        #station level CSR, this is just the dict graph in arrays (edges of station s are station_offsets[s]:station_offsets[s+1])
+        self.station_offsets = station_offsets
+        self.station_targets = station_targets
+        self.station_lines = station_lines
+        self.station_distances = station_distances
+        #state level CSR, state i is (state_station[i], state_line[i]) and its edges are state_offsets[i]:state_offsets[i+1]
+        self.state_station = state_station
+        self.state_line = state_line
+        self.state_offsets = state_offsets
+        self.state_targets = state_targets
+        self.state_weights = state_weights
+        self.state_tie_weights = state_tie_weights  #for mode 'transfers', the time of each edge, to pick the quickest of the routes with the fewest transfers
+        self.state_index = {(state_station[i], line_names[state_line[i]]): i for i in range(len(state_station))}
+        self.station_states = [[] for _ in range(len(station_offsets) - 1)]
+        for i in range(len(state_station)):
+            self.station_states[state_station[i]].append(i)
+        self._dict_graph = None
+        self._heuristic_rate = None
+        self._bounds = {}
+        self._reverse = None
+        self._reverse_position = None
+        self._base_weights = None
+
+    @classmethod
+    def build(cls, graph, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180):
+        #station IDs from setup are already dense (0..n-1), so they index the arrays directly
+        get_weight = make_weight_function(mode, time_function)
+        get_tie_weight = make_weight_function('time', time_function) if mode == 'transfers' else None
+        extended_graph = get_extended_graph(graph, transfer_time)
+        line_names = sorted(set(line for station in graph for _, line, _ in graph[station]))
+        line_ids = {name: i for i, name in enumerate(line_names)}
+        n_stations = max(graph) + 1
+
+        station_offsets = array('i', [0])
+        station_targets = array('i')
+        station_lines = array('i')
+        station_distances = array('d')
+        for station in range(n_stations):
+            for dest, line, distance in graph.get(station, []):
+                station_targets.append(dest)
+                station_lines.append(line_ids[line])
+                station_distances.append(distance)
+            station_offsets.append(len(station_targets))
+
+        #states sorted by (station, line name) so heap ties break exactly like they do in routes.get_shortest_route
+        states = sorted(set((station, line) for station in graph for _, line, _ in graph[station]))
+        state_index = {state: i for i, state in enumerate(states)}
+        state_station = array('i', [station for station, _ in states])
+        state_line = array('i', [line_ids[line] for _, line in states])
+        state_offsets = array('i', [0])
+        state_targets = array('i')
+        state_weights = array('d')
+        state_tie_weights = array('d') if get_tie_weight else None
+        for station, line in states:
+            for dest, next_line, distance, transfer_cost in extended_graph[(station, line)]:
+                state_targets.append(state_index[(dest, next_line)])
+                state_weights.append(get_weight(station, line, dest, next_line, distance, transfer_cost))
+                if get_tie_weight:
+                    state_tie_weights.append(get_tie_weight(station, line, dest, next_line, distance, transfer_cost))
+            state_offsets.append(len(state_targets))
+
+        return cls(line_names, station_offsets, station_targets, station_lines, station_distances,
+                   state_station, state_line, state_offsets, state_targets, state_weights, mode, state_tie_weights)
+
+    @property
+    def dict_graph(self):
+        #the old {station: [(dest, line_name, distance)]} graph, for code like visualisation.create_route_map
+        if self._dict_graph is None:
+            self._dict_graph = {}
+            for station in range(len(self.station_offsets) - 1):
+                lo, hi = self.station_offsets[station], self.station_offsets[station + 1]
+                if lo == hi:
+                    continue
+                self._dict_graph[station] = [(self.station_targets[k], self.line_names[self.station_lines[k]], self.station_distances[k]) for k in range(lo, hi)]
+        return self._dict_graph
+
+    def state_to_tuple(self, state):
+        return (self.state_station[state], self.line_names[self.state_line[state]])
+
+    def _dijkstra(self, start_id, end_id=None, stats=None):
+        #same search as routes.run_dijkstra, on state indices
+        #returns (end_state, distances, predecessors), end_state is -1 if end_id wasn't reached
+        #stats (a dict) gets the number of settled states, heap pushes and pops
+        INF = float('inf')
+        offsets = self.state_offsets
+        targets = self.state_targets
+        weights = self.state_weights
+        state_station = self.state_station
+        distances = [INF] * len(state_station)
+        predecessors = array('i', [-1]) * len(state_station)
+        queue = []
+        settled = 0
+        pushes = 0
+        pops = 0
+        for state in self.station_states[start_id]:
+            distances[state] = 0
+            heappush(queue, (0, state))
+            pushes += 1
+        end_state = -1
+        while queue:
+            current_distance, state = heappop(queue)
+            pops += 1
+            if current_distance != distances[state]:
+                continue
+            settled += 1
+            if state_station[state] == end_id:
+                end_state = state
+                break
+            for k in range(offsets[state], offsets[state + 1]):
+                distance = current_distance + weights[k]
+                target = targets[k]
+                if distance < distances[target]:
+                    distances[target] = distance
+                    predecessors[target] = state
+                    heappush(queue, (distance, target))
+                    pushes += 1
+        if stats is not None:
+            stats['settled'] = settled
+            stats['pushes'] = pushes
+            stats['pops'] = pops
+        return end_state, distances, predecessors
+
+    def _bfs(self, start_id, end_id=None, stats=None):
+        #_dijkstra for graphs whose weights are all 0 or 1 (mode 'stops' or 'transfers', inf for closed edges): a
+        #deque with 0 edges put on the front and 1 edges on the back stays in order of distance without a heap
+        #(0-1 BFS, and with only 1s it's a plain BFS). same return shape as _dijkstra
+        if self.mode not in MODE_ALGORITHMS:
+            raise ValueError(f"bfs needs a graph built with mode 'stops' or 'transfers', not {self.mode!r}")
+        INF = float('inf')
+        offsets = self.state_offsets
+        targets = self.state_targets
+        weights = self.state_weights
+        state_station = self.state_station
+        distances = [INF] * len(state_station)
+        predecessors = array('i', [-1]) * len(state_station)
+        queue = deque()
+        settled = 0
+        pushes = 0
+        pops = 0
+        for state in self.station_states[start_id]:
+            distances[state] = 0
+            queue.append((0, state))
+            pushes += 1
+        end_state = -1
+        while queue:
+            current_distance, state = queue.popleft()
+            pops += 1
+            if current_distance != distances[state]:
+                continue
+            settled += 1
+            if state_station[state] == end_id:
+                end_state = state
+                break
+            for k in range(offsets[state], offsets[state + 1]):
+                distance = current_distance + weights[k]
+                target = targets[k]
+                if distance < distances[target]:
+                    distances[target] = distance
+                    predecessors[target] = state
+                    if distance == current_distance:
+                        queue.appendleft((distance, target))
+                    else:
+                        queue.append((distance, target))
+                    pushes += 1
+        if stats is not None:
+            stats['settled'] = settled
+            stats['pushes'] = pushes
+            stats['pops'] = pops
+        return end_state, distances, predecessors
+
+    def _lexicographic(self, start_id, end_id=None, stats=None, times=None):
+        #for mode 'transfers': the fewest transfers first, then the least time among those (state_tie_weights), like
+        #routes.run_lexicographic. each level (the states with the same number of transfers) is a dijkstra on time,
+        #staying on the line goes on this level's heap and changing lines on the next one's. same return shape as
+        #_dijkstra, the distances are the transfers. times (a list) gets the time of every state, to break ties
+        #between a station's states the same way
+        if self.state_tie_weights is None:
+            raise ValueError(f"lexicographic needs a graph built with mode 'transfers', not {self.mode!r}")
+        INF = float('inf')
+        offsets = self.state_offsets
+        targets = self.state_targets
+        weights = self.state_weights
+        tie_weights = self.state_tie_weights
+        state_station = self.state_station
+        distances = [INF] * len(state_station)
+        state_times = [INF] * len(state_station)
+        predecessors = array('i', [-1]) * len(state_station)
+        level = []
+        settled = 0
+        pushes = 0
+        pops = 0
+        for state in self.station_states[start_id]:
+            distances[state] = 0
+            state_times[state] = 0
+            heappush(level, (0, state))
+            pushes += 1
+        transfers = 0
+        end_state = -1
+        while level and end_state == -1:
+            next_level = []
+            while level:
+                current_time, state = heappop(level)
+                pops += 1
+                if distances[state] != transfers or state_times[state] != current_time:
+                    continue
+                settled += 1
+                if state_station[state] == end_id:
+                    end_state = state
+                    break
+                for k in range(offsets[state], offsets[state + 1]):
+                    step = weights[k]
+                    if step == INF:    #closed
+                        continue
+                    distance = transfers + step
+                    time = current_time + tie_weights[k]
+                    target = targets[k]
+                    if distance < distances[target] or (distance == distances[target] and time < state_times[target]):
+                        distances[target] = distance
+                        state_times[target] = time
+                        predecessors[target] = state
+                        heappush(level if step == 0 else next_level, (time, target))
+                        pushes += 1
+            level = next_level
+            transfers += 1
+        if stats is not None:
+            stats['settled'] = settled
+            stats['pushes'] = pushes
+            stats['pops'] = pops
+        if times is not None:
+            times[:] = state_times
+        return end_state, distances, predecessors
+
+    @property
+    def heuristic_rate(self):
+        #smallest weight per metre of straight line distance over every edge, so haversine(station, end) * rate
+        #is a lower bound on the remaining weight (each edge costs at least rate * its length, and the straight line
+        #is the shortest way to the end). this comes from the baked weights rather than setup.top_speeds, since the
+        #fitted relative speeds can push the modelled top speed above the nominal one. shrunk slightly so float
+        #rounding can't make it overestimate
+        if self._heuristic_rate is None:
+            rate = float('inf')
+            for state in range(len(self.state_station)):
+                lat1, lon1 = vertex_data[self.state_station[state]][1:]
+                for k in range(self.state_offsets[state], self.state_offsets[state + 1]):
+                    lat2, lon2 = vertex_data[self.state_station[self.state_targets[k]]][1:]
+                    distance = haversine(lat1, lon1, lat2, lon2)
+                    if distance > 0:
+                        rate = min(rate, self.state_weights[k] / distance)
+            self._heuristic_rate = 0 if rate == float('inf') else rate * (1 - 1e-9)
+        return self._heuristic_rate
+
+    def prepare(self):
+        #does the one-off preprocessing for astar and bidirectional up front (heuristic for every destination,
+        #reverse edges), otherwise it happens lazily on the first queries that need it
+        self._reverse_edges()
+        for station in range(len(self.station_states)):
+            if self.station_states[station]:
+                self._heuristic_bounds(station)
+        return self
+
+    def _heuristic_bounds(self, end_id):
+        #lower bound on the remaining weight from every station to end_id, cached per destination
+        bounds = self._bounds.get(end_id)
+        if bounds is None:
+            rate = self.heuristic_rate
+            end_lat, end_lon = vertex_data[end_id][1:]
+            bounds = array('d', [0]) * len(self.station_states)
+            for station in range(len(self.station_states)):
+                if self.station_states[station]:
+                    lat, lon = vertex_data[station][1:]
+                    bounds[station] = haversine(lat, lon, end_lat, end_lon) * rate
+            self._bounds[end_id] = bounds
+        return bounds
+
+    def _astar(self, start_id, end_id, stats=None):
+        #A* on the same states as _dijkstra, guided by the straight line distance to end_id
+        #the heuristic is consistent, so the first end state popped is optimal, same return shape as _dijkstra
+        INF = float('inf')
+        offsets = self.state_offsets
+        targets = self.state_targets
+        weights = self.state_weights
+        state_station = self.state_station
+        bounds = self._heuristic_bounds(end_id)
+
+        distances = [INF] * len(state_station)
+        predecessors = array('i', [-1]) * len(state_station)
+        queue = []
+        settled = 0
+        pushes = 0
+        for state in self.station_states[start_id]:
+            distances[state] = 0
+            heappush(queue, (bounds[start_id], 0, state))
+            pushes += 1
+        end_state = -1
+        while queue:
+            _, current_distance, state = heappop(queue)
+            if current_distance != distances[state]:
+                continue
+            settled += 1
+            if state_station[state] == end_id:
+                end_state = state
+                break
+            for k in range(offsets[state], offsets[state + 1]):
+                distance = current_distance + weights[k]
+                target = targets[k]
+                if distance < distances[target]:
+                    distances[target] = distance
+                    predecessors[target] = state
+                    heappush(queue, (distance + bounds[state_station[target]], distance, target))
+                    pushes += 1
+        if stats is not None:
+            stats['settled'] = settled
+            stats['pushes'] = pushes
+        return end_state, distances, predecessors
+
+    def _reverse_edges(self):
+        #reverse CSR (incoming edges of each state), built the first time a bidirectional search needs it
+        if self._reverse is None:
+            n_states = len(self.state_station)
+            incoming = [[] for _ in range(n_states)]
+            for state in range(n_states):
+                for k in range(self.state_offsets[state], self.state_offsets[state + 1]):
+                    incoming[self.state_targets[k]].append((state, k))
+            reverse_offsets = array('i', [0])
+            reverse_sources = array('i')
+            reverse_weights = array('d')
+            reverse_position = array('i', [0]) * len(self.state_targets)    #where forward edge k is in the reverse CSR
+            for state in range(n_states):
+                for source, k in incoming[state]:
+                    reverse_position[k] = len(reverse_sources)
+                    reverse_sources.append(source)
+                    reverse_weights.append(self.state_weights[k])
+                reverse_offsets.append(len(reverse_sources))
+            self._reverse = (reverse_offsets, reverse_sources, reverse_weights)
+            self._reverse_position = reverse_position
+        return self._reverse
+
+    @property
+    def base_weights(self):
+        #the edge weights as built, before any set_edge_weights
+        self._save_base_weights()
+        return self._base_weights
+
+    def _save_base_weights(self):
+        #keeps a copy of the weights as they are now the first time, so it has to run before anything is patched
+        if self._base_weights is None:
+            self._base_weights = array('d', self.state_weights)
+
+    def copy(self):
+        #a graph sharing this one's structure but with its own edge weights, so they can be patched (set_edge_weights)
+        #while searches still running on this one keep seeing the weights they started with
+        self._save_base_weights()    #shared with the copy, which is patched from now on
+        other = object.__new__(type(self))
+        other.__dict__.update(self.__dict__)
+        other.state_weights = array('d', self.state_weights)
+        if self._reverse is not None:
+            other._reverse = (self._reverse[0], self._reverse[1], array('d', self._reverse[2]))
+        other._bounds = dict(self._bounds)
+        return other
+
+    def set_edge_weights(self, changes):
+        #patch edge weights in place, changes is [(k, weight), ...] with k an index into state_targets
+        #(e.g. inf to close an edge, see disruptions.py). the reverse edges follow along, and if any weight went down
+        #the cached A* bounds are dropped since they could now overestimate
+        self._save_base_weights()
+        lowered = False
+        for k, weight in changes:
+            lowered = lowered or weight < self.state_weights[k]
+            self.state_weights[k] = weight
+            if self._reverse is not None:
+                self._reverse[2][self._reverse_position[k]] = weight
+        if lowered:
+            self._heuristic_rate = None
+            self._bounds = {}
+
+    def _edge_weight(self, state, target):
+        #cheapest edge between two states (there can be duplicate edges in the data)
+        return min(self.state_weights[k] for k in range(self.state_offsets[state], self.state_offsets[state + 1]) if self.state_targets[k] == target)
+
+    def _bidirectional(self, start_id, end_id, stats=None):
+        #dijkstra forwards from every start state and backwards from every end state at once,
+        #stopping when the two frontiers can't improve on the best meeting point found so far
+        #returns (path as state indices, total) or (None, inf)
+        INF = float('inf')
+        if start_id == end_id:
+            end_state, distances, predecessors = self._dijkstra(start_id, end_id, stats)
+            return [end_state], distances[end_state]
+        offsets, targets, weights = self.state_offsets, self.state_targets, self.state_weights
+        reverse_offsets, reverse_sources, reverse_weights = self._reverse_edges()
+        n_states = len(self.state_station)
+        forward = [INF] * n_states
+        backward = [INF] * n_states
+        predecessors = array('i', [-1]) * n_states
+        successors = array('i', [-1]) * n_states
+        forward_queue = []
+        backward_queue = []
+        for state in self.station_states[start_id]:
+            forward[state] = 0
+            heappush(forward_queue, (0, state))
+        for state in self.station_states[end_id]:
+            backward[state] = 0
+            heappush(backward_queue, (0, state))
+        settled = 0
+        pushes = len(forward_queue) + len(backward_queue)
+        best, meeting_state = INF, -1
+        while forward_queue and backward_queue:
+            if forward_queue[0][0] + backward_queue[0][0] >= best:
+                break
+            if forward_queue[0][0] <= backward_queue[0][0]:
+                current_distance, state = heappop(forward_queue)
+                if current_distance != forward[state]:
+                    continue
+                settled += 1
+                for k in range(offsets[state], offsets[state + 1]):
+                    distance = current_distance + weights[k]
+                    target = targets[k]
+                    if distance < forward[target]:
+                        forward[target] = distance
+                        predecessors[target] = state
+                        heappush(forward_queue, (distance, target))
+                        pushes += 1
+                        if distance + backward[target] < best:
+                            best, meeting_state = distance + backward[target], target
+            else:
+                current_distance, state = heappop(backward_queue)
+                if current_distance != backward[state]:
+                    continue
+                settled += 1
+                for k in range(reverse_offsets[state], reverse_offsets[state + 1]):
+                    distance = current_distance + reverse_weights[k]
+                    source = reverse_sources[k]
+                    if distance < backward[source]:
+                        backward[source] = distance
+                        successors[source] = state
+                        heappush(backward_queue, (distance, source))
+                        pushes += 1
+                        if forward[source] + distance < best:
+                            best, meeting_state = forward[source] + distance, source
+        if stats is not None:
+            stats['settled'] = settled
+            stats['pushes'] = pushes
+        if meeting_state == -1:
+            return None, INF
+        path = []
+        state = meeting_state
+        while state != -1:
+            path.append(state)
+            state = predecessors[state]
+        path.reverse()
+        state = successors[meeting_state]
+        while state != -1:
+            path.append(state)
+            state = successors[state]
+        #add the weights up from the start, in the same order dijkstra does, so the total matches it exactly
+        total = 0
+        for state, target in zip(path, path[1:]):
+            total += self._edge_weight(state, target)
+        return path, total
+
+    def reconstruct_path(self, predecessors, state):
+        path = []
+        while state != -1:
+            path.append(self.state_to_tuple(state))
+            state = predecessors[state]
+        return path[::-1]
+
+    def has_station(self, station):
+        return 0 <= station < len(self.station_states) and len(self.station_states[station]) > 0
+
+    def shortest_route(self, start_id, end_id, algorithm=None, stats=None):
+        #same return shape as routes.get_shortest_route, algorithm is one of SEARCH_ALGORITHMS, 'bfs' (only for
+        #the modes in MODE_ALGORITHMS) or 'lexicographic' (only for mode 'transfers'), by default the one for the
+        #graph's mode. they all give the same totals, they just settle different numbers of states getting there
+        #(and 'lexicographic' picks the quickest of the routes with that total)
+        INF = float('inf')
+        if algorithm is None:
+            algorithm = MODE_ALGORITHMS.get(self.mode, 'dijkstra')
+        if not self.has_station(start_id) or not self.has_station(end_id):
+            return None, INF
+        if algorithm == 'bidirectional':
+            path, total = self._bidirectional(start_id, end_id, stats)
+            if path is None:
+                return None, INF
+            return [self.state_to_tuple(state) for state in path], total
+        if algorithm == 'dijkstra':
+            end_state, distances, predecessors = self._dijkstra(start_id, end_id, stats)
+        elif algorithm == 'astar':
+            end_state, distances, predecessors = self._astar(start_id, end_id, stats)
+        elif algorithm == 'bfs':
+            end_state, distances, predecessors = self._bfs(start_id, end_id, stats)
+        elif algorithm == 'lexicographic':
+            end_state, distances, predecessors = self._lexicographic(start_id, end_id, stats)
+        else:
+            raise ValueError(f"Unknown search algorithm {algorithm!r}, expected one of {', '.join(SEARCH_ALGORITHMS + ('bfs', 'lexicographic'))}")
+        if end_state == -1:
+            return None, INF
+        return self.reconstruct_path(predecessors, end_state), distances[end_state]
+
+    def shortest_tree(self, start_id):
+        #distances and predecessors (state indices, -1 for none) of every state from start_id
+        if MODE_ALGORITHMS.get(self.mode) == 'bfs':
+            _, distances, predecessors = self._bfs(start_id)
+        elif MODE_ALGORITHMS.get(self.mode) == 'lexicographic':
+            _, distances, predecessors = self._lexicographic(start_id)
+        else:
+            _, distances, predecessors = self._dijkstra(start_id)
+        return distances, predecessors
+
+    def travel_times(self, start_id):
+        #best distance to every station from one search, indexed by station (inf if unreachable)
+        INF = float('inf')
+        travel_times = [INF] * len(self.station_states)
+        if not self.has_station(start_id):
+            return travel_times
+        distances, _ = self.shortest_tree(start_id)
+        for state, distance in enumerate(distances):
+            station = self.state_station[state]
+            if distance < travel_times[station]:
+                travel_times[station] = distance
+        return travel_times
+
+    def routes_from(self, start_id, end_ids):
+        #one search from start_id answers every destination, returns {end_id: (path, total)}
+        INF = float('inf')
+        if not self.has_station(start_id):
+            return {end_id: (None, INF) for end_id in end_ids}
+        if MODE_ALGORITHMS.get(self.mode) == 'lexicographic':
+            times = []
+            _, distances, predecessors = self._lexicographic(start_id, times=times)
+            rank = list(zip(distances, times))  #the quickest of a station's states with the fewest transfers
+        else:
+            distances, predecessors = self.shortest_tree(start_id)
+            rank = distances
+        results = {}
+        for end_id in end_ids:
+            best = -1
+            if self.has_station(end_id):
+                for state in self.station_states[end_id]:  #sorted by line, so ties break like the heap
+                    if distances[state] < INF and (best == -1 or rank[state] < rank[best]):
+                        best = state
+            results[end_id] = (None, INF) if best == -1 else (self.reconstruct_path(predecessors, best), distances[best])
+        return results
+
+    def batch_routes(self, od_pairs):
+        #answers a list of (start_id, end_id) pairs with one search per distinct origin, results are in the same order
+        by_origin = defaultdict(set)
+        for start_id, end_id in od_pairs:
+            by_origin[start_id].add(end_id)
+        answers = {start_id: self.routes_from(start_id, end_ids) for start_id, end_ids in by_origin.items()}
+        return [answers[start_id][end_id] for start_id, end_id in od_pairs]
@@ -0,0 +1,68 @@
+#bounded pool for the expensive part of a request (route + folium map), with request coalescing and backpressure
+#identical requests that arrive while one is already queued or running share its future instead of computing again,
+#and once max_pending distinct jobs are waiting new ones are refused straight away (the app answers 503) rather than
+#piling up behind a burst of map renders
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class PoolSaturated(Exception):
+    pass
+
+class ComputePool:
+    def __init__(self, max_workers=4, max_pending=16):
+        #max_pending counts distinct jobs queued or running, coalesced requests don't take a slot
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='compute')
+        self._in_flight = {}    #key -> future of the job computing it
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.completed = 0
+
+    def submit(self, key, function, *args):
+        #future for function(*args), shared with any in flight job for the same key
+        #raises PoolSaturated if a new job is needed and max_pending are already waiting
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if len(self._in_flight) >= self.max_pending:
+                self.rejected += 1
+                raise PoolSaturated(f"{len(self._in_flight)} jobs already pending")
+            future = self._executor.submit(function, *args)
+            self._in_flight[key] = future
+            self.submitted += 1
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+            self.completed += 1
+
+    def run(self, key, function, *args, timeout=None):
+        #blocking version, for the (sync) flask views
+        return self.submit(key, function, *args).result(timeout)
+
+    def pending(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'pending': len(self._in_flight),
+                'submitted': self.submitted,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected,
+                'completed': self.completed,
+            }
@@ -0,0 +1,253 @@
+#hub labels for point to point queries, built from a contraction hierarchy over the (station, line) state graph
+#preprocessing contracts the states one at a time (least important first), adding shortcut edges so distances between
+#the remaining states are preserved. every shortest path then goes "up" the ordering and back "down", so each station
+#stores the states it can reach going up (its forward label) and the states that can reach it coming down (its backward
+#label). a query is just intersecting two labels, the shortcuts on the winning path are expanded afterwards
+#build it offline (python contraction.py), it is saved next to the journey table and reloaded while the model matches
+import os
+import pickle
+from heapq import heappush, heappop
+from setup import *
+from compiled_graph import CompiledGraph
+
+LABELS_FILE = 'hub_labels.pkl'
+LABELS_VERSION = 1
+
+def _witness_distances(out_edges, contracted, source, skip, limit):
+    #dijkstra from source over the states that haven't been contracted yet, ignoring skip, up to limit
+    INF = float('inf')
+    distances = {source: 0}
+    queue = [(0, source)]
+    while queue:
+        distance, state = heappop(queue)
+        if distance > limit:
+            break
+        if distance != distances[state]:
+            continue
+        for target, weight in out_edges[state].items():
+            if target == skip or contracted[target]:
+                continue
+            new_distance = distance + weight
+            if new_distance < distances.get(target, INF):
+                distances[target] = new_distance
+                heappush(queue, (new_distance, target))
+    return distances
+
+def _find_shortcuts(out_edges, in_edges, contracted, state):
+    #the shortcuts needed to contract state: u -> state -> x where no other path from u to x is as short
+    INF = float('inf')
+    shortcuts = []
+    targets = [(x, w) for x, w in out_edges[state].items() if not contracted[x]]
+    if not targets:
+        return shortcuts
+    max_out = max(w for _, w in targets)
+    for u, w1 in in_edges[state].items():
+        if contracted[u]:
+            continue
+        witness = _witness_distances(out_edges, contracted, u, state, w1 + max_out)
+        for x, w2 in targets:
+            if x != u and witness.get(x, INF) > w1 + w2:
+                shortcuts.append((u, x, w1 + w2))
+    return shortcuts
+
+def contract(compiled):
+    #contraction hierarchy over the compiled state graph (weights already include the transfer costs)
+    #returns (up, down, edge_weights, middles):
+    #   up[u] = [(x, weight)] edges (or shortcuts) from u to higher ranked states
+    #   down[x] = [(u, weight)] edges (or shortcuts) into x from higher ranked states
+    #   edge_weights[(u, x)] = cheapest original edge, middles[(u, x)] = the state a shortcut skips over
+    INF = float('inf')
+    n_states = len(compiled.state_station)
+    out_edges = [dict() for _ in range(n_states)]
+    in_edges = [dict() for _ in range(n_states)]
+    edge_weights = {}
+    for u in range(n_states):
+        for k in range(compiled.state_offsets[u], compiled.state_offsets[u + 1]):
+            x, w = compiled.state_targets[k], compiled.state_weights[k]
+            if w < out_edges[u].get(x, INF):
+                out_edges[u][x] = w
+                in_edges[x][u] = w
+                edge_weights[(u, x)] = w
+    contracted = [False] * n_states
+    contracted_neighbours = [0] * n_states
+    middles = {}
+
+    def priority(state):
+        #edge difference plus how many neighbours are already gone, keeps the hierarchy flat and even
+        shortcuts = _find_shortcuts(out_edges, in_edges, contracted, state)
+        degree = sum(1 for x in out_edges[state] if not contracted[x]) + sum(1 for u in in_edges[state] if not contracted[u])
+        return len(shortcuts) - degree + contracted_neighbours[state]
+
+    queue = [(priority(state), state) for state in range(n_states)]
+    queue.sort()
+    rank = [0] * n_states
+    next_rank = 0
+    while queue:
+        _, state = heappop(queue)
+        #lazy update: the priority might be out of date, only contract if it's still the smallest
+        current = priority(state)
+        if queue and current > queue[0][0]:
+            heappush(queue, (current, state))
+            continue
+        for u, x, w in _find_shortcuts(out_edges, in_edges, contracted, state):
+            if w < out_edges[u].get(x, INF):
+                out_edges[u][x] = w
+                in_edges[x][u] = w
+                middles[(u, x)] = state
+        contracted[state] = True
+        rank[state] = next_rank
+        next_rank += 1
+        for neighbour in set(out_edges[state]) | set(in_edges[state]):
+            contracted_neighbours[neighbour] += 1
+
+    up = [sorted((x, w) for x, w in out_edges[u].items() if rank[x] > rank[u]) for u in range(n_states)]
+    down = [sorted((u, w) for u, w in in_edges[x].items() if rank[u] > rank[x]) for x in range(n_states)]
+    return up, down, edge_weights, middles
+
+def _upward_label(sources, adjacency):
+    #multi source dijkstra that only follows adjacency (which only goes up the hierarchy)
+    #returns {state: (distance, parent state or -1)}, the whole search space
+    INF = float('inf')
+    label = {}
+    queue = []
+    for state in sources:
+        label[state] = (0, -1)
+        heappush(queue, (0, state))
+    while queue:
+        distance, state = heappop(queue)
+        if distance != label[state][0]:
+            continue
+        for target, weight in adjacency[state]:
+            new_distance = distance + weight
+            if new_distance < label.get(target, (INF,))[0]:
+                label[target] = (new_distance, state)
+                heappush(queue, (new_distance, target))
+    return label
+
+class HubLabels:
+    def __init__(self, states, forward_labels, backward_labels, edge_weights, middles, fingerprint=None):
+        self.states = states                      #state index -> (station, line), same indices as CompiledGraph
+        self.forward_labels = forward_labels      #station -> {hub state: (distance from station, parent)} or None
+        self.backward_labels = backward_labels    #station -> {hub state: (distance to station, parent)} or None
+        self.edge_weights = edge_weights
+        self.middles = middles
+        self.fingerprint = fingerprint
+
+    @classmethod
+    def build(cls, compiled, fingerprint=None):
+        up, down, edge_weights, middles = contract(compiled)
+        forward_labels = [_upward_label(states, up) if states else None for states in compiled.station_states]
+        backward_labels = [_upward_label(states, down) if states else None for states in compiled.station_states]
+        states = [compiled.state_to_tuple(state) for state in range(len(compiled.state_station))]
+        return cls(states, forward_labels, backward_labels, edge_weights, middles, fingerprint)
+
+    def has_station(self, station):
+        return 0 <= station < len(self.forward_labels) and self.forward_labels[station] is not None
+
+    def label_size(self):
+        #mean number of hubs per station label
+        labels = [label for label in self.forward_labels + self.backward_labels if label is not None]
+        return sum(len(label) for label in labels) / len(labels)
+
+    def _unpack(self, u, x, path):
+        #appends the original states between u and x (excluding u) to path
+        stack = [(u, x)]
+        while stack:
+            a, b = stack.pop()
+            middle = self.middles.get((a, b))
+            if middle is None:
+                path.append(b)
+            else:
+                stack.append((middle, b))
+                stack.append((a, middle))
+
+    def shortest_route(self, start_id, end_id, stats=None):
+        #same return shape as routes.get_shortest_route
+        INF = float('inf')
+        if not self.has_station(start_id) or not self.has_station(end_id):
+            return None, INF
+        forward = self.forward_labels[start_id]
+        backward = self.backward_labels[end_id]
+        if len(backward) < len(forward):
+            small, large = backward, forward
+        else:
+            small, large = forward, backward
+        best, meeting_state = INF, -1
+        for hub, (distance, _) in small.items():
+            other = large.get(hub)
+            if other is not None and distance + other[0] < best:
+                best, meeting_state = distance + other[0], hub
+        if stats is not None:
+            stats['hubs'] = len(small)
+        if meeting_state == -1:
+            return None, INF
+
+        #chain of (possibly shortcut) edges: start ... meeting_state ... end, then expand the shortcuts
+        chain = []
+        state = meeting_state
+        while state != -1:
+            chain.append(state)
+            state = forward[state][1]
+        chain.reverse()
+        state = backward[meeting_state][1]
+        while state != -1:
+            chain.append(state)
+            state = backward[state][1]
+        path = [chain[0]]
+        for u, x in zip(chain, chain[1:]):
+            self._unpack(u, x, path)
+        #add the weights up from the start, in the same order dijkstra does, so the total matches it exactly
+        total = 0
+        for u, x in zip(path, path[1:]):
+            total += self.edge_weights[(u, x)]
+        return [self.states[state] for state in path], total
+
+    def save(self, file_path=LABELS_FILE):
+        with open(file_path, 'wb') as f:
+            pickle.dump((LABELS_VERSION, self.fingerprint, self.states, self.forward_labels, self.backward_labels,
+                         self.edge_weights, self.middles), f)
+
+    @classmethod
+    def load(cls, file_path=LABELS_FILE):
+        with open(file_path, 'rb') as f:
+            version, fingerprint, *data = pickle.load(f)
+        if version != LABELS_VERSION:
+            raise ValueError(f"Hub labels {file_path} have version {version}, expected {LABELS_VERSION}")
+        return cls(*data, fingerprint=fingerprint)
+
+def load_or_build_hub_labels(graph, fingerprint, file_path=LABELS_FILE, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180):
+    #reuse the labels on disk if they were built with the same model, otherwise rebuild them and write them back
+    if os.path.exists(file_path):
+        try:
+            labels = HubLabels.load(file_path)
+            if labels.fingerprint == fingerprint:
+                return labels
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            pass
+    labels = HubLabels.build(CompiledGraph.build(graph, mode, time_function, transfer_time), fingerprint)
+    try:
+        labels.save(file_path)
+    except OSError:
+        pass    #read only filesystem, we just rebuild next time
+    return labels
+
+def verify(labels, compiled, od_pairs):
+    #compares the labels against full dijkstra on the compiled graph, returns the mismatching pairs
+    return [(s, e) for s, e in od_pairs if labels.shortest_route(s, e) != compiled.shortest_route(s, e)]
+
+if __name__ == "__main__":
+    #offline build + full check against dijkstra on every OD pair
+    import time
+    from model import model_transfer_time, model_fingerprint, get_parameters
+    from vectorised_model import make_time_function
+
+    time_function = make_time_function(graph, get_parameters())
+    compiled = CompiledGraph.build(graph, time_function=time_function, transfer_time=model_transfer_time)
+    start = time.perf_counter()
+    labels = HubLabels.build(compiled, (model_fingerprint(), 'time'))
+    print(f'Built hub labels in {time.perf_counter() - start:.2f}s ({len(labels.middles)} shortcuts, {labels.label_size():.1f} hubs per label)')
+    labels.save()
+    mismatches = verify(labels, compiled, [(s, e) for s in graph for e in graph])
+    print(f'Checked {len(graph) ** 2} OD pairs against dijkstra, {len(mismatches)} mismatches')
+    if mismatches:
+        raise SystemExit(1)
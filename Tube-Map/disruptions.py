@@ -0,0 +1,225 @@
+#closures: stations, line segments and whole lines taken out of service, without touching setup.graph
+#a closure is applied to a CompiledGraph by setting the weights of the edges it rules out to inf in place (searches
+#never relax an inf edge), and reopening puts the built weights back, so closing and reopening are both incremental
+#and any number of closures can overlap. what each closure rules out, on the (station, line) edges:
+#  station: changing lines there (and starting or ending there, see is_closed). trains still run through
+#  segment: riding between two adjacent stations, both ways, on one line or all of them
+#  line: riding it at all
+#the time a transfer costs is folded into the ride after it, so the edge (a, L1) -> (b, L2) rides a -> b on L2
+#after changing from L1 at a
+#every process serving the app has its own Disruptions, DisruptionsFile keeps them in step through a file
+import fcntl
+import json
+import os
+from bisect import bisect_right
+from contextlib import contextmanager
+from heapq import heappush, heappop
+from setup import *
+
+class Disruptions:
+    def __init__(self):
+        self.stations = set()
+        self.segments = set()   #(station, station, line or None for every line), smaller station first
+        self.lines = set()
+
+    @staticmethod
+    def _segment(a, b, line=None):
+        return (min(a, b), max(a, b), line)
+
+    def close_station(self, station):
+        self.stations.add(station)
+
+    def reopen_station(self, station):
+        self.stations.discard(station)
+
+    def close_segment(self, a, b, line=None):
+        self.segments.add(self._segment(a, b, line))
+
+    def reopen_segment(self, a, b, line=None):
+        self.segments.discard(self._segment(a, b, line))
+
+    def close_line(self, line):
+        self.lines.add(line)
+
+    def reopen_line(self, line):
+        self.lines.discard(line)
+
+    def clear(self):
+        self.stations.clear()
+        self.segments.clear()
+        self.lines.clear()
+
+    def replace(self, other):
+        #take on another Disruptions' closures
+        self.stations = set(other.stations)
+        self.segments = set(other.segments)
+        self.lines = set(other.lines)
+
+    def __bool__(self):
+        return bool(self.stations or self.segments or self.lines)
+
+    def is_closed(self, station):
+        #no journeys start or end at a closed station
+        return station in self.stations
+
+    def to_dict(self):
+        return {
+            'stations': [{'id': station, 'name': vertex_data[station][0]} for station in sorted(self.stations)],
+            'segments': [{'from': {'id': a, 'name': vertex_data[a][0]}, 'to': {'id': b, 'name': vertex_data[b][0]}, 'line': line}
+                         for a, b, line in sorted(self.segments, key=lambda segment: (segment[0], segment[1], segment[2] or ''))],
+            'lines': sorted(self.lines),
+        }
+
+    def to_json(self):
+        #just the ids, for DisruptionsFile (to_dict is the API's version, with names)
+        return {
+            'stations': sorted(self.stations),
+            'segments': [list(segment) for segment in sorted(self.segments, key=lambda segment: (segment[0], segment[1], segment[2] or ''))],
+            'lines': sorted(self.lines),
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        disruptions = cls()
+        disruptions.stations = set(data.get('stations', []))
+        disruptions.segments = set(cls._segment(*segment) for segment in data.get('segments', []))
+        disruptions.lines = set(data.get('lines', []))
+        return disruptions
+
+    def edge_closed(self, station, line, dest, next_line):
+        #whether the edge (station, line) -> (dest, next_line) is ruled out
+        if next_line in self.lines:
+            return True
+        if line != next_line and station in self.stations:
+            return True
+        segment = (min(station, dest), max(station, dest))
+        return (*segment, next_line) in self.segments or (*segment, None) in self.segments
+
+    def apply(self, compiled):
+        #patch compiled's weights to match the current closures, returns [(edge k, old weight, new weight), ...]
+        #for the edges that changed (what JourneyTable.update and affected_routes take)
+        INF = float('inf')
+        base = compiled.base_weights
+        line_names, state_station, state_line = compiled.line_names, compiled.state_station, compiled.state_line
+        changes = []
+        for state in range(len(state_station)):
+            station, line = state_station[state], line_names[state_line[state]]
+            for k in range(compiled.state_offsets[state], compiled.state_offsets[state + 1]):
+                target = compiled.state_targets[k]
+                weight = INF if self and self.edge_closed(station, line, state_station[target], line_names[state_line[target]]) else base[k]
+                if weight != compiled.state_weights[k]:
+                    changes.append((k, compiled.state_weights[k], weight))
+        compiled.set_edge_weights([(k, new) for k, _, new in changes])
+        return changes
+
+def file_stamp(file_path):
+    #(inode, mtime, size) of a file, or None if it doesn't exist: cheap to compare to tell whether it was rewritten
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+class DisruptionsFile:
+    #the closures shared by every process serving the app (each gunicorn worker has its own Disruptions), as a JSON
+    #file with a version number. a change is made under a lock on top of the latest version and saved as the next
+    #one (written to a temporary file and renamed, so it's never read half written), and each process polls the
+    #file (one stat when nothing changed) before it routes and applies any version newer than its own
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.version = 0        #the version this process has applied, 0 is no closures
+        self._stamp = None      #what the file looked like when it was last read
+
+    def changed(self):
+        return file_stamp(self.file_path) != self._stamp
+
+    def poll(self):
+        #(version, Disruptions) if the file changed since it was last read, otherwise None
+        stamp = file_stamp(self.file_path)
+        if stamp == self._stamp:
+            return None
+        self._stamp = stamp
+        if stamp is None:
+            return 0, Disruptions()
+        with open(self.file_path) as f:
+            data = json.load(f)
+        return data['version'], Disruptions.from_json(data)
+
+    @contextmanager
+    def locked(self):
+        #held while a change is made, so two processes can't both save the same next version
+        with open(self.file_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def save(self, disruptions):
+        #store disruptions as the next version (call it while holding locked())
+        version = self.version + 1
+        temporary_path = f'{self.file_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump({'version': version, **disruptions.to_json()}, f)
+        os.replace(temporary_path, self.file_path)
+        self.version = version
+        self._stamp = file_stamp(self.file_path)
+
+def weight_changes(compiled):
+    #every edge whose weight differs from the built one, as changes like Disruptions.apply returns (e.g. to bring a
+    #journey table built for the open network in line with a graph that has closures applied)
+    base = compiled.base_weights
+    return [(k, base[k], weight) for k, weight in enumerate(compiled.state_weights) if weight != base[k]]
+
+def _multi_source_distances(offsets, targets, weights, sources):
+    #dijkstra from several states at once, sources is {state: starting distance}
+    INF = float('inf')
+    distances = [INF] * (len(offsets) - 1)
+    queue = []
+    for state, distance in sources.items():
+        distances[state] = distance
+        heappush(queue, (distance, state))
+    while queue:
+        current_distance, state = heappop(queue)
+        if current_distance != distances[state]:
+            continue
+        for k in range(offsets[state], offsets[state + 1]):
+            distance = current_distance + weights[k]
+            if distance < distances[targets[k]]:
+                distances[targets[k]] = distance
+                heappush(queue, (distance, targets[k]))
+    return distances
+
+def affected_routes(compiled, changes):
+    #returns affected(start_id, end_id, path, total): whether a route found on compiled before the changes (as
+    #(path, total) like get_shortest_route, path None if there wasn't one) might not be the answer any more
+    #an edge getting dearer only matters to the routes that use it. an edge getting cheaper matters to any route it
+    #could now beat: that's checked against a lower bound on going through any of the cheaper edges, the distance
+    #to the nearest of their tails plus the cheapest of them plus the distance from the nearest of their heads
+    INF = float('inf')
+    dearer = set()
+    cheaper_tails, cheaper_heads = {}, {}
+    cheapest = INF
+    for k, old, new in changes:
+        tail, head = bisect_right(compiled.state_offsets, k) - 1, compiled.state_targets[k]
+        if new > old:
+            dearer.add((tail, head))
+        else:
+            cheaper_tails[tail] = 0
+            cheaper_heads[head] = 0
+            cheapest = min(cheapest, new)
+    if cheaper_tails:
+        to_tails = _multi_source_distances(*compiled._reverse_edges(), cheaper_tails)
+        from_heads = _multi_source_distances(compiled.state_offsets, compiled.state_targets, compiled.state_weights, cheaper_heads)
+
+    def affected(start_id, end_id, path, total):
+        if path and dearer:
+            states = [compiled.state_index[state] for state in path]
+            if any(pair in dearer for pair in zip(states, states[1:])):
+                return True
+        if cheaper_tails:
+            via = (min((to_tails[state] for state in compiled.station_states[start_id]), default=INF) + cheapest
+                   + min((from_heads[state] for state in compiled.station_states[end_id]), default=INF))
+            return via <= total
+        return False
+    return affected
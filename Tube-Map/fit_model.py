@@ -0,0 +1,25 @@
+#offline fitting command, run from this folder after changing any of the model inputs:
+#   python fit_model.py
+#this refits the relative line speeds against primary_data.txt and writes them to fitted_parameters.json,
+#which model.py loads at startup instead of fitting on every import
+import argparse
+import model
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the journey time model and save its parameters")
+    parser.add_argument('--output', default=model.PARAMETERS_FILE, help="where to write the fitted parameters")
+    parser.add_argument('--force', action='store_true', help="refit even if the model was just refitted on import")
+    parser.add_argument('--joint', action='store_true', help="fit the line speeds and both distance coefficients together")
+    parser.add_argument('--ternary', action='store_true', help="use the original ternary search (model.fine_tune) instead of the batched engine")
+    args = parser.parse_args()
+
+    if model.parameters_source == 'fitted' and not (args.force or args.joint or args.ternary):
+        #importing model already refitted because the saved parameters were stale
+        model.save_parameters(args.output)
+    elif args.ternary:
+        model.fine_tune()
+        model.save_parameters(args.output)
+    else:
+        model.fit_parameters(args.output, joint=args.joint)
+    print(f'Total Squared Error: {model.get_loss()}')
+    print(f'Saved parameters to {args.output} (data checksum {model.data_checksum()[:12]})')
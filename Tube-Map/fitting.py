@@ -0,0 +1,110 @@
+#fitting engine for the journey time model
+#model.fine_tune does a ternary search per line where every step clears the caches and re-runs get_forced_route for
+#every row of primary_data.txt. here each observation's forced route is worked out once and stored as a row of an
+#(observations x edges) incidence matrix, so the modelled time of every observation is edge_times @ incidence.T and
+#the loss of thousands of candidate parameter vectors is one batched numpy expression
+import numpy as np
+from setup import *
+from routes import get_forced_route
+from vectorised_model import EdgeArrays, get_edge_times
+
+RELATIVE_SPEED_BOUNDS = (0, 3)    #same range the ternary search used
+COEFFICIENT_BOUNDS = {
+    'distance_base_coefficient': (0.05, 0.25),
+    'distance_relevance_coefficient': (0, 1),
+}
+
+class FittingProblem:
+    def __init__(self, graph, observations):
+        #observations are model.formatted_data rows: (start station name, end station name, line, seconds)
+        self.edges = EdgeArrays(graph)
+        self.line_names = self.edges.line_names
+        edge_lookup = {}
+        for k in range(len(self.edges)):
+            edge_lookup.setdefault((int(self.edges.sources[k]), int(self.edges.targets[k]), self.line_names[self.edges.line_ids[k]]), k)
+
+        self.incidence = np.zeros((len(observations), len(self.edges)))
+        for i, (start_station, end_station, line, _) in enumerate(observations):
+            route = get_forced_route(graph, vertex_ID[start_station], vertex_ID[end_station], line)[0]
+            for (station, station_line), (next_station, _) in zip(route, route[1:]):
+                self.incidence[i, edge_lookup[(station, next_station, station_line)]] += 1
+        self.observed = np.array([seconds for *_, seconds in observations], dtype=float)
+        #only the edges some observation rides on affect the loss, so drop the rest
+        used = np.flatnonzero(self.incidence.any(axis=0))
+        self.edges = self.edges.take(used)
+        self.incidence = self.incidence[:, used]
+
+    #parameter vectors are [relative speeds in line_names order..., distance_base_coefficient, distance_relevance_coefficient]
+    def to_vector(self, parameters):
+        return np.array([parameters['relative_speeds'][line] for line in self.line_names]
+                        + [parameters['distance_base_coefficient'], parameters['distance_relevance_coefficient']])
+
+    def to_parameters(self, vectors):
+        n_lines = len(self.line_names)
+        return {
+            'relative_speeds': vectors[..., :n_lines],
+            'distance_base_coefficient': vectors[..., n_lines],
+            'distance_relevance_coefficient': vectors[..., n_lines + 1],
+        }
+
+    def to_dict(self, vector):
+        #back to the model.get_parameters() format
+        n_lines = len(self.line_names)
+        return {
+            'relative_speeds': {line: float(vector[i]) for i, line in enumerate(self.line_names)},
+            'distance_base_coefficient': float(vector[n_lines]),
+            'distance_relevance_coefficient': float(vector[n_lines + 1]),
+        }
+
+    def coordinate_bounds(self, coordinate):
+        n_lines = len(self.line_names)
+        if coordinate < n_lines:
+            return RELATIVE_SPEED_BOUNDS
+        return COEFFICIENT_BOUNDS[['distance_base_coefficient', 'distance_relevance_coefficient'][coordinate - n_lines]]
+
+    def route_times(self, vectors):
+        #modelled time of every observation, shape (..., observations)
+        return get_edge_times(self.edges, self.to_parameters(vectors)) @ self.incidence.T
+
+    def loss(self, vectors):
+        #total squared error, one value per parameter vector
+        residuals = self.route_times(vectors) - self.observed
+        return (residuals ** 2).sum(axis=-1)
+
+    def line_search(self, vector, coordinate, grid_size=101, tolerance=1e-6):
+        #minimise over one coordinate with the rest fixed: evaluate a whole grid in one batch,
+        #then zoom in around the best point until the grid spacing is below tolerance
+        low, high = self.coordinate_bounds(coordinate)
+        best_value, best_loss = vector[coordinate], self.loss(vector)
+        while True:
+            candidates = np.tile(vector, (grid_size, 1))
+            grid = np.linspace(low, high, grid_size)
+            candidates[:, coordinate] = grid
+            with np.errstate(divide='ignore', invalid='ignore'):    #a speed of 0 at the edge of the grid gives inf times
+                losses = np.nan_to_num(self.loss(candidates), nan=np.inf)
+            best = int(np.argmin(losses))
+            if losses[best] < best_loss:
+                best_value, best_loss = grid[best], losses[best]
+            step = (high - low) / (grid_size - 1)
+            if step < tolerance:
+                break
+            low, high = max(low, best_value - step), min(high, best_value + step)
+        result = vector.copy()
+        result[coordinate] = best_value
+        return result
+
+    def fit(self, parameters, joint=False, max_sweeps=20, tolerance=1e-9):
+        #joint=False: one pass over the line speeds in order, like fine_tune
+        #joint=True: coordinate descent over every line speed and both distance coefficients until the loss stops improving
+        vector = self.to_vector(parameters)
+        n_lines = len(self.line_names)
+        coordinates = list(range(n_lines + 2)) if joint else list(range(n_lines))
+        previous_loss = self.loss(vector)
+        for _ in range(max_sweeps if joint else 1):
+            for coordinate in coordinates:
+                vector = self.line_search(vector, coordinate)
+            current_loss = self.loss(vector)
+            if previous_loss - current_loss <= tolerance * previous_loss:
+                break
+            previous_loss = current_loss
+        return self.to_dict(vector)
@@ -0,0 +1,22 @@
+#gunicorn settings, picked up automatically when serving from this folder:
+#   gunicorn main:app --workers 8
+#the app is imported once in the master (network.bin, fitted parameters, journey table, static base map) and
+#every compiled graph is built there too, then the workers are forked and share all of it copy-on-write
+#instead of each one loading its own copy
+import gc
+
+preload_app = True
+#threaded workers: each request gets a thread, which hands its map render to the app's render pool and waits on it.
+#with the default sync workers a worker only ever has one request in flight, so identical requests could never
+#share a render and the pool's 503 backpressure could never fire. threads is above MAX_PENDING_RENDERS so a burst
+#fills the pool's queue and the rest get the 503 straight away instead of waiting for a free thread
+worker_class = 'gthread'
+threads = 32
+
+def when_ready(server):
+    #runs in the master after the app is imported and before any worker is forked
+    from app import warm_up
+    warm_up()
+    #park everything loaded so far in the permanent generation: otherwise the first collection in each worker
+    #writes to the header of every object it scans, which copies (un-shares) nearly all of the pages
+    gc.freeze()
@@ -0,0 +1,154 @@
+#opt-in instrumentation: time spent in each stage of a request, what the searches did (heap pushes and pops, settled
+#states, weight callbacks) and how the caches are doing, in the prometheus text format for the app's /metrics
+#it's off unless TUBE_METRICS=1 is set, and then every hook returns straight away (stage() hands back one shared
+#do-nothing context manager), so the hot paths pay next to nothing for it
+#TUBE_PROFILE_DIR=<folder> separately lets a request ask for a cProfile dump of itself, with the TUBE_PROFILE_TOKEN
+#in an X-Profile header (see the app)
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+ENABLED = os.environ.get('TUBE_METRICS', '') not in ('', '0')
+PROFILE_DIR = os.environ.get('TUBE_PROFILE_DIR') or None
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+STATES_BUCKETS = (10, 30, 100, 300, 1000, 3000)
+
+class Metrics:
+    #counters and histograms keyed by (name, labels), plus collectors that report gauges and counters kept
+    #elsewhere (cache stats, pool stats) when the metrics are read, so nothing has to be pushed into here
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._kinds = {}         #name -> (type, help)
+        self._counters = {}      #(name, labels) -> value
+        self._histograms = {}    #(name, labels) -> [count per bucket..., sum, count]
+        self._buckets = {}       #histogram name -> bucket upper bounds
+        self._collectors = []    #functions returning [(name, type, help, labels dict, value), ...]
+
+    def inc(self, name, amount=1, help='', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._kinds.setdefault(name, ('counter', help))
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, help='', buckets=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._kinds.setdefault(name, ('histogram', help))
+            bounds = self._buckets.setdefault(name, buckets)
+            row = self._histograms.get(key)
+            if row is None:
+                row = self._histograms[key] = [0] * (len(bounds) + 2)
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        #everything in the prometheus text exposition format (version 0.0.4)
+        samples = {}    #name -> (type, help, [(suffix, labels, value), ...])
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, (*self._kinds[name], []))[2].append(('', labels, value))
+            for (name, labels), row in self._histograms.items():
+                rows = samples.setdefault(name, (*self._kinds[name], []))[2]
+                for bound, count in zip(self._buckets[name], row):
+                    rows.append(('_bucket', labels + (('le', _number(bound)),), count))
+                rows.append(('_bucket', labels + (('le', '+Inf'),), row[-1]))
+                rows.append(('_sum', labels, row[-2]))
+                rows.append(('_count', labels, row[-1]))
+        for collector in self._collectors:
+            for name, kind, help, labels, value in collector():
+                samples.setdefault(name, (kind, help, []))[2].append(('', tuple(sorted(labels.items())), value))
+        lines = []
+        for name in sorted(samples):
+            kind, help, rows = samples[name]
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in rows:
+                label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+                lines.append(f"{name}{suffix}{{{label_text}}} {_number(value)}" if labels else f"{name}{suffix} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+_off = nullcontext()
+
+@contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('tube_stage_seconds', time.perf_counter() - start, 'Time spent in each stage of a request', stage=name)
+
+def stage(name):
+    #with stage('map html'): ... records how long the block took, when instrumentation is on
+    return _timed_stage(name) if ENABLED else _off
+
+def record_search(search, stats):
+    #one search's counters (a stats dict as the searches fill in: settled, pushes, pops, weight_calls)
+    if not ENABLED or stats is None:
+        return
+    metrics.inc('tube_search_queries_total', 1, 'Searches run', search=search)
+    for key in ('settled', 'pushes', 'pops', 'weight_calls'):
+        if key in stats:
+            metrics.inc(f'tube_search_{key}_total', stats[key], f'Total {key.replace("_", " ")} over all searches', search=search)
+    if 'settled' in stats:
+        metrics.observe('tube_search_settled_states', stats['settled'], 'States settled per search', STATES_BUCKETS, search=search)
+
+def cache_info_collector(functions):
+    #hit rates of functools caches, {label: cached function}, read when the metrics are
+    def collect():
+        rows = []
+        for label, function in functions.items():
+            info = function.cache_info()
+            lookups = info.hits + info.misses
+            rows.append(('tube_model_cache_hits_total', 'counter', 'functools cache hits in model.py', {'function': label}, info.hits))
+            rows.append(('tube_model_cache_misses_total', 'counter', 'functools cache misses in model.py', {'function': label}, info.misses))
+            rows.append(('tube_model_cache_entries', 'gauge', 'Entries in the functools caches in model.py', {'function': label}, info.currsize))
+            rows.append(('tube_model_cache_hit_ratio', 'gauge', 'Hits per lookup since the cache was last cleared', {'function': label}, info.hits / lookups if lookups else 0.0))
+        return rows
+    return collect
+
+def stats_collector(prefix, stats_function, counters=(), help=''):
+    #a stats() dict (like RouteCache.stats or ComputePool.stats) as <prefix>_<key> gauges, or counters for the
+    #keys in counters
+    def collect():
+        rows = []
+        for key, value in stats_function().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                kind = 'counter' if key in counters else 'gauge'
+                rows.append((f'{prefix}_{key}_total' if kind == 'counter' else f'{prefix}_{key}', kind, f'{help} {key.replace("_", " ")}', {}, value))
+        return rows
+    return collect
+
+def start_profile():
+    #a running profiler for one request, or None if profiling isn't set up
+    if PROFILE_DIR is None:
+        return None
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def finish_profile(profiler, name):
+    #stop the profiler and dump its stats (for pstats or snakeviz) to PROFILE_DIR, returns the file's path
+    profiler.disable()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    file_path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}-{time.perf_counter_ns()}.prof")
+    profiler.dump_stats(file_path)
+    return file_path
@@ -0,0 +1,219 @@
+#precomputed all-pairs journey times
+#the network is tiny (~270 stations, ~380 (station, line) states) so we can afford to run one full dijkstra per station up front,
+#then every query is just a lookup plus a walk back up the stored dijkstra tree
+import os
+import pickle
+from array import array
+from bisect import bisect_right
+from heapq import heappush, heappop
+from setup import *
+from compiled_graph import CompiledGraph
+
+JOURNEY_TABLE_FILE = 'journey_table.pkl'
+JOURNEY_TABLE_VERSION = 1
+
+class JourneyTable:
+    def __init__(self, states, distances, predecessors, fingerprint=None):
+        #states is the dense list of (station, line) states, distances[source][state] and predecessors[source][state] are indexed by it
+        #predecessors are state indices, -1 means no parent
+        self.states = states
+        self.state_index = {state: i for i, state in enumerate(states)}
+        self.distances = distances
+        self.predecessors = predecessors
+        self.fingerprint = fingerprint
+        self.station_states = defaultdict(list)  #station -> state indices, sorted by line so ties break the same way as the heap
+        for i, (station, line) in enumerate(states):
+            self.station_states[station].append(i)
+
+    @classmethod
+    def build(cls, graph, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180, fingerprint=None):
+        compiled = CompiledGraph.build(graph, mode, time_function, transfer_time)
+        states = [compiled.state_to_tuple(i) for i in range(len(compiled.state_station))]
+        distances = {}
+        predecessors = {}
+        for source in graph:
+            tree_distances, tree_predecessors = compiled.shortest_tree(source)
+            distances[source] = array('d', tree_distances)
+            predecessors[source] = tree_predecessors
+        return cls(states, distances, predecessors, fingerprint)
+
+    def update(self, compiled, changes):
+        #bring the table up to date after some edge weights of compiled (the graph the table was built from) changed,
+        #e.g. closures from disruptions.py. changes is [(edge k, old weight, new weight), ...]
+        #rather than searching every row again, each row's tree is repaired where it can have changed: when a tree edge
+        #gets dearer, the subtree under it loses its distances and is searched again from the rest of the tree, and when
+        #an edge gets cheaper and beats the tree's way into its target, the search carries on from there
+        #returns {origin: set of destinations whose route changed}
+        tails = [bisect_right(compiled.state_offsets, k) - 1 for k, _, _ in changes]
+        heads = [compiled.state_targets[k] for k, _, _ in changes]
+        dearer = [(tail, head) for tail, head, (_, old, new) in zip(tails, heads, changes) if new > old]
+        cheaper = [(tail, head, new) for tail, head, (_, old, new) in zip(tails, heads, changes) if new < old]
+        affected = {}
+        for source in self.distances:
+            row_distances, row_predecessors = self.distances[source], self.predecessors[source]
+            roots = [head for tail, head in dearer if row_predecessors[head] == tail]
+            improved = [(tail, head, weight) for tail, head, weight in cheaper if row_distances[tail] + weight < row_distances[head]]
+            if not roots and not improved:
+                continue
+            new_distances, new_predecessors = array('d', row_distances), array('i', row_predecessors)
+            touched = self._repair(compiled, new_distances, new_predecessors, roots, improved)
+            changed = self._changed_destinations(row_distances, row_predecessors, new_distances, new_predecessors, touched)
+            self.distances[source] = new_distances    #whole rows are swapped in, so a lookup never sees half a repair
+            self.predecessors[source] = new_predecessors
+            if changed:
+                affected[source] = changed
+        return affected
+
+    def _repair(self, compiled, distances, predecessors, roots, improved):
+        #fixes one row in place (see update), returns the states whose distance or parent may have changed
+        INF = float('inf')
+        offsets, targets, weights = compiled.state_offsets, compiled.state_targets, compiled.state_weights
+        queue = []
+        touched = set()
+        if roots:
+            children = [[] for _ in range(len(self.states))]
+            for state, parent in enumerate(predecessors):
+                if parent != -1:
+                    children[parent].append(state)
+            stack = list(roots)
+            while stack:
+                state = stack.pop()
+                if state not in touched:
+                    touched.add(state)
+                    stack.extend(children[state])
+            for state in touched:
+                distances[state] = INF
+                predecessors[state] = -1
+            #the way back into the subtree from the rest of the tree
+            reverse_offsets, reverse_sources, reverse_weights = compiled._reverse_edges()
+            for state in touched:
+                for k in range(reverse_offsets[state], reverse_offsets[state + 1]):
+                    distance = distances[reverse_sources[k]] + reverse_weights[k]
+                    if distance < distances[state]:
+                        distances[state] = distance
+                        predecessors[state] = reverse_sources[k]
+                if distances[state] < INF:
+                    heappush(queue, (distances[state], state))
+        for tail, head, weight in improved:
+            if distances[tail] + weight < distances[head]:
+                distances[head] = distances[tail] + weight
+                predecessors[head] = tail
+                touched.add(head)
+                heappush(queue, (distances[head], head))
+        while queue:
+            current_distance, state = heappop(queue)
+            if current_distance != distances[state]:
+                continue
+            for k in range(offsets[state], offsets[state + 1]):
+                distance = current_distance + weights[k]
+                target = targets[k]
+                if distance < distances[target]:
+                    distances[target] = distance
+                    predecessors[target] = state
+                    touched.add(target)
+                    heappush(queue, (distance, target))
+        return touched
+
+    def _changed_destinations(self, old_distances, old_predecessors, new_distances, new_predecessors, touched):
+        #stations whose route (the path to their best state) differs between two rows. a path is the same if its
+        #best state is and none of the touched states along it changed distance or parent. a station with no touched
+        #state can't have changed (whenever a state changes, the repair touches everything below it)
+        INF = float('inf')
+        dirty = [None] * len(self.states)
+        def is_dirty(state):
+            chain = []
+            while state != -1 and dirty[state] is None:
+                chain.append(state)
+                state = new_predecessors[state]
+            result = False if state == -1 else dirty[state]
+            for state in reversed(chain):
+                result = result or state in touched and (old_distances[state] != new_distances[state] or old_predecessors[state] != new_predecessors[state])
+                dirty[state] = result
+            return result
+        def best_state(row_distances, station):
+            best = None
+            for i in self.station_states[station]:
+                if best is None or row_distances[i] < row_distances[best]:
+                    best = i
+            return best if best is not None and row_distances[best] < INF else None
+        changed = set()
+        for station in set(self.states[state][0] for state in touched):
+            old_best, new_best = best_state(old_distances, station), best_state(new_distances, station)
+            if old_best != new_best or (new_best is not None and is_dirty(new_best)):
+                changed.add(station)
+        return changed
+
+    def get_route(self, start_id, end_id):
+        #same return shape as get_shortest_route: (path, total weight), or (None, inf)
+        INF = float('inf')
+        if start_id not in self.distances or end_id not in self.station_states:
+            return None, INF
+        row_distances = self.distances[start_id]
+        best = None
+        for i in self.station_states[end_id]:
+            if best is None or row_distances[i] < row_distances[best]:
+                best = i
+        if best is None or row_distances[best] == INF:
+            return None, INF
+        row_predecessors = self.predecessors[start_id]
+        path = []
+        current = best
+        while current != -1:
+            path.append(self.states[current])
+            current = row_predecessors[current]
+        return path[::-1], row_distances[best]
+
+    def get_time(self, start_id, end_id):
+        #just the modelled time, without building the path
+        INF = float('inf')
+        if start_id not in self.distances or end_id not in self.station_states:
+            return INF
+        row_distances = self.distances[start_id]
+        return min((row_distances[i] for i in self.station_states[end_id]), default=INF)
+
+    def travel_times(self, start_id):
+        #modelled time from start_id to every reachable station, {station: time}, straight out of the stored tree
+        INF = float('inf')
+        if start_id not in self.distances:
+            return {}
+        travel_times = {}
+        for station in self.station_states:
+            time = self.get_time(start_id, station)
+            if time < INF:
+                travel_times[station] = time
+        return travel_times
+
+    def save(self, file_path=JOURNEY_TABLE_FILE):
+        #renamed into place once it's written, so another process loading it never sees half a table
+        temp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump((JOURNEY_TABLE_VERSION, self.fingerprint, self.states, self.distances, self.predecessors), f)
+        os.replace(temp_path, file_path)
+
+    @classmethod
+    def load(cls, file_path=JOURNEY_TABLE_FILE):
+        with open(file_path, 'rb') as f:
+            version, fingerprint, states, distances, predecessors = pickle.load(f)
+        if version != JOURNEY_TABLE_VERSION:
+            raise ValueError(f"Journey table {file_path} has version {version}, expected {JOURNEY_TABLE_VERSION}")
+        return cls(states, distances, predecessors, fingerprint)
+
+def load_or_build_journey_table(graph, fingerprint, file_path=JOURNEY_TABLE_FILE, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180, time_function_factory=None):
+    #reuse the table on disk if it was built with the same model, otherwise rebuild it and write it back
+    #time_function_factory (no arguments, returns a time_function) can be given instead of time_function, so whatever
+    #it needs (e.g. numpy for the vectorised model) is only loaded when the table actually has to be rebuilt
+    if os.path.exists(file_path):
+        try:
+            table = JourneyTable.load(file_path)
+            if table.fingerprint == fingerprint:
+                return table
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            pass
+    if time_function_factory is not None:
+        time_function = time_function_factory()
+    table = JourneyTable.build(graph, mode, time_function, transfer_time, fingerprint)
+    try:
+        table.save(file_path)
+    except OSError:
+        pass    #read only filesystem, we just rebuild next time
+    return table
@@ -0,0 +1,130 @@
+#load test for the map endpoints, run from this folder:
+#   python load_test.py                          (starts a local threaded server on a free port)
+#   python load_test.py --url http://host:8000   (against a server that's already running, e.g. gunicorn)
+#clients pick origin/destination pairs from a small hot set, so a lot of requests are identical and in flight together
+#(like a popular route being shared), and report throughput, tail latency and the status codes that came back
+import argparse
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from benchmarks import percentile
+
+SERVER = """
+import sys
+from werkzeug.serving import run_simple
+from app import app
+run_simple('127.0.0.1', int(sys.argv[1]), app, threaded=True)
+"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(timeout=120):
+    #local server in a subprocess (so it doesn't share a GIL with the clients), returns (process, url) once it answers
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-c', SERVER, str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url + '/static/style.css', timeout=1).read()
+            return process, url
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit('The server exited before it started answering')
+            time.sleep(0.2)
+    process.kill()
+    raise SystemExit(f'The server did not answer within {timeout}s')
+
+def make_request(url, endpoint, start, end):
+    #one request, returns (status, seconds)
+    if endpoint == 'map':
+        request = urllib.request.Request(url + '/', data=urllib.parse.urlencode({'start_station': start, 'end_station': end}).encode())
+    elif endpoint == 'isochrone':
+        request = urllib.request.Request(url + '/isochrone?' + urllib.parse.urlencode({'start': start, 'minutes': 20}))
+    else:
+        request = urllib.request.Request(url + '/api/route?' + urllib.parse.urlencode({'start': start, 'end': end}))
+    begin = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        error.read()
+        status = error.code
+    except OSError:
+        status = 0    #connection refused/reset or timed out
+    return status, time.perf_counter() - begin
+
+def run_load(url, endpoint, pairs, concurrency, n_requests, seed=0):
+    rng = random.Random(seed)
+    workload = [rng.choice(pairs) for _ in range(n_requests)]
+    results = []
+    lock = threading.Lock()
+    position = 0
+    def client():
+        nonlocal position
+        while True:
+            with lock:
+                if position >= len(workload):
+                    return
+                start, end = workload[position]
+                position += 1
+            result = make_request(url, endpoint, start, end)
+            with lock:
+                results.append(result)
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+
+    statuses = {}
+    for status, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    ok = [seconds for status, seconds in results if status == 200]
+    report = {'requests': len(results), 'seconds': elapsed, 'throughput_rps': len(ok) / elapsed}
+    if ok:
+        report.update({'p50_ms': percentile(ok, 50) * 1000, 'p90_ms': percentile(ok, 90) * 1000,
+                       'p99_ms': percentile(ok, 99) * 1000, 'max_ms': max(ok) * 1000})
+    return report, statuses
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the route map endpoints")
+    parser.add_argument('--url', help="server to test, by default one is started locally")
+    parser.add_argument('--endpoint', choices=['map', 'isochrone', 'api'], default='map')
+    parser.add_argument('--concurrency', type=int, default=16, help="number of clients sending requests at once")
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--hot-pairs', type=int, default=8, help="how many distinct origin/destination pairs the clients pick from")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from setup import vertex_data
+    rng = random.Random(args.seed)
+    names = sorted(name for name, _, _ in vertex_data.values())
+    pairs = [tuple(rng.sample(names, 2)) for _ in range(args.hot_pairs)]
+
+    process = None
+    url = args.url
+    if url is None:
+        process, url = start_server()
+    try:
+        make_request(url, args.endpoint, *pairs[0])    #warm up (first render imports folium's templates)
+        report, statuses = run_load(url, args.endpoint, pairs, args.concurrency, args.requests, args.seed)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    print(f"{args.endpoint}: {args.requests} requests, {args.concurrency} clients, {args.hot_pairs} distinct pairs")
+    print("  ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in report.items()))
+    print("status codes: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
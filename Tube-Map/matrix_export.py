@@ -0,0 +1,203 @@
+#the full station x station matrices for analysis: modelled journey time, number of transfers and the line of the
+#first leg, exported as .npy files that are read back memory-mapped (no copy, no parsing)
+#   python matrix_export.py                  (rebuilds journey_matrix/ if the model changed since it was written)
+#   python matrix_export.py --workers 4 --force
+#   python matrix_export.py --scaling        (throughput with 1, 2, ... processes)
+#every origin is one single source search on the time CompiledGraph, fanned out over a process pool in chunks of
+#origins. the output files are preallocated and every worker writes its rows straight into them, so nothing but
+#row counts goes back through the pool
+#the matrices are indexed by station id: times[a, b] in seconds (inf if unreachable), transfers[a, b] (-1 if
+#unreachable) and first_line[a, b] as an index into the lines in meta.json (-1 if there's no leg, e.g. a == b)
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import numpy as np
+from setup import *
+
+MATRIX_DIR = 'journey_matrix'
+MATRIX_VERSION = 1
+MATRICES = {'times': np.float64, 'transfers': np.int16, 'first_line': np.int8}
+
+_worker = {}    #per process: the compiled graph and the output files opened for writing
+
+def _build_graph():
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph
+    return CompiledGraph.build(graph, time_function=make_time_function(graph, get_parameters()), transfer_time=model_transfer_time)
+
+def _init_worker(directory, compiled=None):
+    #with fork the parent's graph comes along for free, otherwise (spawn) each worker builds its own
+    _worker['compiled'] = compiled if compiled is not None else _worker.get('compiled') or _build_graph()
+    _worker['outputs'] = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r+') for name in MATRICES}
+
+def origin_rows(compiled, origin):
+    #(times, transfers, first_line) rows for one origin from one search. a route's legs are the runs of the same
+    #line along its states after the first (the first state can be on a line that's never ridden, like route_legs),
+    #so the leg count and first line of every state follow from its parent's in one pass over the tree
+    n_stations = len(compiled.station_states)
+    times = np.full(n_stations, np.inf)
+    transfers = np.full(n_stations, -1, dtype=np.int16)
+    first_line = np.full(n_stations, -1, dtype=np.int8)
+    if not compiled.has_station(origin):
+        return times, transfers, first_line
+    distances, predecessors = compiled.shortest_tree(origin)
+    state_line = compiled.state_line
+    legs = [None] * len(distances)           #(number of legs, first line) per state
+    for state in range(len(distances)):
+        chain = []
+        while state != -1 and legs[state] is None:
+            chain.append(state)
+            state = predecessors[state]
+        for state in reversed(chain):
+            parent = predecessors[state]
+            if parent == -1:
+                legs[state] = (0, -1)
+            elif predecessors[parent] == -1:
+                legs[state] = (1, state_line[state])
+            else:
+                count, line = legs[parent]
+                legs[state] = (count + (state_line[state] != state_line[parent]), line)
+    for station in range(n_stations):
+        best = -1
+        for state in compiled.station_states[station]:    #sorted by line, so ties break like routes_from
+            if distances[state] < float('inf') and (best == -1 or distances[state] < distances[best]):
+                best = state
+        if best != -1:
+            times[station] = distances[best]
+            transfers[station] = max(0, legs[best][0] - 1)
+            first_line[station] = legs[best][1]
+    return times, transfers, first_line
+
+def _export_chunk(origins):
+    compiled, outputs = _worker['compiled'], _worker['outputs']
+    for origin in origins:
+        for name, row in zip(MATRICES, origin_rows(compiled, origin)):
+            outputs[name][origin] = row
+    for output in outputs.values():
+        output.flush()
+    return len(origins)
+
+def export_matrices(directory=MATRIX_DIR, workers=None, chunk_size=16, compiled=None):
+    #writes the matrices and meta.json into directory (replacing what's there once they're complete), returns the
+    #number of origins per second
+    from model import model_fingerprint
+    workers = workers or os.cpu_count() or 1
+    compiled = compiled or _build_graph()
+    n_stations = len(compiled.station_states)
+    partial = directory.rstrip(os.sep) + '.partial'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    for name, dtype in MATRICES.items():
+        np.lib.format.open_memmap(os.path.join(partial, f'{name}.npy'), mode='w+', dtype=dtype, shape=(n_stations, n_stations)).flush()
+
+    start = time.perf_counter()
+    origins = list(range(n_stations))
+    chunks = [origins[i:i + chunk_size] for i in range(0, n_stations, chunk_size)]
+    if workers == 1:
+        _init_worker(partial, compiled)
+        for chunk in chunks:
+            _export_chunk(chunk)
+    else:
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+        _worker['compiled'] = compiled    #what forked workers inherit
+        with context.Pool(workers, initializer=_init_worker, initargs=(partial,)) as pool:
+            for _ in pool.imap_unordered(_export_chunk, chunks):
+                pass
+    _worker.clear()
+    elapsed = time.perf_counter() - start
+
+    with open(os.path.join(partial, 'meta.json'), 'w') as f:
+        json.dump({
+            'version': MATRIX_VERSION,
+            'fingerprint': model_fingerprint(),
+            'stations': [vertex_data[station][0] if compiled.has_station(station) else None for station in range(n_stations)],
+            'lines': compiled.line_names,
+            'built': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }, f, indent=1)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(partial, directory)
+    return n_stations / elapsed
+
+class JourneyMatrix:
+    #the exported matrices, memory-mapped read only: indexing them reads straight from the page cache, and
+    #processes that load the same files share those pages
+    def __init__(self, directory=MATRIX_DIR):
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != MATRIX_VERSION:
+            raise ValueError(f"Journey matrix {directory} has version {meta['version']}, expected {MATRIX_VERSION}")
+        self.fingerprint = meta['fingerprint']
+        self.stations = meta['stations']
+        self.lines = meta['lines']
+        self.times = np.load(os.path.join(directory, 'times.npy'), mmap_mode='r')
+        self.transfers = np.load(os.path.join(directory, 'transfers.npy'), mmap_mode='r')
+        self.first_line = np.load(os.path.join(directory, 'first_line.npy'), mmap_mode='r')
+
+    def is_current(self):
+        #whether it was exported with the model that's loaded now
+        from model import model_fingerprint
+        return self.fingerprint == model_fingerprint()
+
+    def journey(self, start_id, end_id):
+        #(seconds, transfers, first line name or None), like a row of the table an analyst would look at
+        line = int(self.first_line[start_id, end_id])
+        return float(self.times[start_id, end_id]), int(self.transfers[start_id, end_id]), self.lines[line] if line >= 0 else None
+
+def is_stale(directory=MATRIX_DIR):
+    try:
+        return not JourneyMatrix(directory).is_current()
+    except (OSError, ValueError, KeyError):
+        return True
+
+def check(directory=MATRIX_DIR, n_pairs=2000):
+    #compares the exported matrices with routes from the journey table, returns the number of mismatches
+    import random
+    from app import journey_table
+    from routes import route_legs
+    matrix = JourneyMatrix(directory)
+    rng = random.Random(0)
+    stations = sorted(graph)
+    mismatches = 0
+    for _ in range(n_pairs):
+        start_id, end_id = rng.choice(stations), rng.choice(stations)
+        path, total = journey_table.get_route(start_id, end_id)
+        legs = route_legs(path)
+        expected = (total, max(0, len(legs) - 1), legs[0][0] if legs else None)
+        mismatches += matrix.journey(start_id, end_id) != expected
+    return mismatches
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the station x station journey matrices as memory-mappable .npy files")
+    parser.add_argument('--out', default=MATRIX_DIR, help=f"output folder (default {MATRIX_DIR})")
+    parser.add_argument('--workers', type=int, default=None, help="processes to use (default: every core)")
+    parser.add_argument('--chunk', type=int, default=16, help="origins per task (default 16)")
+    parser.add_argument('--force', action='store_true', help="export even if the matrices are up to date")
+    parser.add_argument('--check', action='store_true', help="compare the export with the journey table afterwards")
+    parser.add_argument('--scaling', action='store_true', help="report throughput for 1 up to --workers processes instead")
+    args = parser.parse_args()
+
+    if args.scaling:
+        compiled = _build_graph()
+        baseline = None
+        scratch = args.out.rstrip(os.sep) + '.scaling'
+        reference = None
+        for workers in range(1, (args.workers or os.cpu_count() or 1) + 1):
+            rate = max(export_matrices(scratch, workers, args.chunk, compiled) for _ in range(3))
+            baseline = baseline or rate
+            times = np.array(JourneyMatrix(scratch).times)
+            identical = reference is None or np.array_equal(times, reference)
+            reference = times if reference is None else reference
+            print(f"{workers:3d} processes  {rate:8.0f} origins/s  {rate / baseline:5.2f}x  {'same output' if identical else 'OUTPUT DIFFERS'}")
+        shutil.rmtree(scratch, ignore_errors=True)
+    elif not args.force and not is_stale(args.out):
+        print(f"{args.out} is up to date with the current model (use --force to export anyway)")
+    else:
+        rate = export_matrices(args.out, args.workers, args.chunk)
+        matrix = JourneyMatrix(args.out)
+        print(f"exported {matrix.times.shape[0]}x{matrix.times.shape[1]} matrices to {args.out} ({rate:.0f} origins/s)")
+    if args.check:
+        print(f"{check(args.out)} mismatches against the journey table")
@@ -1,6 +1,14 @@
 from setup import *
 from routes import *
 from functools import *
+import hashlib
+import json
+import os
+
+PARAMETERS_FILE = 'fitted_parameters.json'
+PARAMETERS_VERSION = 1
+#everything the fit depends on, if any of these change the saved parameters are stale
+MODEL_INPUT_FILES = ['primary_data.txt', 'average_dwell_times.txt', 'london_tube_vertices.txt', 'london_tube_edge_list.txt']
 
 relative_speeds = {
     "Bakerloo": 1,
@@ -15,6 +23,17 @@ relative_speeds = {
     "Victoria": 1,
     "Waterloo & City": 1
 }
+distance_relevance_coefficient = 0.24683055802825526
+distance_base_coefficient = 0.11539970618192215    #defined at 1m
+#starting point for fitting
+INITIAL_PARAMETERS = {
+    'relative_speeds': dict(relative_speeds),
+    'distance_relevance_coefficient': distance_relevance_coefficient,
+    'distance_base_coefficient': distance_base_coefficient,
+}
+parameters_source = None    #'file' if loaded from PARAMETERS_FILE, 'fitted' if fit_parameters() ran at import
+parameters_version = 0      #bumped by set_parameters, for keying anything derived from the parameters
+parameter_listeners = []    #called with no arguments after the parameters change, see on_parameters_changed
 
 #@cache
 def time_to_seconds(time_str):
@@ -41,15 +60,10 @@ for line in lines[1:]:
 
     formatted_data.append((start_station, end_station, line_name, time_in_seconds))
 
-for entry in formatted_data:
-    print("Reading Primary Data: ",entry)
-
 
 @cache  #functools lru cache used here to save time, BE CAREFUL to clear the cache when training
 def get_top_speed(start_station, end_station, line):
     distance = get_distance(start_station, end_station)
-    distance_relevance_coefficient = 0.24683055802825526
-    distance_base_coefficient = 0.11539970618192215    #defined at 1m
 
     result = top_speeds[line]
     result *= distance_base_coefficient * distance ** (distance_relevance_coefficient) * relative_speeds[line]
@@ -123,6 +137,8 @@ def get_loss():
 def fine_tune():
     #ternary search on the relative speeds!
     global relative_speeds
+    for line in relative_speeds:
+        relative_speeds[line] = 1   #always start from scratch so the fit doesn't depend on what was loaded before
     for line in relative_speeds:
         l=0
         r=3
@@ -139,6 +155,8 @@ def fine_tune():
                 l=m1
         print(line, l)
         relative_speeds[line] = l
+    #through set_parameters like any other change, so the version is bumped and everything built from the old speeds is dropped
+    set_parameters(get_parameters())
     print('Fine tune finished. Total Squared Error:',get_loss())
     return relative_speeds
 def time_DC(current_station, next_station, used_line, silent=1):
@@ -151,8 +169,112 @@ def time_DC(current_station, next_station, used_line, silent=1):
     result += get_adjacent_time(get_distance(current_station,next_station), used_line, get_top_speed(current_station, next_station, used_line))
 
     return result
+def data_checksum():
+    #hash of the input files and line tables the fit depends on
+    h = hashlib.sha256()
+    for file_path in MODEL_INPUT_FILES:
+        with open(file_path, 'rb') as f:
+            h.update(f.read())
+    h.update(repr([sorted(table.items()) for table in (top_speeds, accelerations, decelerations)]).encode())
+    return h.hexdigest()
+
+def get_parameters():
+    return {
+        'relative_speeds': dict(relative_speeds),
+        'distance_relevance_coefficient': distance_relevance_coefficient,
+        'distance_base_coefficient': distance_base_coefficient,
+    }
+
+def set_parameters(parameters):
+    #swap in a new set of parameters, the cached travel times are no longer valid
+    global distance_relevance_coefficient, distance_base_coefficient, parameters_version
+    relative_speeds.update(parameters['relative_speeds'])
+    distance_relevance_coefficient = parameters['distance_relevance_coefficient']
+    distance_base_coefficient = parameters['distance_base_coefficient']
+    get_top_speed.cache_clear()
+    get_adjacent_time.cache_clear()
+    calculate_route_time.cache_clear()
+    parameters_version += 1
+    for listener in parameter_listeners:
+        listener()
+
+def on_parameters_changed(listener):
+    #register a callback (e.g. a route cache's clear) to run whenever set_parameters is called
+    parameter_listeners.append(listener)
+    return listener
+
+def save_parameters(file_path=PARAMETERS_FILE):
+    artifact = {
+        'version': PARAMETERS_VERSION,
+        'data_checksum': data_checksum(),
+        'squared_error': get_loss(),
+        **get_parameters(),
+    }
+    #written next to the file and renamed over it, so a running app reloading it never reads half a file
+    temp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(artifact, f, indent=4)
+    os.replace(temp_path, file_path)
+
+def read_parameters(file_path=PARAMETERS_FILE):
+    #the saved parameters without applying them, or None if they're missing or were fitted on different inputs
+    try:
+        with open(file_path, 'r') as f:
+            artifact = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(artifact, dict) or artifact.get('version') != PARAMETERS_VERSION or artifact.get('data_checksum') != data_checksum():
+        return None
+    if any(key not in artifact for key in INITIAL_PARAMETERS):
+        return None
+    return {key: artifact[key] for key in INITIAL_PARAMETERS}
+
+def load_parameters(file_path=PARAMETERS_FILE):
+    #returns True if the saved parameters were loaded, False if they're missing or were fitted on different inputs
+    parameters = read_parameters(file_path)
+    if parameters is None:
+        return False
+    set_parameters(parameters)
+    return True
+
+def fit_parameters(file_path=PARAMETERS_FILE, joint=False):
+    #the offline fitting step, see fit_model.py
+    #uses the batched engine in fitting.py, fine_tune() is the original (much slower) ternary search
+    from fitting import FittingProblem
+    problem = FittingProblem(graph, formatted_data)
+    set_parameters(problem.fit(INITIAL_PARAMETERS, joint=joint))
+    if file_path is not None:
+        save_parameters(file_path)
+    return get_parameters()
+
+def model_fingerprint(parameters=None):
+    #identifies the fitted model (the current one, or the given parameters) and everything else routes are built
+    #from: the input data, the graph and the transfer times' inputs (line frequencies and interchange walks),
+    #so anything precomputed from it can tell when it's stale
+    h = hashlib.sha256()
+    h.update(repr(sorted((parameters or get_parameters()).items())).encode())
+    h.update(data_checksum().encode())
+    h.update(repr(sorted(graph.items())).encode())
+    h.update(repr(sorted(frequencies.items())).encode())
+    h.update(repr([interchange_walk_time(node) for node in sorted(graph)]).encode())
+    return h.hexdigest()
+def interchange_walk_time(node):
+    #the walking part of a transfer, more lines (edges) at a station means longer walks between platforms
+    return (len(graph[node])/2)**0.5*60
+
 def model_transfer_time(node, prev_line, new_line):
-    answer = (len(graph[node])/2)**0.5*60 + (3600/frequencies[new_line])/2
+    #walk plus waiting half a headway for the new line, see timetable.py for waits that depend on the time of day
+    answer = interchange_walk_time(node) + (3600/frequencies[new_line])/2
     return answer
 
-fine_tune()
+if load_parameters():
+    parameters_source = 'file'
+else:
+    #only happens when the inputs changed since the last `python fit_model.py`
+    print(f'{PARAMETERS_FILE} is missing or out of date, refitting the model...')
+    fit_parameters(None)
+    parameters_source = 'fitted'
+    try:
+        save_parameters()
+    except OSError:
+        pass    #read only filesystem, we'll just refit next time
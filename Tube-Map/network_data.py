@@ -0,0 +1,138 @@
+#compiled binary form of the network inputs (stations, edges, dwell times), so setup doesn't parse the text files on import
+#the file is little endian: a fixed header, then flat arrays, then a string table, every section 8 byte aligned
+#it's opened with mmap, so the arrays are read straight from the page cache (shared by every worker on the machine)
+#and only the final dicts are built in python. build it with python build_network.py (setup also rewrites it if stale)
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+NETWORK_FILE = 'network.bin'
+NETWORK_MAGIC = b'TUBENET\0'
+NETWORK_VERSION = 1
+NETWORK_INPUT_FILES = ['london_tube_vertices.txt', 'london_tube_edge_list.txt', 'average_dwell_times.txt']
+
+#magic, version, stations, edges, lines, dwell entries, strings, crc32 of the inputs
+HEADER = struct.Struct('<8sIIIIIII')
+
+def source_checksum(lines, file_paths=NETWORK_INPUT_FILES):
+    #crc32 of the input files plus the lines setup keeps, so any change to either makes the binary stale
+    #(zlib is already loaded by the interpreter, hashlib would add a few ms to every import of setup)
+    checksum = 0
+    for file_path in file_paths:
+        with open(file_path, 'rb') as f:
+            checksum = zlib.crc32(f.read(), checksum)
+    return zlib.crc32('\n'.join(sorted(lines)).encode(), checksum)
+
+def _pad(n):
+    return -n % 8
+
+def write_network(file_path, graph, vertex_data, dwell_times, checksum):
+    #stations must be numbered 0..n-1 (setup renumbers them), edges are stored per station in graph order
+    n_stations = len(vertex_data)
+    if sorted(vertex_data) != list(range(n_stations)) or sorted(graph) != list(range(n_stations)):
+        raise ValueError("Stations must be numbered 0..n-1 to be compiled")
+    #string table: station names, then line names, then any dwell time stations that aren't in the graph
+    line_names = sorted(set(line for station in graph for _, line, _ in graph[station]) | set(line for _, line in dwell_times))
+    line_ids = {name: i for i, name in enumerate(line_names)}
+    strings = [vertex_data[i][0] for i in range(n_stations)] + line_names
+    string_ids = {}
+    for i, name in enumerate(strings[:n_stations]):
+        string_ids.setdefault(name, i)
+    for name, _ in dwell_times:
+        if name not in string_ids:
+            string_ids[name] = len(strings)
+            strings.append(name)
+
+    edges = [(dest, line, distance) for station in range(n_stations) for dest, line, distance in graph[station]]
+    edge_offsets = [0]
+    for station in range(n_stations):
+        edge_offsets.append(edge_offsets[-1] + len(graph[station]))
+    encoded = [name.encode() for name in strings]
+    string_offsets = [0]
+    for name in encoded:
+        string_offsets.append(string_offsets[-1] + len(name))
+    blob = b''.join(encoded)
+
+    sections = [
+        struct.pack(f'<{n_stations}d', *(vertex_data[i][1] for i in range(n_stations))),
+        struct.pack(f'<{n_stations}d', *(vertex_data[i][2] for i in range(n_stations))),
+        struct.pack(f'<{len(edges)}d', *(distance for _, _, distance in edges)),
+        struct.pack(f'<{len(dwell_times)}d', *dwell_times.values()),
+        struct.pack(f'<{n_stations + 1}i', *edge_offsets),
+        struct.pack(f'<{len(edges)}i', *(dest for dest, _, _ in edges)),
+        struct.pack(f'<{len(edges)}i', *(line_ids[line] for _, line, _ in edges)),
+        struct.pack(f'<{len(dwell_times)}i', *(string_ids[name] for name, _ in dwell_times)),
+        struct.pack(f'<{len(dwell_times)}i', *(line_ids[line] for _, line in dwell_times)),
+        struct.pack(f'<{len(strings) + 1}i', *string_offsets),
+        blob,
+    ]
+    #written to a temporary file and renamed, so a worker starting up never maps a half written file
+    temporary_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(HEADER.pack(NETWORK_MAGIC, NETWORK_VERSION, n_stations, len(edges), len(line_names), len(dwell_times), len(strings), checksum))
+        f.write(b'\0' * _pad(HEADER.size))
+        for section in sections:
+            f.write(section)
+            f.write(b'\0' * _pad(len(section)))
+    os.replace(temporary_path, file_path)
+
+class NetworkData:
+    #read only view of a compiled network file, the arrays are memoryviews into the mapping (no copies)
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as f:
+            self._mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_stations, n_edges, n_lines, n_dwell, n_strings, self.checksum = HEADER.unpack_from(self._mapping)
+        if magic != NETWORK_MAGIC:
+            raise ValueError(f"{file_path} is not a compiled network file")
+        if version != NETWORK_VERSION:
+            raise ValueError(f"Network file {file_path} has version {version}, expected {NETWORK_VERSION}")
+        self.n_stations, self.n_edges, self.n_lines, self.n_dwell = n_stations, n_edges, n_lines, n_dwell
+        view = memoryview(self._mapping)
+        position = HEADER.size + _pad(HEADER.size)
+        def section(count, fmt):
+            nonlocal position
+            size = count * struct.calcsize(fmt)
+            result = view[position:position + size].cast(fmt)
+            position += size + _pad(size)
+            return result
+        self.latitudes = section(n_stations, 'd')
+        self.longitudes = section(n_stations, 'd')
+        self.edge_distances = section(n_edges, 'd')
+        self.dwell_times = section(n_dwell, 'd')
+        self.edge_offsets = section(n_stations + 1, 'i')
+        self.edge_targets = section(n_edges, 'i')
+        self.edge_lines = section(n_edges, 'i')
+        self.dwell_stations = section(n_dwell, 'i')
+        self.dwell_lines = section(n_dwell, 'i')
+        string_offsets = section(n_strings + 1, 'i').tolist()
+        blob = view[position:position + string_offsets[-1]].tobytes()
+        self.strings = [blob[a:b].decode() for a, b in zip(string_offsets, string_offsets[1:])]
+        self.line_names = self.strings[n_stations:n_stations + n_lines]
+
+    def vertex_data(self):
+        names = self.strings[:self.n_stations]
+        return dict(enumerate(zip(names, self.latitudes.tolist(), self.longitudes.tolist())))
+
+    def graph(self):
+        offsets = self.edge_offsets.tolist()
+        line_names = self.line_names
+        edges = list(zip(self.edge_targets.tolist(), [line_names[line] for line in self.edge_lines.tolist()], self.edge_distances.tolist()))
+        return {station: edges[offsets[station]:offsets[station + 1]] for station in range(self.n_stations)}
+
+    def average_dwell_times(self):
+        keys = zip([self.strings[name] for name in self.dwell_stations.tolist()], [self.line_names[line] for line in self.dwell_lines.tolist()])
+        return dict(zip(keys, self.dwell_times.tolist()))
+
+def load_network(file_path, checksum):
+    #the compiled network if it exists and was built from the current inputs, otherwise None
+    if sys.byteorder != 'little':
+        return None    #the arrays are cast in place, so only little endian machines can use them
+    try:
+        network = NetworkData(file_path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if network.checksum != checksum:
+        return None
+    return network
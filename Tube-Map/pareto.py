@@ -0,0 +1,130 @@
+#multi-criteria routing: every route between two stations that isn't beaten on both journey time and number of transfers
+#(the pareto set), from one label setting search over the (station, line) states of a time CompiledGraph
+#a label is (time, transfers) at a state plus a parent label. labels come off the heap in time order, so a label is
+#dominated exactly when its state already settled one with no more transfers, and one int per state (the fewest
+#transfers settled there) is all the dominance bookkeeping needed. the labels themselves live in flat arrays
+#the search is guided by two lower bounds to the destination: the time of the reverse shortest path tree (as in
+#alternatives.py) and the fewest transfers between lines. a label is pruned once the destination has settled a route
+#with no more transfers than it can possibly end up with
+from array import array
+from collections import deque
+from heapq import heappush, heappop
+from setup import *
+from alternatives import reverse_tree
+
+_line_adjacency_cache = {}
+
+def line_adjacency(compiled):
+    #{line id: set of line ids it shares a station with}, cached per compiled graph like routes.get_extended_graph
+    cached = _line_adjacency_cache.get(id(compiled))
+    if cached is None or cached[0] is not compiled:
+        adjacency = {line: set() for line in range(len(compiled.line_names))}
+        for states in compiled.station_states:
+            lines = set(compiled.state_line[state] for state in states)
+            for line in lines:
+                adjacency[line] |= lines - {line}
+        cached = (compiled, adjacency)
+        _line_adjacency_cache[id(compiled)] = cached
+    return cached[1]
+
+def transfers_to_end(compiled, end_id):
+    #lower bound on the transfers still needed from each line to reach end_id: a BFS over the lines, where two lines
+    #are a transfer apart if they share a station. lines that can't get there get len(line_names)
+    #(a bound on lines rather than on every state, since it's a handful of lines instead of a search of the whole graph)
+    adjacency = line_adjacency(compiled)
+    transfers = [len(compiled.line_names)] * len(compiled.line_names)
+    queue = deque()
+    for state in compiled.station_states[end_id]:
+        transfers[compiled.state_line[state]] = 0
+        queue.append(compiled.state_line[state])
+    while queue:
+        line = queue.popleft()
+        for other in adjacency[line]:
+            if transfers[line] + 1 < transfers[other]:
+                transfers[other] = transfers[line] + 1
+                queue.append(other)
+    return transfers
+
+def pareto_routes(compiled, start_id, end_id, max_transfers=None, stats=None):
+    #every pareto optimal (time, transfers) route from start_id to end_id on a time CompiledGraph, as
+    #[(path, total, transfers), ...] fastest first (so with the most transfers first), path like get_shortest_route
+    #the first is the fastest route and the last needs the fewest transfers. max_transfers drops anything with more
+    #stats (a dict) gets the number of labels created and settled
+    INF = float('inf')
+    if not compiled.has_station(start_id) or not compiled.has_station(end_id):
+        return []
+    offsets, targets, weights = compiled.state_offsets, compiled.state_targets, compiled.state_weights
+    state_station, state_line = compiled.state_station, compiled.state_line
+    to_end, _ = reverse_tree(compiled, end_id)
+    line_transfers_left = transfers_to_end(compiled, end_id)
+
+    n_states = len(state_station)
+    fewest_settled = array('i', [n_states]) * n_states    #fewest transfers of a settled label per state
+    label_state = array('i')
+    label_parent = array('i')
+    label_time = array('d')
+    label_transfers = array('i')
+    end_labels = []
+    #a label with this many transfers or more can't beat a route already found (or is over max_transfers)
+    transfer_limit = n_states if max_transfers is None else max_transfers + 1
+    queue = []
+    for state in compiled.station_states[start_id]:
+        if to_end[state] < INF and line_transfers_left[state_line[state]] < transfer_limit:
+            heappush(queue, (to_end[state], 0, 0.0, len(label_state)))
+            label_state.append(state)
+            label_parent.append(-1)
+            label_time.append(0.0)
+            label_transfers.append(0)
+    settled = 0
+    while queue:
+        _, transfers, time, label = heappop(queue)
+        state = label_state[label]
+        if transfers >= fewest_settled[state] or transfers + line_transfers_left[state_line[state]] >= transfer_limit:
+            continue
+        fewest_settled[state] = transfers
+        settled += 1
+        if state_station[state] == end_id:
+            end_labels.append(label)
+            transfer_limit = transfers
+            if transfers == 0:
+                break
+            continue
+        line = state_line[state]
+        for k in range(offsets[state], offsets[state + 1]):
+            target = targets[k]
+            target_line = state_line[target]
+            next_transfers = transfers if target_line == line else transfers + 1
+            if next_transfers >= fewest_settled[target] or next_transfers + line_transfers_left[target_line] >= transfer_limit:
+                continue
+            next_time = time + weights[k]
+            if next_time + to_end[target] == INF:
+                continue    #a closed edge (see disruptions.py) or no way on to the end
+            heappush(queue, (next_time + to_end[target], next_transfers, next_time, len(label_state)))
+            label_state.append(target)
+            label_parent.append(label)
+            label_time.append(next_time)
+            label_transfers.append(next_transfers)
+
+    if stats is not None:
+        stats['labels'] = len(label_state)
+        stats['settled'] = settled
+    routes = []
+    for label in end_labels:
+        path = []
+        total, transfers = label_time[label], label_transfers[label]
+        while label != -1:
+            path.append(compiled.state_to_tuple(label_state[label]))
+            label = label_parent[label]
+        routes.append((path[::-1], total, transfers))
+    return routes
+
+if __name__ == "__main__":
+    import sys
+    from model import model_transfer_time, get_parameters
+    from vectorised_model import make_time_function
+    from compiled_graph import CompiledGraph
+    from routes import journey_summary
+    compiled = CompiledGraph.build(graph, time_function=make_time_function(graph, get_parameters()), transfer_time=model_transfer_time)
+    start_id, end_id = vertex_ID[sys.argv[1]], vertex_ID[sys.argv[2]]
+    for path, total, transfers in pareto_routes(compiled, start_id, end_id):
+        print(f"{total / 60:5.1f} min, {transfers} transfers: {journey_summary(path)}")
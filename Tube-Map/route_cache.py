@@ -0,0 +1,72 @@
+#bounded LRU cache (with an optional TTL) for route results
+#traffic is dominated by a few hundred origin/destination pairs, so the app keeps finished results here
+#keys should include the model parameter version so a refit can never serve stale routes
+import threading
+import time
+from collections import OrderedDict
+
+class RouteCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        #ttl is in seconds, None means entries only leave by eviction or clear()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()    #key -> (value, expiry time or None), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        #drop every entry, e.g. when the model parameters are reloaded (counters are kept)
+        with self._lock:
+            self._entries.clear()
+
+    def discard(self, predicate):
+        #drop the entries for which predicate(key, value) is true, e.g. the routes a closure affects, returns how many
+        with self._lock:
+            keys = [key for key, (value, _) in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -1,37 +1,69 @@
 from heapq import heappush, heappop
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+import threading
 from setup import *
 import math
+import instrumentation
+
+def default_transfer_time(node, prev_line, new_line):
+    return 180
 
 def create_extended_graph(graph, transfer_time):
     #this function creates a graph such that (node, line) pairs are vertices
-    #such pairs which share the node are connected by transfer time
-    #such pairs which are adjacent are connected by 'weight' 
+    #each (station, line) vertex gets an edge for every edge out of the station: (dest, dest_line, weight, transfer_cost)
+    #transfer_cost is 0 when staying on the line, otherwise transfer_time(station, line, dest_line) worked out here once,
+    #so changing lines is folded into the next ride and routes keep their [(station, line), ...] shape
     #(for reference, weight is just the primitive estimation of distance/avg speed, not the REAL modelled time)
     #the real modelled time is dealt with in the other function
 
-    extended_graph = defaultdict(lambda:[])
-
-    for station in graph:
-        for dest, line, weight in graph[station]:
-            extended_graph[(station, line)].append((dest, line, weight))
+    extended_graph = {}
 
     for station in graph:
-        lines_at_station = set(edge[1] for edge in graph[station])
-        for line1 in lines_at_station:
-            for line2 in lines_at_station:
-                if line1 != line2:
-                    extended_graph[(station, line1)].append((station, line2, transfer_time(station, line1, line2)))
+        lines_at_station = sorted(set(edge[1] for edge in graph[station]))
+        for line in lines_at_station:
+            extended_graph[(station, line)] = [(dest, dest_line, weight, 0 if dest_line == line else transfer_time(station, line, dest_line)) for dest, dest_line, weight in graph[station]]
 
     return extended_graph
 
-def get_shortest_route(graph, start_id, end_id, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180):
-    INF = float('inf')
-    if start_id not in graph or end_id not in graph:
-        return None, INF
+EXTENDED_GRAPH_CACHE_SIZE = 8
+_extended_graph_cache = OrderedDict()    #(id(graph), transfer_time) -> (graph, extended graph), least recently used first
+_compiled_graph_cache = OrderedDict()    #(id(graph), mode, time_function, transfer_time) -> (graph, CompiledGraph), the same way
+_extended_graph_lock = threading.Lock()
+
+def _cached_build(cache, key, graph, build):
+    #build() for a graph, kept in cache under key (which starts with id(graph)). only the EXTENDED_GRAPH_CACHE_SIZE
+    #most recently used are kept, so throwaway graphs or transfer functions (e.g. a lambda per call) don't pile up
+    with _extended_graph_lock:
+        cached = cache.get(key)
+        if cached is not None and cached[0] is graph:
+            cache.move_to_end(key)
+            return cached[1]
+    cached = (graph, build())
+    with _extended_graph_lock:
+        cache[key] = cached
+        cache.move_to_end(key)
+        while len(cache) > EXTENDED_GRAPH_CACHE_SIZE:
+            cache.popitem(last=False)
+    return cached[1]
+
+def get_extended_graph(graph, transfer_time):
+    #the extended graph only depends on the graph and the transfer model, so build it once per pair and reuse it
+    #keyed by identity, so call clear_extended_graph_cache() after editing a graph in place
+    return _cached_build(_extended_graph_cache, (id(graph), transfer_time), graph, lambda: create_extended_graph(graph, transfer_time))
 
-    extended_graph = create_extended_graph(graph, transfer_time)
+def get_compiled_graph(graph, mode='time', time_function=None, transfer_time=default_transfer_time):
+    #CompiledGraph.build, reused for the same graph, mode and functions like get_extended_graph
+    from compiled_graph import CompiledGraph
+    return _cached_build(_compiled_graph_cache, (id(graph), mode, time_function, transfer_time), graph,
+                         lambda: CompiledGraph.build(graph, mode, time_function, transfer_time))
 
+def clear_extended_graph_cache():
+    with _extended_graph_lock:
+        _extended_graph_cache.clear()
+        _compiled_graph_cache.clear()
+
+def make_weight_function(mode='time', time_function=None):
+    #returns get_weight(current_station, current_line, next_station, next_line, weight, transfer_cost) for the chosen mode
     def get_time(current_station, next_station, used_line):
         dist = get_distance(current_station, next_station)
         result =  dist/line_speeds[used_line]
@@ -43,21 +75,36 @@ def get_shortest_route(graph, start_id, end_id, mode='time', time_function=None,
     get_time = time_function
     #these weird lines actually just make time_function default to the primitive estimation
 
-
-    def get_weight(edge, current_line, current_station, mode):
-        dest, line, weight = edge
+    def get_weight(current_station, current_line, next_station, line, weight, transfer_cost):
         if mode == 'stops':
             return 1
         elif mode == 'distance':
-            return weight if line == current_line else weight*line_speeds[current_line] + transfer_time(current_station, current_line, line)
+            return weight if line == current_line else weight*line_speeds[current_line] + transfer_cost
         elif mode == 'time':
             one_stop = get_time(current_station, next_station, line)
-            return one_stop if line == current_line else one_stop + transfer_time(current_station, current_line, line)
+            return one_stop if line == current_line else one_stop + transfer_cost
         elif mode == 'transfers':
             return 0 if line == current_line else 1
         else:
             raise Exception("Dear coder, you have entered an invalid mode. Please select a valid one... unless you want more bugs")
 
+    return get_weight
+
+def reconstruct_path(predecessors, state):
+    #step backwards through the dijkstra tree
+    path = []
+    current = state
+    while current is not None:
+        path.append(current)
+        current = predecessors[current]
+    return path[::-1]
+
+def run_dijkstra(graph, extended_graph, start_id, get_weight, end_id=None, stats=None):
+    #dijkstra over the (station, line) states of extended_graph, starting from every line at start_id
+    #stops at the first settled state of end_id, or settles everything if end_id is None
+    #returns (end_state, distances, predecessors), end_state is None if end_id wasn't reached
+    #stats (a dict) gets the heap pushes and pops, settled states and get_weight calls
+    INF = float('inf')
     distances = defaultdict(lambda:INF)
     predecessors = defaultdict(lambda:None) #parent list
 
@@ -66,27 +113,239 @@ def get_shortest_route(graph, start_id, end_id, mode='time', time_function=None,
     for line in start_lines:
         distances[(start_id, line)] = 0
         heappush(queue, (0, (start_id, line)))
+    pushes = len(queue)
+    pops = 0
+    settled = 0
+    weight_calls = 0
+    end_state = None
     #dijkstra distance method
     while queue:
         current_distance, (current_station, current_line) = heappop(queue)
-        if current_station == end_id and current_distance == distances[(current_station, current_line)]:
-            #step backwards through the dijkstra tree
-            path = []
-            current = (current_station, current_line)
-            while current is not None:
-                path.append(current)
-                current = predecessors[current]
-            return path[::-1], current_distance
+        pops += 1
+        if current_distance != distances[(current_station, current_line)]:
+            continue
+        settled += 1
+        if current_station == end_id:
+            end_state = (current_station, current_line)
+            break
 
-        for next_station, next_line, weight in graph[current_station]:
-            edge_weight = get_weight((next_station, next_line, weight), current_line, current_station, mode)
+        for next_station, next_line, weight, transfer_cost in extended_graph[(current_station, current_line)]:
+            edge_weight = get_weight(current_station, current_line, next_station, next_line, weight, transfer_cost)
+            weight_calls += 1
             distance = current_distance + edge_weight
 
             if distance < distances[(next_station, next_line)]:
                 distances[(next_station, next_line)] = distance
                 predecessors[(next_station, next_line)] = (current_station, current_line)
                 heappush(queue, (distance, (next_station, next_line)))
-    return None, INF
+                pushes += 1
+    if stats is not None:
+        stats.update(pushes=pushes, pops=pops, settled=settled, weight_calls=weight_calls)
+    return end_state, distances, predecessors
+
+def run_bfs(graph, extended_graph, start_id, get_weight=None, end_id=None, stats=None):
+    #run_dijkstra for mode='stops', where every edge weighs 1: a plain FIFO queue already hands the states out in
+    #order of distance, so there's no heap and no get_weight calls. same arguments and return shape as run_dijkstra
+    INF = float('inf')
+    distances = defaultdict(lambda:INF)
+    predecessors = defaultdict(lambda:None)
+
+    queue = deque()
+    for line in sorted(set(edge[1] for edge in graph[start_id])):
+        distances[(start_id, line)] = 0
+        queue.append((start_id, line))
+    pushes = len(queue)
+    pops = 0
+    end_state = None
+    while queue:
+        state = queue.popleft()
+        pops += 1
+        if state[0] == end_id:
+            end_state = state
+            break
+        distance = distances[state] + 1
+        for next_station, next_line, _, _ in extended_graph[state]:
+            if distance < distances[(next_station, next_line)]:
+                distances[(next_station, next_line)] = distance
+                predecessors[(next_station, next_line)] = state
+                queue.append((next_station, next_line))
+                pushes += 1
+    if stats is not None:
+        stats.update(pushes=pushes, pops=pops, settled=pops, weight_calls=0)
+    return end_state, distances, predecessors
+
+def run_zero_one_bfs(graph, extended_graph, start_id, get_weight=None, end_id=None, stats=None):
+    #run_dijkstra for mode='transfers', where staying on the line weighs 0 and changing weighs 1: a deque kept in
+    #order by putting 0 edges on the front and 1 edges on the back replaces the heap
+    #transfers mode uses run_fewest_transfers now, this only stays as the fewest transfers reference that
+    #benchmarks.py bench_mode_searches times and checks the other searches against
+    INF = float('inf')
+    distances = defaultdict(lambda:INF)
+    predecessors = defaultdict(lambda:None)
+
+    queue = deque()
+    for line in sorted(set(edge[1] for edge in graph[start_id])):
+        distances[(start_id, line)] = 0
+        queue.append((0, (start_id, line)))
+    pushes = len(queue)
+    pops = 0
+    settled = 0
+    end_state = None
+    while queue:
+        current_distance, (current_station, current_line) = queue.popleft()
+        pops += 1
+        if current_distance != distances[(current_station, current_line)]:
+            continue
+        settled += 1
+        if current_station == end_id:
+            end_state = (current_station, current_line)
+            break
+
+        for next_station, next_line, _, _ in extended_graph[(current_station, current_line)]:
+            if next_line == current_line:
+                if current_distance < distances[(next_station, next_line)]:
+                    distances[(next_station, next_line)] = current_distance
+                    predecessors[(next_station, next_line)] = (current_station, current_line)
+                    queue.appendleft((current_distance, (next_station, next_line)))
+                    pushes += 1
+            elif current_distance + 1 < distances[(next_station, next_line)]:
+                distances[(next_station, next_line)] = current_distance + 1
+                predecessors[(next_station, next_line)] = (current_station, current_line)
+                queue.append((current_distance + 1, (next_station, next_line)))
+                pushes += 1
+    if stats is not None:
+        stats.update(pushes=pushes, pops=pops, settled=settled, weight_calls=0)
+    return end_state, distances, predecessors
+
+def run_lexicographic(graph, extended_graph, start_id, get_weight, end_id=None, stats=None):
+    #fewest transfers first, then the least weight (get_weight is normally the time mode's) among those
+    #it's 0-1 BFS on transfers where each level (the routes with the same number of transfers) is a dijkstra on
+    #weight: staying on the line goes on this level's heap and changing lines on the next one's. distances are
+    #(transfers, weight) pairs, otherwise the same return shape as run_dijkstra
+    INF = float('inf')
+    distances = defaultdict(lambda:(INF, INF))
+    predecessors = defaultdict(lambda:None)
+
+    level = []
+    for line in sorted(set(edge[1] for edge in graph[start_id])):
+        distances[(start_id, line)] = (0, 0)
+        heappush(level, (0, (start_id, line)))
+    transfers = 0
+    pushes = len(level)
+    pops = 0
+    settled = 0
+    weight_calls = 0
+    end_state = None
+    while level and end_state is None:
+        next_level = []
+        while level:
+            current_distance, (current_station, current_line) = heappop(level)
+            pops += 1
+            if (transfers, current_distance) != distances[(current_station, current_line)]:
+                continue
+            settled += 1
+            if current_station == end_id:
+                end_state = (current_station, current_line)
+                break
+
+            for next_station, next_line, weight, transfer_cost in extended_graph[(current_station, current_line)]:
+                edge_weight = get_weight(current_station, current_line, next_station, next_line, weight, transfer_cost)
+                weight_calls += 1
+                key = (transfers if next_line == current_line else transfers + 1, current_distance + edge_weight)
+                if key < distances[(next_station, next_line)]:
+                    distances[(next_station, next_line)] = key
+                    predecessors[(next_station, next_line)] = (current_station, current_line)
+                    heappush(level if next_line == current_line else next_level, (key[1], (next_station, next_line)))
+                    pushes += 1
+        level = next_level
+        transfers += 1
+    if stats is not None:
+        stats.update(pushes=pushes, pops=pops, settled=settled, weight_calls=weight_calls)
+    return end_state, distances, predecessors
+
+#modes whose weights are all 1, or all 0 or 1, get a search without a heap. every other mode uses run_dijkstra
+def run_fewest_transfers(graph, extended_graph, start_id, get_weight, end_id=None, stats=None):
+    #the search for mode='transfers': run_lexicographic, so the quickest of the routes with the fewest transfers is
+    #picked (get_weight is the time mode's, see SEARCH_WEIGHT_MODES), with just the transfers as the distances
+    INF = float('inf')
+    end_state, distances, predecessors = run_lexicographic(graph, extended_graph, start_id, get_weight, end_id, stats)
+    return end_state, defaultdict(lambda:INF, {state: distance[0] for state, distance in distances.items()}), predecessors
+
+MODE_SEARCHES = {'stops': run_bfs, 'transfers': run_fewest_transfers}
+#the weights a mode's search is given when they aren't the mode's own
+SEARCH_WEIGHT_MODES = {'transfers': 'time'}
+
+def get_shortest_route(graph, start_id, end_id, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180, stats=None, algorithm=None):
+    #stats (a dict) gets the search's counters, see run_dijkstra. they're also recorded when instrumentation is on
+    #algorithm picks one of CompiledGraph.shortest_route's searches ('dijkstra', 'astar', 'bidirectional', 'bfs' or
+    #'lexicographic'), run on a CompiledGraph of the graph (built on first use, see get_compiled_graph). by default
+    #the search for the mode runs on the dict graph. either way the total is the same
+    INF = float('inf')
+    if start_id not in graph or end_id not in graph:
+        return None, INF
+    if algorithm is not None:
+        if stats is None and instrumentation.ENABLED:
+            stats = {}
+        route = get_compiled_graph(graph, mode, time_function, transfer_time).shortest_route(start_id, end_id, algorithm, stats)
+        instrumentation.record_search('routes', stats)
+        return route
+
+    extended_graph = get_extended_graph(graph, transfer_time)
+
+    get_weight = make_weight_function(SEARCH_WEIGHT_MODES.get(mode, mode), time_function)
+    if stats is None and instrumentation.ENABLED:
+        stats = {}
+    search = MODE_SEARCHES.get(mode, run_dijkstra)
+    end_state, distances, predecessors = search(graph, extended_graph, start_id, get_weight, end_id, stats)
+    instrumentation.record_search('routes', stats)
+    if end_state is None:
+        return None, INF
+    return reconstruct_path(predecessors, end_state), distances[end_state]
+
+def get_fewest_transfers_route(graph, start_id, end_id, time_function=None, transfer_time=lambda node, prev_line, new_line: 180, stats=None):
+    #the quickest of the routes with the fewest transfers, same return shape as get_shortest_route (the total is
+    #the time, route_legs gives the transfers)
+    INF = float('inf')
+    if start_id not in graph or end_id not in graph:
+        return None, INF
+    extended_graph = get_extended_graph(graph, transfer_time)
+    get_weight = make_weight_function('time', time_function)
+    if stats is None and instrumentation.ENABLED:
+        stats = {}
+    end_state, distances, predecessors = run_lexicographic(graph, extended_graph, start_id, get_weight, end_id, stats)
+    instrumentation.record_search('fewest_transfers', stats)
+    if end_state is None:
+        return None, INF
+    return reconstruct_path(predecessors, end_state), distances[end_state][1]
+
+def get_shortest_route_tree(graph, start_id, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180):
+    #same search as get_shortest_route, but it doesn't stop at a destination
+    #returns the distances and predecessors of every (station, line) state reachable from start_id
+    extended_graph = get_extended_graph(graph, transfer_time)
+    get_weight = make_weight_function(SEARCH_WEIGHT_MODES.get(mode, mode), time_function)
+    _, distances, predecessors = MODE_SEARCHES.get(mode, run_dijkstra)(graph, extended_graph, start_id, get_weight)
+    return distances, predecessors
+
+def get_travel_times(graph, start_id, mode='time', time_function=None, transfer_time=lambda node, prev_line, new_line: 180):
+    #one dijkstra from start_id gives the time to every station, instead of one get_shortest_route per destination
+    #returns {station: time}, unreachable stations are left out
+    INF = float('inf')
+    if start_id not in graph:
+        return {}
+    distances, _ = get_shortest_route_tree(graph, start_id, mode, time_function, transfer_time)
+    travel_times = {}
+    for (station, line), distance in distances.items():
+        if distance < travel_times.get(station, INF):
+            travel_times[station] = distance
+    return travel_times
+
+def stations_within(travel_times, limit):
+    #the part of a travel time dict that's within limit (same units, so seconds for mode='time')
+    return {station: time for station, time in travel_times.items() if time <= limit}
+
+def get_isochrone(graph, start_id, minutes, time_function=None, transfer_time=lambda node, prev_line, new_line: 180):
+    #every station reachable within the given number of minutes, as {station: seconds}
+    return stations_within(get_travel_times(graph, start_id, 'time', time_function, transfer_time), minutes * 60)
 
 def get_forced_route(graph, start_id, end_id, forced_line):
     #so this is just for situations where the shortest path isn't necessarily the one on the same line
@@ -95,9 +354,7 @@ def get_forced_route(graph, start_id, end_id, forced_line):
     if start_id not in graph or end_id not in graph:
         return None, INF
 
-    extended_graph = create_extended_graph(graph, lambda a,b,c: 180)    #we don't care about transfer time for this one
-
-
+    extended_graph = get_extended_graph(graph, default_transfer_time)    #we don't care about transfer time for this one
 
     def get_weight(edge, current_line, current_station):
         return INF if current_line!=forced_line else 1
@@ -122,7 +379,7 @@ def get_forced_route(graph, start_id, end_id, forced_line):
                 current = predecessors[current]
             return path[::-1], current_distance
 
-        for next_station, next_line, weight in graph[current_station]:
+        for next_station, next_line, weight, _ in extended_graph[(current_station, current_line)]:
             if next_line!=forced_line:
                 #if we go off our forced line, we've made a mistake, so it's not valid
                 continue
@@ -172,4 +429,48 @@ def journey_summary(route):
         previous_station_name = station_name
 
     summary_output = " -> ".join(journey_summary)
-    return summary_output
\ No newline at end of file
+    return summary_output
+
+def options_summary(options):
+    #journey_summary for each option of a pareto set (see pareto.pareto_routes), with its time and transfers in front
+    #e.g. "41 min, 2 transfers: Start at Morden on Northern line -> ..."
+    summaries = []
+    for route, total, transfers in options:
+        summaries.append(f"{int(total) // 60} min, {transfers} transfer{'' if transfers == 1 else 's'}: {journey_summary(route)}")
+    return summaries
+
+def route_legs(route):
+    #splits a route into legs on a single line, each leg is (line, [station, ...])
+    #changing lines means the new leg starts at the station where the previous one ended
+    legs = []
+    for i, (station, line) in enumerate(route or []):
+        if i == 0:
+            legs.append((line, [station]))
+        elif line == legs[-1][0]:
+            legs[-1][1].append(station)
+        else:
+            legs.append((line, [route[i-1][0], station]))
+    #a start state on a line we never ride (possible on ties) isn't a real leg
+    return [leg for leg in legs if len(leg[1]) > 1]
+
+def route_to_dict(route, total, total_key='total_seconds'):
+    #machine readable version of a route, for the JSON API
+    #total is whatever the search minimised, so pass total_key='total_weight' for modes other than time
+    if not route:
+        return None
+    legs = route_legs(route)
+    return {
+        'start': {'id': route[0][0], 'name': vertex_data[route[0][0]][0]},
+        'end': {'id': route[-1][0], 'name': vertex_data[route[-1][0]][0]},
+        total_key: total,
+        'transfers': max(0, len(legs) - 1),
+        'path': [{'id': station, 'name': vertex_data[station][0], 'line': line} for station, line in route],
+        'legs': [{
+            'line': line,
+            'from': vertex_data[stations[0]][0],
+            'to': vertex_data[stations[-1]][0],
+            'stops': len(stations) - 1,
+            'stations': [{'id': station, 'name': vertex_data[station][0]} for station in stations],
+        } for line, stations in legs],
+        'summary': journey_summary(route),
+    }
\ No newline at end of file
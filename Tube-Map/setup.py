@@ -4,6 +4,7 @@ from collections import *
 from math import *
 import csv
 from collections import defaultdict
+from network_data import NETWORK_FILE, source_checksum, load_network, write_network
 
 def haversine(lat1, lon1, lat2, lon2):
     R = 6371000  
@@ -110,63 +111,58 @@ frequencies = {
     "Waterloo & City": 12
 }
 
-graph = {}
-vertex_data = {}
-vertex_ID = {}
-
-
-with open('london_tube_vertices.txt','r') as f:
-    vertex_metadata = f.readlines()
+def read_vertices(file_path='london_tube_vertices.txt'):
+    #id -> (name, latitude, longitude)
+    vertices = {}
+    with open(file_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            vertices[int(row['id'])] = (row['name'], float(row['latitude']), float(row['longitude']))
+    return vertices
 
+def compute_average_dwell(file_path):
+    import ast    #only needed when network.bin is stale, and it's slow to import
+    with open(file_path,'r') as f:
+        try:
+            return ast.literal_eval(f.read())
+        except (ValueError, SyntaxError):
+            raise Exception("Failed to read the average dwell times.")
 
-with open('london_tube_edge_list.txt','r') as f:
-    edge_metadata = f.readlines()
-
-for i in vertex_metadata[1:]:
-    i = i.strip()
-    comma_indices = []
-    for j in range(len(i)):
-        if i[j]==',':
-            comma_indices.append(j)
-    ID, name, latitude, longitude = i[:comma_indices[0]], i[comma_indices[0]+2:comma_indices[-2]-1], i[comma_indices[-2]+1:comma_indices[-1]], i[comma_indices[-1]+1:]
-    ID = int(ID)
-    latitude = float(latitude)
-    longitude = float(longitude)
-    vertex_data[ID] = (name, latitude, longitude)
-    graph[ID] = []
-
-for i in edge_metadata[1:]:
-    i=i.strip()
-    fr, to, line, color = i.split(',')
-    fr=int(fr)
-    to=int(to)
-    lat1, lon1 = vertex_data[fr][1:]
-    lat2, lon2 = vertex_data[to][1:]
-    line = line[1:-6]
-    if line not in line_speeds:
-        continue
-    graph[fr].append((to, line, haversine(lat1,lon1,lat2,lon2)))
-    graph[to].append((fr, line, haversine(lat1,lon1,lat2,lon2)))
+def read_network_text(vertices_path='london_tube_vertices.txt', edges_path='london_tube_edge_list.txt', dwell_path='average_dwell_times.txt'):
+    #parses the text inputs, returns (graph, vertex_data, average_dwell_times)
+    vertex_data = read_vertices(vertices_path)
+    graph = {ID: [] for ID in vertex_data}
+    with open(edges_path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            fr = int(row['from'])
+            to = int(row['to'])
+            lat1, lon1 = vertex_data[fr][1:]
+            lat2, lon2 = vertex_data[to][1:]
+            line = row['line'][:-5]    #"Bakerloo Line" -> "Bakerloo"
+            if line not in line_speeds:
+                continue
+            graph[fr].append((to, line, haversine(lat1,lon1,lat2,lon2)))
+            graph[to].append((fr, line, haversine(lat1,lon1,lat2,lon2)))
+
+    #get rid of DLR stations and other irrelevant stuff, and number the remaining stations 0..n-1
+    valid_IDs = [i for i in graph if len(graph[i])>0]
+    new_IDs = {ID: i for i, ID in enumerate(valid_IDs)}
+    vertex_data = {new_IDs[k]:v for k,v in vertex_data.items() if k in new_IDs}
+    graph = {new_IDs[i]: [(new_IDs[j[0]], j[1], j[2]) for j in graph[i]] for i in valid_IDs}
+    return graph, vertex_data, compute_average_dwell(dwell_path)
+
+#the compiled network.bin is mapped in instead of parsing the text files, as long as it was built from the current ones
+network_checksum = source_checksum(line_speeds)
+compiled_network = load_network(NETWORK_FILE, network_checksum)
+if compiled_network is not None:
+    graph, vertex_data, average_dwell_times = compiled_network.graph(), compiled_network.vertex_data(), compiled_network.average_dwell_times()
+else:
+    graph, vertex_data, average_dwell_times = read_network_text()
+    try:
+        write_network(NETWORK_FILE, graph, vertex_data, average_dwell_times, network_checksum)
+    except OSError:
+        pass    #read only filesystem, we just parse the text again next time
 
-valid_IDs = []
-for i in graph:
-    if len(graph[i])>0:
-        valid_IDs.append(i)
-svIDs = set(valid_IDs)
-new_IDs = {}
-for i in range(len(valid_IDs)):
-    new_IDs[valid_IDs[i]] = i
-vertex_data = {new_IDs[k]:v for k,v in vertex_data.items() if k in svIDs}
-new_graph = {}
-for i in graph:
-    if i not in svIDs:
-        continue
-    new = []
-    for j in graph[i]:
-        new.append((new_IDs[j[0]], j[1], j[2]))
-    new_graph[new_IDs[i]] = new
-graph = new_graph
-#this entire code is to get rid of DLR stations and other irrelevant stuff
+vertex_ID = {}
 for i in vertex_data:
     vertex_ID[vertex_data[i][0]] = i
 
@@ -182,19 +178,6 @@ def get_distance(fr, to):
     lat2, lon2 = vertex_data[to][1:]
     return haversine(lat1,lon1,lat2,lon2)
 
-
-
-def compute_average_dwell(file_path):
-    with open(file_path,'r') as f:
-        try:
-            return eval(f.read())
-        except:
-            raise Exception("Failed to read the average dwell times.")
-    return average_dwell
-
-file_path = 'average_dwell_times.txt'  
-average_dwell_times = compute_average_dwell(file_path)
-
 station_names = []
 for i in vertex_data:
     station_names.append(vertex_data[i][0])
\ No newline at end of file
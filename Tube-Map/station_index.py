@@ -0,0 +1,89 @@
+#station name lookup: a normalised name index for exact matches, plus prefix and trigram indexes for typeahead and typos
+#normalising folds case, accents, apostrophes, '&' vs 'and' and other punctuation, so "kings cross st pancras",
+#"King's Cross St. Pancras" and "KINGS CROSS ST PANCRAS" are all the same key
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import Counter
+
+MIN_LOOKUP_SCORE = 0.5        #a misspelt name only resolves if it's at least this similar to a station...
+MIN_LOOKUP_MARGIN = 0.05      #...and clearly closer than the next best one (e.g. "Edgware Road" is ambiguous)
+MIN_SUGGESTION_SCORE = 0.25
+ABBREVIATIONS = {'rd': 'road', 'stn': 'station', 'pk': 'park', 'sq': 'square', 'gdns': 'gardens', 'ter': 'terminal'}
+
+def normalise_name(name):
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c)).lower()
+    name = re.sub(r"['’`]", '', name)    #king's -> kings
+    name = name.replace('&', ' and ')
+    name = re.sub(r'[^a-z0-9]+', ' ', name)    #st. -> st, bromley-by-bow -> bromley by bow, (b) -> b
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in name.split())
+
+def trigrams(normalised):
+    #padded so short words and the start of the name still give trigrams
+    padded = f'  {normalised} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class StationIndex:
+    def __init__(self, vertex_data):
+        self.names = {station: name for station, (name, _, _) in vertex_data.items()}
+        self.exact = {}            #normalised name -> station
+        self.sorted_names = []     #(normalised name, station), for prefix ranges
+        self.postings = {}         #trigram -> stations whose name contains it
+        self.trigram_counts = {}   #station -> number of distinct trigrams in its name
+        for station, name in self.names.items():
+            normalised = normalise_name(name)
+            self.exact.setdefault(normalised, station)
+            self.sorted_names.append((normalised, station))
+            grams = trigrams(normalised)
+            self.trigram_counts[station] = len(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(station)
+        self.sorted_names.sort()
+
+    def prefix_matches(self, normalised):
+        #stations whose normalised name starts with normalised, alphabetically
+        matches = []
+        for name, station in self.sorted_names[bisect_left(self.sorted_names, (normalised,)):]:
+            if not name.startswith(normalised):
+                break
+            matches.append(station)
+        return matches
+
+    def similarities(self, normalised):
+        #dice coefficient of trigram sets against every station sharing at least one trigram, best first
+        grams = trigrams(normalised)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        scores = [(2 * count / (len(grams) + self.trigram_counts[station]), station) for station, count in shared.items()]
+        scores.sort(key=lambda item: (-item[0], self.names[item[1]]))
+        return scores
+
+    def lookup(self, name, fuzzy=True):
+        #station for a name typed by a person, None if there's no station or it's ambiguous
+        normalised = normalise_name(name)
+        station = self.exact.get(normalised)
+        if station is not None or not fuzzy or not normalised:
+            return station
+        scores = self.similarities(normalised)
+        if not scores or scores[0][0] < MIN_LOOKUP_SCORE:
+            return None
+        if len(scores) > 1 and scores[0][0] - scores[1][0] < MIN_LOOKUP_MARGIN:
+            return None
+        return scores[0][1]
+
+    def suggest(self, query, limit=10):
+        #typeahead: names starting with the query first, then the closest names by trigram similarity
+        normalised = normalise_name(query)
+        if not normalised:
+            return []
+        results = self.prefix_matches(normalised)[:limit]
+        seen = set(results)
+        for score, station in self.similarities(normalised):
+            if len(results) >= limit or score < MIN_SUGGESTION_SCORE:
+                break
+            if station not in seen:
+                results.append(station)
+                seen.add(station)
+        return results
@@ -0,0 +1,437 @@
+#time dependent routing: earliest arrival for a given departure time, with waits that depend on how often each line
+#runs at that time of day (trains per hour in time bands, from line_frequencies.json) instead of the all day
+#frequencies table that model.model_transfer_time uses. that static model is still what every other mode uses, and
+#is the fallback here too: without the file (or for a line it doesn't list) the static frequencies apply all day
+#the engine is RAPTOR on frequency based trips. every line is split into patterns, runs of stations that can be ridden
+#without a transfer (the shortest in-line paths, so no optimal leg is missed), and round k finds the earliest arrival
+#at every station using k trains. a round scans all the patterns at once as the rows of a matrix: the best trip at
+#each stop is a running minimum along the row, so there's no heap at all
+import json
+import os
+from array import array
+from bisect import bisect_right
+from heapq import heappush, heappop
+import numpy as np
+from setup import *
+from model import interchange_walk_time
+from compiled_graph import CompiledGraph
+
+PROFILES_FILE = 'line_frequencies.json'
+DAY = 24 * 3600
+MAX_ROUNDS = 10     #trains per journey, far more than any sensible route needs
+
+def parse_clock(text):
+    #"08:30" or "08:30:15" -> seconds after midnight, ValueError if it isn't a time of day
+    parts = text.strip().split(':')
+    if not 2 <= len(parts) <= 3 or not all(part.isdigit() for part in parts):
+        raise ValueError(f"Invalid time {text!r}, expected HH:MM")
+    hours, minutes, seconds = [int(part) for part in parts] + [0] * (3 - len(parts))
+    if hours > 23 or minutes > 59 or seconds > 59:
+        raise ValueError(f"Invalid time {text!r}, expected HH:MM")
+    return hours * 3600 + minutes * 60 + seconds
+
+def format_clock(seconds):
+    #seconds after midnight -> "HH:MM:SS", with "+1" etc. for the following days
+    days, seconds = divmod(int(round(seconds)), DAY)
+    text = f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{text}+{days}" if days else text
+
+class FrequencyProfiles:
+    #trains per hour of every line in each time band. band_starts are seconds after midnight in ascending order,
+    #each band runs until the next one starts and the last one runs past midnight until the first starts
+    def __init__(self, band_names, band_starts, trains_per_hour, source='static'):
+        self.band_names = band_names
+        self.band_starts = band_starts
+        self.trains_per_hour = trains_per_hour
+        self.source = source
+
+    @classmethod
+    def static(cls):
+        #the static frequencies table all day, i.e. exactly model.model_transfer_time's waits
+        return cls(['all_day'], [0], {line: [float(f)] for line, f in frequencies.items()})
+
+    @classmethod
+    def load(cls, file_path=PROFILES_FILE):
+        if not os.path.exists(file_path):
+            return cls.static()
+        with open(file_path) as f:
+            data = json.load(f)
+        band_names = [name for name, _ in data['bands']]
+        band_starts = [parse_clock(start) for _, start in data['bands']]
+        if not band_starts or any(a >= b for a, b in zip(band_starts, band_starts[1:])):
+            raise ValueError(f"{file_path}: bands must start at increasing times")
+        trains_per_hour = {}
+        for line, static in frequencies.items():
+            values = data['trains_per_hour'].get(line)
+            if values is None:
+                values = [static] * len(band_names)
+            elif len(values) != len(band_names):
+                raise ValueError(f"{file_path}: {line} has {len(values)} frequencies for {len(band_names)} bands")
+            trains_per_hour[line] = [float(value) for value in values]
+        return cls(band_names, band_starts, trains_per_hour, file_path)
+
+    def wait_coefficients(self, line_names):
+        #the expected wait for a train on the platform at time t (see day_time) is min(headway_wait, catch - t), per
+        #(line, band): half a headway of the band t is in (inf if the line isn't running), or, if it's sooner, staying
+        #on the platform until a later band starts and waiting half of its headway (e.g. the first train after the
+        #night, or just before the peak). that way arriving later never means leaving earlier
+        n_bands = len(self.band_starts)
+        headway_wait = np.full((len(line_names), n_bands), np.inf)
+        catch = np.full((len(line_names), n_bands), np.inf)
+        for line_id, line in enumerate(line_names):
+            tph = self.trains_per_hour[line]
+            for band in range(n_bands):
+                if tph[band] > 0:
+                    headway_wait[line_id, band] = (3600 / tph[band]) / 2
+            for band in range(n_bands):
+                for later in range(band + 1, band + n_bands + 1):
+                    start = self.band_starts[later % n_bands] + DAY * (later // n_bands)
+                    catch[line_id, band] = min(catch[line_id, band], start + headway_wait[line_id, later % n_bands])
+        return headway_wait, catch
+
+    def day_time(self, seconds):
+        #seconds (scalar or array) -> time of day counted so that the bands are in order, [first start, first start + DAY)
+        t = np.mod(seconds, DAY)
+        return np.where(t < self.band_starts[0], t + DAY, t)
+
+def running_minimum(x):
+    #np.minimum.accumulate(x, axis=0), but in log2(rows) vectorised passes (min over the previous 1, 2, 4, ...
+    #rows) rather than one row at a time, which is a few times quicker for these short, wide matrices
+    y = np.empty_like(x)
+    step = 1
+    while step < x.shape[0]:
+        y[:step] = x[:step]
+        np.minimum(x[step:], x[:-step], out=y[step:])
+        x, y = y, x
+        step *= 2
+    return x
+
+def build_patterns(compiled, line_ids=None):
+    #[(line id, [station, ...]), ...]: for every line (or just line_ids), the shortest in-line path between every
+    #pair of its stations, keeping only the longest ones (anything that's part of a kept path is covered by it)
+    patterns = []
+    for line_id in (range(len(compiled.line_names)) if line_ids is None else sorted(line_ids)):
+        adjacency = {}
+        for state in range(len(compiled.state_station)):
+            if compiled.state_line[state] != line_id:
+                continue
+            station = compiled.state_station[state]
+            neighbours = adjacency.setdefault(station, {})
+            for k in range(compiled.state_offsets[state], compiled.state_offsets[state + 1]):
+                target = compiled.state_targets[k]
+                if compiled.state_line[target] == line_id:
+                    dest = compiled.state_station[target]
+                    neighbours[dest] = min(compiled.state_weights[k], neighbours.get(dest, float('inf')))
+        paths = []
+        for source in sorted(adjacency):
+            distances = {source: 0}
+            predecessors = {source: None}
+            queue = [(0, source)]
+            while queue:
+                distance, station = heappop(queue)
+                if distance != distances[station]:
+                    continue
+                for dest, weight in adjacency[station].items():
+                    if distance + weight < distances.get(dest, float('inf')):
+                        distances[dest] = distance + weight
+                        predecessors[dest] = station
+                        heappush(queue, (distance + weight, dest))
+            parents = set(predecessors.values())
+            for leaf in distances:
+                if leaf != source and leaf not in parents:
+                    path = [leaf]
+                    while predecessors[path[-1]] is not None:
+                        path.append(predecessors[path[-1]])
+                    paths.append(path[::-1])
+        covered = set()
+        for path in sorted(paths, key=lambda path: (-len(path), path)):
+            if (path[0], path[-1]) in covered:
+                continue
+            patterns.append((line_id, path))
+            for i in range(len(path)):
+                for j in range(i + 1, len(path)):
+                    covered.add((path[i], path[j]))
+    return patterns
+
+class TimetableRouter:
+    def __init__(self, graph, time_function=None, profiles=None):
+        self.profiles = FrequencyProfiles.load() if profiles is None else profiles
+        #ride times only, transfers are added during the search since the wait depends on the time
+        self.compiled = CompiledGraph.build(graph, time_function=time_function, transfer_time=lambda node, prev_line, new_line: 0)
+        compiled = self.compiled
+        self.n_stations = len(compiled.station_states)
+        self.walk = np.array([interchange_walk_time(station) if compiled.has_station(station) else 0.0 for station in range(self.n_stations)])
+        self.headway_wait, self.catch = self.profiles.wait_coefficients(compiled.line_names)
+        self.band_starts = np.array(self.profiles.band_starts, dtype=float)
+        self._walk_list, self._headway_list, self._catch_list = self.walk.tolist(), self.headway_wait.tolist(), self.catch.tolist()
+        self._bounds = {}
+
+        self.patterns = build_patterns(compiled)
+        self.closed = np.zeros(self.n_stations + 1)    #inf where a transfer is ruled out, see apply_disruptions
+        self._build_tables()
+        #(station, next station, line id) -> ride time, for walking a route forwards
+        self.ride_times = {}
+        for state in range(len(compiled.state_station)):
+            for k in range(compiled.state_offsets[state], compiled.state_offsets[state + 1]):
+                target = compiled.state_targets[k]
+                key = (compiled.state_station[state], compiled.state_station[target], compiled.state_line[target])
+                self.ride_times[key] = min(compiled.state_weights[k], self.ride_times.get(key, float('inf')))
+
+    def _build_tables(self):
+        #pattern p is column p of the matrices: its stations and the ride time from its first station to each of them
+        #(columns so that a running minimum down the pattern is over contiguous memory). short patterns are padded
+        #with a dummy station n_stations that is never reached
+        compiled = self.compiled
+        length = max(len(stations) for _, stations in self.patterns)
+        n_patterns = len(self.patterns)
+        self.stops = np.full((length, n_patterns), self.n_stations)
+        self.cumulative = np.zeros((length, n_patterns))
+        for p, (line_id, stations) in enumerate(self.patterns):
+            self.stops[:len(stations), p] = stations
+            for i in range(1, len(stations)):
+                ride = compiled._edge_weight(compiled.state_index[(stations[i - 1], compiled.line_names[line_id])],
+                                             compiled.state_index[(stations[i], compiled.line_names[line_id])])
+                self.cumulative[i, p] = self.cumulative[i - 1, p] + ride
+        #where each cell's boarding time is in the (line, station) table a round works out
+        pattern_line = np.array([line_id for line_id, _ in self.patterns])
+        self.board_index = pattern_line[None, :] * (self.n_stations + 1) + self.stops
+        #which patterns stop at each station: a round only scans the patterns through a station the last round improved
+        self.incidence = np.zeros((self.n_stations + 1, n_patterns), dtype=bool)
+        for p, (_, stations) in enumerate(self.patterns):
+            self.incidence[stations, p] = True
+        self.all_columns = np.arange(n_patterns)
+        self.walk_with_dummy = np.append(self.walk, 0.0)
+        #the real cells grouped by station, for the best arrival per station with one reduceat
+        cells = np.flatnonzero(self.stops.ravel() < self.n_stations)
+        cells = cells[np.argsort(self.stops.ravel()[cells], kind='stable')]
+        self.cell_order = cells
+        cell_stations = self.stops.ravel()[cells]
+        self.group_starts = np.flatnonzero(np.r_[True, cell_stations[1:] != cell_stations[:-1]])
+        self.group_stations = cell_stations[self.group_starts]
+        self.station_cells = {int(station): cells[lo:hi] for station, lo, hi in
+                              zip(self.group_stations, self.group_starts, np.r_[self.group_starts[1:], len(cells)])}
+        self.board_walk = self.walk_with_dummy + self.closed
+
+    def with_disruptions(self, disruptions):
+        #a copy of the router with apply_disruptions done to it, leaving this one as it was for the searches still
+        #running on it (the patterns and tables are rebuilt as new arrays, only the compiled graph needs copying)
+        router = object.__new__(type(self))
+        router.__dict__.update(self.__dict__)
+        router.compiled = self.compiled.copy()
+        router.apply_disruptions(disruptions)
+        return router
+
+    def apply_disruptions(self, disruptions):
+        #bring the router in line with the closures in a Disruptions (see disruptions.py): closed rides are closed on
+        #the compiled graph, only the lines with a ride that changed get new patterns, and boarding after a transfer
+        #at a closed station is ruled out. returns the edge changes like Disruptions.apply
+        compiled = self.compiled
+        changes = disruptions.apply(compiled)
+        lines = set()
+        for k, _, _ in changes:
+            tail = bisect_right(compiled.state_offsets, k) - 1
+            if compiled.state_line[tail] == compiled.state_line[compiled.state_targets[k]]:
+                lines.add(compiled.state_line[tail])
+        if lines:
+            kept = [pattern for pattern in self.patterns if pattern[0] not in lines]
+            self.patterns = sorted(kept + build_patterns(compiled, lines), key=lambda pattern: pattern[0])
+        self.closed = np.array([np.inf if station in disruptions.stations else 0.0 for station in range(self.n_stations + 1)])
+        self._build_tables()
+        self._bounds = {}
+        return changes
+
+    def wait(self, line_id, seconds):
+        #expected wait on the platform for line_id at a time (seconds after midnight of the departure day)
+        #plain floats rather than numpy, but the same sums as the vectorised version in _rounds
+        starts = self.profiles.band_starts
+        t = seconds % DAY
+        if t < starts[0]:
+            t += DAY
+        band = bisect_right(starts, t) - 1
+        return min(self._headway_list[line_id][band], self._catch_list[line_id][band] - t)
+
+    def transfer_time(self, station, line_id, seconds):
+        #walk to the platform, then wait for the next train
+        walk = self._walk_list[station]
+        return walk + self.wait(line_id, seconds + walk)
+
+    def _lower_bounds(self, end_id):
+        #lower bound on the time from every station to end_id (straight line distance at the fastest ride rate,
+        #waits only make it longer), cached per destination
+        bounds = self._bounds.get(end_id)
+        if bounds is None:
+            bounds = np.append(np.asarray(self.compiled._heuristic_bounds(end_id)), np.inf)
+            self._bounds[end_id] = bounds
+        return bounds
+
+    def _rounds(self, start_id, departure, end_id=None, max_rounds=MAX_ROUNDS):
+        #the RAPTOR rounds. returns (best, rounds): best is the earliest arrival at every station (plus the dummy one)
+        #and rounds[k - 1] is (which stations round k improved, the patterns it scanned, their boarding offsets and
+        #the arrivals at every cell) for _reconstruct
+        best = np.full(self.n_stations + 1, np.inf)
+        best[start_id] = departure
+        walk = self.walk_with_dummy
+        bounds = None if end_id is None else self._lower_bounds(end_id)
+        marked = np.zeros(self.n_stations + 1, dtype=bool)
+        marked[start_id] = True
+        rounds = []
+        for k in range(1, max_rounds + 1):
+            columns = np.flatnonzero(self.incidence[marked].any(axis=0))
+            #picking out the patterns to scan only pays when it leaves out most of them
+            subset = len(columns) < self.stops.shape[1] // 2
+            if k == 1:
+                #starting out there's no walk, but there's still the wait for the first train (the same wait as a
+                #transfer's, so a line that isn't running isn't boarded until its next band starts)
+                t = self.profiles.day_time(departure)
+                band = np.searchsorted(self.band_starts, t, 'right') - 1
+                start_board = np.full((len(self.compiled.line_names), self.n_stations + 1), np.inf)
+                start_board[:, start_id] = departure + np.minimum(self.headway_wait[:, band], self.catch[:, band] - t)
+                board_index = self.board_index.take(columns, axis=1) if subset else self.board_index
+                board = start_board.take(board_index)
+            else:
+                #the wait only depends on the line and when you get to the station, so it's worked out per
+                #(line, station) rather than per cell
+                t = self.profiles.day_time(np.where(np.isfinite(best), best, 0) + walk)
+                band = np.searchsorted(self.band_starts, t, 'right') - 1
+                wait = np.minimum(self.headway_wait[:, band], self.catch[:, band] - t)
+                board_index = self.board_index.take(columns, axis=1) if subset else self.board_index
+                board = (best + (self.board_walk + wait)).take(board_index)
+            #the first train to stop i is the best one boarded at or before i: board[j] + ride(j -> i)
+            cumulative = self.cumulative.take(columns, axis=1) if subset else self.cumulative
+            offset = board - cumulative
+            arrival = running_minimum(offset) + cumulative
+            if subset:
+                scanned = arrival
+                arrival = np.full(self.stops.shape, np.inf)
+                arrival[:, columns] = scanned
+            else:
+                columns = self.all_columns
+            station_best = np.minimum.reduceat(arrival.take(self.cell_order), self.group_starts)
+            improved = station_best < best[self.group_stations]
+            if end_id is not None:
+                #nothing that can't get to the destination before its best arrival so far can help
+                improved &= station_best + bounds[self.group_stations] < best[end_id]
+            if not improved.any():
+                break
+            marked = np.zeros(self.n_stations + 1, dtype=bool)
+            marked[self.group_stations[improved]] = True
+            rounds.append((marked, columns, offset, arrival))
+            best[self.group_stations[improved]] = station_best[improved]
+        return best, rounds
+
+    def _reconstruct(self, rounds, end_id):
+        #route as [(station, line), ...], from the end back through the rounds. in the round a station was improved,
+        #its earliest cell is the arrival it got, and the trip to that cell was boarded where the offset was smallest
+        n_patterns = self.stops.shape[1]
+        legs = []
+        station = end_id
+        k = len(rounds)
+        while True:
+            while k > 0 and not rounds[k - 1][0][station]:
+                k -= 1
+            if k == 0:
+                break
+            _, columns, offset, arrival = rounds[k - 1]
+            cells = self.station_cells[station]
+            i, p = divmod(int(cells[arrival.take(cells).argmin()]), n_patterns)
+            column = int(offset[:i + 1, np.searchsorted(columns, p)].argmin())
+            line_id, stations = self.patterns[p]
+            legs.append((self.compiled.line_names[line_id], stations[column:i + 1]))
+            station = stations[column]
+            k -= 1
+        legs.reverse()
+        route = [(legs[0][1][0], legs[0][0])]
+        for line, stations in legs:
+            route.extend((station, line) for station in stations[1:])
+        return route
+
+    def arrival_time(self, route, departure):
+        #walks the route forwards from the departure, adding the wait for the first train, each ride and, where the
+        #line changes, the transfer
+        line_ids = self.compiled.line_ids
+        t = departure
+        if len(route) > 1:
+            #the first state can be on a line that's never ridden (see route_legs), the wait is for the first one that is
+            t += self.wait(line_ids[route[1][1]], departure)
+            route = [(route[0][0], route[1][1])] + route[1:]
+        for (station, line), (next_station, next_line) in zip(route, route[1:]):
+            ride = self.ride_times[(station, next_station, line_ids[next_line])]
+            if next_line == line:
+                t += ride
+            else:
+                t += ride + self.transfer_time(station, line_ids[next_line], t)
+        return t
+
+    def earliest_arrival(self, start_id, end_id, departure, max_rounds=MAX_ROUNDS, stats=None):
+        #(route, arrival) leaving start_id at departure (seconds after midnight), like get_shortest_route but
+        #the total is the arrival time. (None, inf) if there's no route. stats (a dict) gets the number of rounds
+        INF = float('inf')
+        if not self.compiled.has_station(start_id) or not self.compiled.has_station(end_id):
+            return None, INF
+        if start_id == end_id:
+            return [self.compiled.state_to_tuple(self.compiled.station_states[start_id][0])], departure
+        best, rounds = self._rounds(start_id, departure, end_id, max_rounds)
+        if stats is not None:
+            stats['rounds'] = len(rounds)
+        if best[end_id] == INF:
+            return None, INF
+        route = self._reconstruct(rounds, end_id)
+        return route, self.arrival_time(route, departure)
+
+    def arrival_times(self, start_id, departure, max_rounds=MAX_ROUNDS):
+        #earliest arrival at every station from one search, indexed by station (inf if unreachable)
+        if not self.compiled.has_station(start_id):
+            return [float('inf')] * self.n_stations
+        best, _ = self._rounds(start_id, departure, None, max_rounds)
+        return best[:self.n_stations].tolist()
+
+    def earliest_arrival_dijkstra(self, start_id, end_id, departure, stats=None):
+        #the same query as a time dependent dijkstra over the (station, line) states, to check RAPTOR against
+        INF = float('inf')
+        compiled = self.compiled
+        if not compiled.has_station(start_id) or not compiled.has_station(end_id):
+            return None, INF
+        offsets, targets, weights = compiled.state_offsets, compiled.state_targets, compiled.state_weights
+        state_station, state_line = compiled.state_station, compiled.state_line
+        times = [INF] * len(state_station)
+        predecessors = array('i', [-1]) * len(state_station)
+        queue = []
+        for state in compiled.station_states[start_id]:
+            times[state] = departure + self.wait(state_line[state], departure)    #waiting for the first train
+            heappush(queue, (times[state], state))
+        settled = 0
+        end_state = -1
+        while queue:
+            t, state = heappop(queue)
+            if t != times[state]:
+                continue
+            settled += 1
+            if state_station[state] == end_id:
+                end_state = state
+                break
+            for k in range(offsets[state], offsets[state + 1]):
+                target = targets[k]
+                if state_line[target] == state_line[state]:
+                    arrival = t + weights[k]
+                else:
+                    arrival = t + (weights[k] + self.transfer_time(state_station[state], state_line[target], t))
+                if arrival < times[target]:
+                    times[target] = arrival
+                    predecessors[target] = state
+                    heappush(queue, (arrival, target))
+        if stats is not None:
+            stats['settled'] = settled
+        if end_state == -1:
+            return None, INF
+        route = compiled.reconstruct_path(predecessors, end_state)
+        return route, self.arrival_time(route, departure)
+
+if __name__ == "__main__":
+    import sys
+    from model import get_parameters
+    from vectorised_model import make_time_function
+    from routes import journey_summary
+    router = TimetableRouter(graph, make_time_function(graph, get_parameters()))
+    departure = parse_clock(sys.argv[3]) if len(sys.argv) > 3 else parse_clock('08:30')
+    route, arrival = router.earliest_arrival(vertex_ID[sys.argv[1]], vertex_ID[sys.argv[2]], departure)
+    print(f"Leave {format_clock(departure)}, arrive {format_clock(arrival)}: {journey_summary(route)}")
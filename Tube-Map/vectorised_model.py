@@ -0,0 +1,115 @@
+#numpy version of the journey time model in model.py
+#instead of calling get_top_speed/get_adjacent_time once per edge (and memoising on float keys), this works out
+#the time of every edge of the graph in one batched pass: haversine distances, the waterloo fudge and the kinematics
+#parameters are the same dict as model.get_parameters(), and any of them can carry leading batch dimensions
+#(e.g. relative_speeds with shape (candidates, lines)) to evaluate lots of parameter sets at once
+import numpy as np
+from setup import *
+
+WATERLOO_ID = 220
+EARTH_RADIUS = 6371000
+
+def haversine_array(lat1, lon1, lat2, lon2):
+    lat1_rad = np.radians(lat1)
+    lon1_rad = np.radians(lon1)
+    lat2_rad = np.radians(lat2)
+    lon2_rad = np.radians(lon2)
+
+    dlat = lat2_rad - lat1_rad
+    dlon = lon2_rad - lon1_rad
+
+    a = (np.sin(dlat / 2) ** 2 +
+         np.cos(lat1_rad) * np.cos(lat2_rad) * (np.sin(dlon / 2) ** 2))
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS * c
+
+class EdgeArrays:
+    #the edges of a dict graph as flat arrays, in the order `for station in graph: for edge in graph[station]`
+    #which is the same order as the station level CSR in compiled_graph
+    def __init__(self, graph, vertex_data=vertex_data, dwell_times=average_dwell_times):
+        self.line_names = sorted(set(line for station in graph for _, line, _ in graph[station]))
+        line_ids = {name: i for i, name in enumerate(self.line_names)}
+        edges = [(station, dest, line) for station in graph for dest, line, _ in graph[station]]
+        self.sources = np.array([s for s, _, _ in edges], dtype=np.int32)
+        self.targets = np.array([d for _, d, _ in edges], dtype=np.int32)
+        self.line_ids = np.array([line_ids[line] for _, _, line in edges], dtype=np.int32)
+
+        n_stations = max(vertex_data) + 1
+        latitudes = np.zeros(n_stations)
+        longitudes = np.zeros(n_stations)
+        for station, (_, lat, lon) in vertex_data.items():
+            latitudes[station] = lat
+            longitudes[station] = lon
+        self.distances = haversine_array(latitudes[self.sources], longitudes[self.sources], latitudes[self.targets], longitudes[self.targets])
+        to_waterloo = haversine_array(latitudes[WATERLOO_ID], longitudes[WATERLOO_ID], latitudes, longitudes)
+        self.waterloo_distances = (to_waterloo[self.sources] + to_waterloo[self.targets]) / 2
+        #dwell at the station we're leaving, 0 where there's no data (same as time_DC)
+        self.dwell_times = np.array([dwell_times.get((vertex_data[s][0], line), 0) for s, _, line in edges], dtype=float)
+
+        self.top_speeds = self.line_table(top_speeds)[self.line_ids]
+        self.accelerations = self.line_table(accelerations)[self.line_ids]
+        self.decelerations = self.line_table(decelerations)[self.line_ids]
+
+    def __len__(self):
+        return len(self.sources)
+
+    def take(self, indices):
+        #copy with only the given edges, e.g. just the ones some routes actually use
+        subset = object.__new__(EdgeArrays)
+        subset.line_names = self.line_names
+        for name in ('sources', 'targets', 'line_ids', 'distances', 'waterloo_distances', 'dwell_times', 'top_speeds', 'accelerations', 'decelerations'):
+            setattr(subset, name, getattr(self, name)[indices])
+        return subset
+
+    def line_table(self, table):
+        #per line dict -> array indexed by line ID
+        return np.array([table[name] for name in self.line_names], dtype=float)
+
+def get_top_speed_array(edges, parameters):
+    relative_speeds = parameters['relative_speeds']
+    if isinstance(relative_speeds, dict):
+        relative_speeds = edges.line_table(relative_speeds)
+    relative_speeds = np.asarray(relative_speeds, dtype=float)    #indexed by line ID, i.e. sorted line names
+    base = np.asarray(parameters['distance_base_coefficient'], dtype=float)[..., None]
+    relevance = np.asarray(parameters['distance_relevance_coefficient'], dtype=float)[..., None]
+
+    result = edges.top_speeds * (base * edges.distances ** relevance * relative_speeds[..., edges.line_ids])
+
+    fudge = 1/2 + ((np.log(edges.waterloo_distances + 3000) - np.log(3000))) / 15
+    return result * fudge
+
+def get_adjacent_time_array(distance, accel, decel, top_speed):
+    #same kinematics as model.get_adjacent_time, both branches worked out everywhere and picked with np.where
+    distance_if_momentary_top_speed = top_speed**2 / (2 * accel) + top_speed**2 / (2 * decel)
+
+    #we don't reach top speed
+    accel_dist = distance * decel / (accel + decel)
+    decel_dist = distance * accel / (decel + accel)
+    velocity_reached = np.sqrt(2 * accel_dist * accel)
+    short_time = accel_dist / (velocity_reached / 2) + decel_dist / (velocity_reached / 2)
+
+    #we reach top speed
+    accel_time = top_speed / accel
+    decel_time = top_speed / decel
+    cruise_dist = distance - accel_time * (top_speed / 2) - decel_time * (top_speed / 2)
+    long_time = accel_time + decel_time + (cruise_dist / top_speed)
+
+    return np.where(distance_if_momentary_top_speed > distance, short_time, long_time)
+
+def get_edge_times(edges, parameters):
+    #modelled time of every edge (dwell at the start station + running time), aligned with edges
+    #shape is (..., len(edges)) where ... are any batch dimensions of the parameters
+    top_speed = get_top_speed_array(edges, parameters)
+    return edges.dwell_times + get_adjacent_time_array(edges.distances, edges.accelerations, edges.decelerations, top_speed)
+
+def make_time_function(graph, parameters, edges=None):
+    #wraps get_edge_times in the time_function(current_station, next_station, line) interface that routes.py expects
+    if edges is None:
+        edges = EdgeArrays(graph)
+    times = get_edge_times(edges, parameters)
+    table = {}
+    for k in range(len(edges)):
+        table[(int(edges.sources[k]), int(edges.targets[k]), edges.line_names[edges.line_ids[k]])] = float(times[k])
+    def time_function(current_station, next_station, used_line):
+        return table[(current_station, next_station, used_line)]
+    return time_function
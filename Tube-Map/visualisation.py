@@ -1,6 +1,8 @@
-import folium
-from folium import plugins
-import numpy as np
+#folium takes a few hundred ms to import, so it's only imported by the functions that draw a map: importing this
+#module (e.g. for NetworkLayers) stays cheap, and scripts that only route never load it
+import html
+import json
+import os
 from setup import *
 from routes import *
 def rgb_to_hex(rgb):
@@ -8,12 +10,11 @@ def rgb_to_hex(rgb):
 
 def calculate_offset_points(p1, p2, offset_distance):
     #move these points a bit perpendicular to the line connecting them togethers
-    p1 = np.array(p1)
-    p2 = np.array(p2)
-    d = p2 - p1
-    perp = np.array([-d[1], d[0]])
-    perp = perp / np.linalg.norm(perp)
-    return p1 + perp * offset_distance, p2 + perp * offset_distance
+    d = (p2[0] - p1[0], p2[1] - p1[1])
+    length = hypot(*d)
+    perp = (-d[1] / length, d[0] / length)
+    return ((p1[0] + perp[0] * offset_distance, p1[1] + perp[1] * offset_distance),
+            (p2[0] + perp[0] * offset_distance, p2[1] + perp[1] * offset_distance))
 
 def get_min_time(graph, station1, station2):
     #min weight over all lines
@@ -23,22 +24,128 @@ def get_min_time(graph, station1, station2):
             min_time = min(min_time, weight)
     return min_time
 
+def get_line_colour(line, line_colours):
+    line_code = None
+    for code in line_colours.keys():
+        if line.lower().startswith(code.lower()):
+            line_code = code
+            break
+    return rgb_to_hex(line_colours[line_code]) if line_code else '#000000'
+
+class NetworkLayers:
+    #everything on the map that doesn't depend on the route (line segments with their offsets, station markers)
+    #worked out once, so a request only has to draw the route on top
+    def __init__(self, graph, vertex_data, line_colours):
+        station_connections = {}
+        for station_id in graph:
+            for dest, line, _ in graph[station_id]:
+                pair_key = tuple(sorted([station_id, dest]))
+                if pair_key not in station_connections:
+                    station_connections[pair_key] = []
+                if line not in [l for l, _ in station_connections[pair_key]]:
+                    station_connections[pair_key].append((line, _))
+        self.segments = {}  #((station_id, dest), line) -> (points, colour), station_id < dest
+        for (station_id, dest), connections in station_connections.items():
+            station_lat = vertex_data[station_id][1]
+            station_lon = vertex_data[station_id][2]
+            dest_lat = vertex_data[dest][1]
+            dest_lon = vertex_data[dest][2]
+            num_lines = len(connections)
+            offset_step = 0.00004
+            for i, (line, _) in enumerate(connections):
+                if num_lines > 1:
+                    offset = offset_step * (i - (num_lines - 1) / 2)
+                    p1_offset, p2_offset = calculate_offset_points([station_lat, station_lon], [dest_lat, dest_lon], offset)
+                    points = [tuple(float(x) for x in p1_offset), tuple(float(x) for x in p2_offset)]
+                else:
+                    points = [(station_lat, station_lon), (dest_lat, dest_lon)]
+                self.segments[((station_id, dest), line)] = (points, get_line_colour(line, line_colours))
+        self.stations = [(station_id, vertex_data[station_id][0], vertex_data[station_id][1], vertex_data[station_id][2]) for station_id in graph]
+
+    def lines_geojson(self):
+        features = []
+        for ((_, _), line), (points, colour) in self.segments.items():
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'LineString', 'coordinates': [[lon, lat] for lat, lon in points]},
+                'properties': {'popup': html.escape(f"{line} Line"), 'style': {'color': colour, 'weight': 3, 'opacity': 0.8}},
+            })
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def stations_geojson(self):
+        features = []
+        for station_id, station_name, station_lat, station_lon in self.stations:
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [station_lon, station_lat]},
+                'properties': {'popup': html.escape(station_name), 'style': {'radius': 4, 'color': '#000000', 'fill': True, 'weight': 1}},
+            })
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def write_geojson(self, directory='static', url_path='static'):
+        #writes the base layers as static assets into directory, returns ((file path, url), ...) for the lines and the
+        #stations, for create_route_map(base_layer_files=...). url_path is where the browser finds directory
+        #folium reads the file on every render, so a file that's already up to date is left alone, and otherwise it's
+        #written next to its final name and renamed over it, so a render never reads half of it
+        layer_files = []
+        for name, data in (('network_lines.geojson', self.lines_geojson()), ('network_stations.geojson', self.stations_geojson())):
+            file_path = os.path.join(directory, name)
+            content = json.dumps(data, separators=(',', ':'))
+            try:
+                with open(file_path) as f:
+                    unchanged = f.read() == content
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                temp_path = f'{file_path}.{os.getpid()}.tmp'
+                with open(temp_path, 'w') as f:
+                    f.write(content)
+                os.replace(temp_path, file_path)
+            layer_files.append((file_path, f'{url_path}/{name}'))
+        return tuple(layer_files)
+
+def _base_layer(layer_file, **kwargs):
+    #a GeoJson layer the browser loads from a static file, layer_file is a (file path, url) from write_geojson
+    import folium
+    file_path, url = layer_file
+    layer = folium.GeoJson(file_path, embed=False, **kwargs)
+    layer.embed_link = url
+    return layer
+
+#binds each feature's popup text, the style comes from feature.properties.style
+_POPUP_FROM_PROPERTIES = "function(feature, layer) { layer.bindPopup(feature.properties.popup); }"
+
+def get_segment_points(network, station1, station2, line):
+    #points and colour of the drawn segment between two adjacent stations on a line, in the direction of travel
+    #(None if the two aren't adjacent on that line)
+    if ((station1, station2), line) in network.segments:
+        return network.segments[((station1, station2), line)]
+    if ((station2, station1), line) in network.segments:
+        points, color = network.segments[((station2, station1), line)]
+        return points[::-1], color
+    return None
+
+def alternative_route_name(index, route_path, route_distance):
+    minutes = int(route_distance) // 60
+    transfers = max(0, len(route_legs(route_path)) - 1)
+    return f"Alternative {index}: {minutes} min, {transfers} transfer{'' if transfers == 1 else 's'}"
+
 def create_route_map(graph, vertex_data, line_colours, route_path, route_distance, 
-                    center_coords=(51.5074, -0.1278)):
+                    center_coords=(51.5074, -0.1278), network=None, base_layer_files=None, alternatives=None):
     #create a tube map html file, with a route highlighted on the file
+    #network is a NetworkLayers for this graph (built here if not given)
+    #base_layer_files is (lines, stations) from NetworkLayers.write_geojson: the map then loads the whole network from those
+    #static files instead of embedding every line and station, so only the route itself is rendered per call
+    #alternatives is a list of (path, total) like alternatives.k_shortest_routes gives, each drawn dashed in its own
+    #layer underneath the main route so they can be switched on and off from the layer control
+    import folium
+    from folium import plugins
+    from folium.utilities import JsCode
+    if network is None:
+        network = NetworkLayers(graph, vertex_data, line_colours)
     m = folium.Map(location=center_coords, zoom_start=12, tiles='cartodbpositron')
-    lines_group = folium.FeatureGroup(name="All Lines")
-    stations_group = folium.FeatureGroup(name="All Stations")
     route_lines_group = folium.FeatureGroup(name="Route")
     route_stations_group = folium.FeatureGroup(name="Route Stations")
-    station_connections = {}
-    for station_id in graph:
-        for dest, line, _ in graph[station_id]:
-            pair_key = tuple(sorted([station_id, dest]))
-            if pair_key not in station_connections:
-                station_connections[pair_key] = []
-            if line not in [l for l, _ in station_connections[pair_key]]:
-                station_connections[pair_key].append((line, _))
     route_segments = set()
     route_stations = set()
     if route_path:
@@ -48,47 +155,46 @@ def create_route_map(graph, vertex_data, line_colours, route_path, route_distanc
             route_segments.add(((station1, station2), line2))
             route_stations.add(station1)
         route_stations.add(route_path[-1][0])
-    for (station_id, dest), connections in station_connections.items():
-        station_lat = vertex_data[station_id][1]
-        station_lon = vertex_data[station_id][2]
-        dest_lat = vertex_data[dest][1]
-        dest_lon = vertex_data[dest][2]
-        num_lines = len(connections)
-        offset_step = 0.00004
-        for i, (line, _) in enumerate(connections):
-            if num_lines > 1:
-                offset = offset_step * (i - (num_lines - 1) / 2)
-            else:
-                offset = 0
-            line_code = None
-            for code in line_colours.keys():
-                if line.lower().startswith(code.lower()):
-                    line_code = code
-                    break
-            color = rgb_to_hex(line_colours[line_code]) if line_code else '#000000'
-            if num_lines > 1:
-                p1_offset, p2_offset = calculate_offset_points([station_lat, station_lon], [dest_lat, dest_lon], offset)
-                points = [tuple(p1_offset), tuple(p2_offset)]
-            else:
-                points = [(station_lat, station_lon), (dest_lat, dest_lon)]
+
+    if base_layer_files is None:
+        lines_group = folium.FeatureGroup(name="All Lines")
+        stations_group = folium.FeatureGroup(name="All Stations")
+        for ((_, _), line), (points, color) in network.segments.items():
             folium.PolyLine(points, weight=3, color=color, opacity=0.8, popup=f"{line} Line").add_to(lines_group)
-            #check if this edge is in the actual route
-            if ((station_id, dest), line) in route_segments:
-                route_line = folium.PolyLine(points, weight=8, color=color, opacity=1.0, popup=f"Route: {line} Line").add_to(route_lines_group)
-                plugins.PolyLineTextPath(route_line, text='>', repeat=True, offset=18, attributes={'font-size': '48px', 'fill': color}).add_to(route_lines_group)
-            elif ((dest, station_id), line) in route_segments:
-                route_line = folium.PolyLine(points[::-1], weight=8, color=color, opacity=1.0, popup=f"Route: {line} Line").add_to(route_lines_group)
-                plugins.PolyLineTextPath(route_line, text='>', repeat=True, offset=18, attributes={'font-size': '48px', 'fill': color}).add_to(route_lines_group)
+        for station_id, station_name, station_lat, station_lon in network.stations:
+            if station_id not in route_stations:
+                folium.CircleMarker(location=[station_lat, station_lon], radius=4, color='#000000', fill=True, popup=folium.Popup(station_name, parse_html=True), weight=1).add_to(stations_group)
+    else:
+        lines_file, stations_file = base_layer_files
+        lines_group = _base_layer(lines_file, name="All Lines", on_each_feature=JsCode(_POPUP_FROM_PROPERTIES))
+        stations_group = _base_layer(stations_file, name="All Stations", on_each_feature=JsCode(_POPUP_FROM_PROPERTIES), marker=folium.CircleMarker())
+
+    #check if each edge of the route is an actual segment, and draw it in the direction of travel
+    for (station1, station2), line in route_segments:
+        segment = get_segment_points(network, station1, station2, line)
+        if segment is None:
+            continue
+        points, color = segment
+        route_line = folium.PolyLine(points, weight=8, color=color, opacity=1.0, popup=f"Route: {line} Line").add_to(route_lines_group)
+        plugins.PolyLineTextPath(route_line, text='>', repeat=True, offset=18, attributes={'font-size': '48px', 'fill': color}).add_to(route_lines_group)
+
+    alternative_groups = []
+    for index, (alternative_path, alternative_distance) in enumerate(alternatives or [], 1):
+        name = alternative_route_name(index, alternative_path, alternative_distance)
+        group = folium.FeatureGroup(name=name)
+        for (station1, _), (station2, line) in zip(alternative_path, alternative_path[1:]):
+            segment = get_segment_points(network, station1, station2, line)
+            if segment is None:
+                continue
+            points, color = segment
+            folium.PolyLine(points, weight=6, color=color, opacity=0.6, dash_array='10 8',
+                            popup=f"{name} ({line} Line)").add_to(group)
+        alternative_groups.append(group)
 
     #draw stations as circles
     #draw radius bigger for start and end station > other stations on the route > off-route stations
-    for station_id in graph:
-        station_name = vertex_data[station_id][0]
-        station_lat = vertex_data[station_id][1]
-        station_lon = vertex_data[station_id][2]
-        if station_id not in route_stations:
-            folium.CircleMarker(location=[station_lat, station_lon], radius=4, color='#000000', fill=True, popup=folium.Popup(station_name, parse_html=True), weight=1).add_to(stations_group)
-        else:
+    for station_id, station_name, station_lat, station_lon in network.stations:
+        if station_id in route_stations:
             radius = 9 if station_id in [route_path[0][0], route_path[-1][0]] else 8
             folium.CircleMarker(location=[station_lat, station_lon], radius=radius, color='#000000', fill=True, fill_color='#ffffff', popup=folium.Popup(station_name, parse_html=True), weight=2).add_to(route_stations_group)
     #check if there's actually a route and add in the total journey time as a popup window
@@ -97,11 +203,55 @@ def create_route_map(graph, vertex_data, line_colours, route_path, route_distanc
         folium.Rectangle(bounds=[[51.45, -0.2], [51.46, -0.1]], color="none", fill=True, popup=route_info).add_to(m)
     lines_group.add_to(m)
     stations_group.add_to(m)
+    for group in alternative_groups:
+        group.add_to(m)
     route_lines_group.add_to(m)
     route_stations_group.add_to(m)
     folium.LayerControl().add_to(m)
     return m
 
+def get_band_colour(fraction):
+    #green (close) through yellow to red (at the limit)
+    fraction = min(max(fraction, 0), 1)
+    if fraction < 0.5:
+        return rgb_to_hex((int(510 * fraction), 170, 0))
+    return rgb_to_hex((255, int(170 * (2 - 2 * fraction)), 0))
+
+def create_isochrone_map(graph, vertex_data, line_colours, start_id, travel_times, minutes,
+                         center_coords=None, network=None, base_layer_files=None):
+    #map of every station reachable from start_id within the given number of minutes, coloured by how long it takes
+    #travel_times is {station: seconds}, e.g. from routes.get_travel_times, network/base_layer_files work like in create_route_map
+    import folium
+    from folium.utilities import JsCode
+    if network is None:
+        network = NetworkLayers(graph, vertex_data, line_colours)
+    if center_coords is None:
+        center_coords = vertex_data[start_id][1:]
+    limit = minutes * 60
+    m = folium.Map(location=center_coords, zoom_start=12, tiles='cartodbpositron')
+    reachable_group = folium.FeatureGroup(name=f"Within {minutes} minutes")
+
+    if base_layer_files is None:
+        lines_group = folium.FeatureGroup(name="All Lines")
+        for ((_, _), line), (points, color) in network.segments.items():
+            folium.PolyLine(points, weight=3, color=color, opacity=0.8, popup=f"{line} Line").add_to(lines_group)
+    else:
+        lines_group = _base_layer(base_layer_files[0], name="All Lines", on_each_feature=JsCode(_POPUP_FROM_PROPERTIES))
+
+    #furthest first, so the closer stations are drawn on top
+    for station_id, station_name, station_lat, station_lon in sorted(network.stations, key=lambda s: -travel_times.get(s[0], float('inf'))):
+        time = travel_times.get(station_id)
+        if time is None or time > limit:
+            continue
+        radius = 9 if station_id == start_id else 6
+        popup = folium.Popup(f"{station_name}: {int(time) // 60} min {int(time) % 60} s", parse_html=True)
+        folium.CircleMarker(location=[station_lat, station_lon], radius=radius, color='#000000', fill=True, fill_color=get_band_colour(time / limit) if limit else get_band_colour(0), fill_opacity=0.9, popup=popup, weight=1).add_to(reachable_group)
+
+    lines_group.add_to(m)
+    reachable_group.add_to(m)
+    folium.LayerControl().add_to(m)
+    return m
+
 def visualize_route(graph, vertex_data, line_colours, start_station, end_station, time_function = None, transfer_time = lambda node, prev_line, new_line: 180, mode='time'):
     #creates and saves a map with the shortest route marked on
     route_path, route_distance = get_shortest_route(graph, start_station, end_station, time_function=time_function, transfer_time = transfer_time, mode=mode)